@@ -0,0 +1,307 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+#built-in imports
+import time
+import asyncio
+import urllib.parse
+import urllib.request
+
+from ..utils.httppool import decodeBody
+
+
+class AsyncTilesFetcher():
+	'''
+	asyncio engine to download the tiles of a MapService
+	All downloads of a request run in one event loop on the calling thread :
+	a global semaphore bounds the number of tiles processed at the same time,
+	a per host semaphore bounds the number of connections opened to each server.
+	Downloading stops as soon as the running flag of the map service is turned off
+	or when the request becomes outdated (see MapService.newRequest).
+	Downloads are shared with the other requests through the map service in-flight registry.
+	'''
+
+	REDIRECT_CODES = (301, 302, 303, 307, 308)
+	MAX_REDIRECTS = 5
+
+	#interval (seconds) at which the running flag of the map service is checked
+	POLL_INTERVAL = 0.05
+
+	def __init__(self, srv, maxConcurrency=16, maxPerHost=6, timeout=3):
+		self.srv = srv
+		self.maxConcurrency = maxConcurrency
+		self.maxPerHost = maxPerHost
+		self.timeout = timeout
+		#generation of the request served by this fetcher
+		self.generation = srv.generation
+
+		#connections statistics
+		self.nbOpened = 0
+		self.nbReused = 0
+
+
+	def getTiles(self, laykey, tiles, tilesData, cpt=True, callback=None):
+		'''
+		Download tiles [(x,y,z)] of the source grid and seed tilesData list [(x,y,z,data)]
+		callback, if any, is called with each (x,y,z,data) tuple as soon as it is available
+		Reprojected tiles are not handled here, they are built by MapService.warpTiles
+		'''
+		for tile in self.iterTiles(laykey, tiles):
+			tilesData.append(tile)
+			if cpt:
+				self.srv.addProgress()
+			if callback is not None:
+				callback(tile)
+		return tilesData
+
+
+	def iterTiles(self, laykey, tiles):
+		'''Generator yielding (x,y,z,data) tuples in the order they are downloaded'''
+		loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+		#asyncio primitives must be created once the loop is set
+		self._slots = asyncio.Semaphore(self.maxConcurrency)
+		self._hostSlots = {}
+		self._idle = {}
+		pending = set( loop.create_task(self._getTile(laykey, col, row, zoom)) for col, row, zoom in tiles )
+		try:
+			while pending:
+				#cooperative cancellation
+				if not self.isAlive():
+					break
+				done, pending = loop.run_until_complete(asyncio.wait(pending, timeout=self.POLL_INTERVAL, return_when=asyncio.FIRST_COMPLETED))
+				for task in done:
+					yield task.result()
+		finally:
+			for task in pending:
+				task.cancel()
+			if pending:
+				loop.run_until_complete(asyncio.wait(pending))
+			self._closeConnections()
+			loop.close()
+			asyncio.set_event_loop(None)
+
+
+	def isAlive(self):
+		return self.srv.isAlive(self.generation)
+
+
+	async def _getTile(self, laykey, col, row, zoom):
+		await self._slots.acquire()
+		try:
+			data = await self._downloadTile(laykey, col, row, zoom)
+		finally:
+			self._slots.release()
+		return (col, row, zoom, data)
+
+
+	async def _downloadTile(self, laykey, col, row, zoom):
+		'''Asynchronous counterpart of MapService.downloadTile(), through the in-flight registry'''
+		inflight = self.srv.INFLIGHT
+		key = (self.srv.srckey, laykey, self.srv.srcGridKey, zoom, col, row)
+		while True:
+			call, leader = inflight.begin(key)
+			if leader:
+				break
+			#the tile is already downloading, wait for it without blocking the event loop
+			loop = asyncio.get_event_loop()
+			if not await loop.run_in_executor(None, inflight.wait, call, self.isAlive):
+				return None
+			if not call.cancelled:
+				return call.result
+
+		try:
+			data = await self._fetchTile(laykey, col, row, zoom)
+		except:
+			#cancelled, let a waiting request take over
+			inflight.end(key, call, cancelled=True)
+			raise
+		inflight.end(key, call, data)
+		return data
+
+	async def _fetchTile(self, laykey, col, row, zoom):
+		'''Download a tile with the retry policy and the circuit breaker of MapService.downloadTile()'''
+		srv = self.srv
+		url = srv.buildUrl(laykey, col, row, zoom)
+		breaker = srv.getBreaker()
+		srv.metrics.gauge('inflight', 1)
+		try:
+			for attempt in range(srv.MAX_RETRIES + 1):
+				if attempt > 0:
+					if not self.isAlive():
+						break
+					srv.metrics.incr('download_retries')
+					await asyncio.sleep(srv.getRetryDelay(attempt - 1))
+				if not breaker.allow():
+					break
+				start = time.perf_counter()
+				try:
+					status, data = await self._download(url)
+				except asyncio.CancelledError:
+					raise
+				except:
+					status, data = None, None
+				srv.metrics.observe('download', time.perf_counter() - start, start)
+				result = srv.checkTile(laykey, col, row, zoom, status, data)
+				if result == 'OK':
+					return data
+				elif result == 'MISSING':
+					return None
+				elif result == 'FAILED':
+					break
+		finally:
+			srv.metrics.gauge('inflight', -1)
+
+		print("Can't download tile x"+str(col)+" y"+str(row))
+		print(url)
+		return None
+
+
+	async def _download(self, url):
+		for i in range(self.MAX_REDIRECTS + 1):
+			u = urllib.parse.urlsplit(url)
+			proxy = urllib.request.getproxies().get(u.scheme)
+			if proxy is not None and not urllib.request.proxy_bypass(u.hostname):
+				#proxies are not handled by this engine, fallback to the blocking connection pool
+				loop = asyncio.get_event_loop()
+				status, data = await loop.run_in_executor(None, self.srv.HTTP_POOL.request, url, self.srv.headers)
+				headers = {}
+				break
+			status, headers, data = await self._request(u)
+			location = headers.get('location')
+			if status in self.REDIRECT_CODES and location is not None:
+				url = urllib.parse.urljoin(url, location)
+				continue
+			data = decodeBody(data, headers.get('content-encoding', ''))
+			break
+		return status, data
+
+
+	async def _request(self, u):
+		scheme = u.scheme.lower()
+		port = u.port
+		if port is None:
+			port = 443 if scheme == 'https' else 80
+		key = (scheme, u.hostname, port)
+		path = u.path or '/'
+		if u.query:
+			path += '?' + u.query
+
+		hostSlots = self._hostSlots.get(key)
+		if hostSlots is None:
+			hostSlots = self._hostSlots[key] = asyncio.Semaphore(self.maxPerHost)
+
+		await hostSlots.acquire()
+		try:
+			conn, reused = await self._acquire(key)
+			try:
+				status, headers, data, keepAlive = await asyncio.wait_for(self._send(conn, key, path), self.timeout)
+			except (OSError, EOFError, ValueError, asyncio.TimeoutError):
+				conn[1].close()
+				if not reused:
+					raise
+				#the server has probably closed this idle connection, retry once with a new one
+				conn = await self._open(key)
+				status, headers, data, keepAlive = await asyncio.wait_for(self._send(conn, key, path), self.timeout)
+			except:
+				conn[1].close()
+				raise
+			if keepAlive:
+				self._idle.setdefault(key, []).append(conn)
+			else:
+				conn[1].close()
+		finally:
+			hostSlots.release()
+
+		return status, headers, data
+
+
+	async def _acquire(self, key):
+		conns = self._idle.get(key)
+		if conns:
+			self.nbReused += 1
+			return conns.pop(), True
+		return await self._open(key), False
+
+	async def _open(self, key):
+		scheme, host, port = key
+		self.nbOpened += 1
+		return await asyncio.wait_for(asyncio.open_connection(host, port, ssl=(scheme == 'https') or None), self.timeout)
+
+	def _closeConnections(self):
+		for conns in self._idle.values():
+			for reader, writer in conns:
+				writer.close()
+		self._idle = {}
+
+
+	async def _send(self, conn, key, path):
+		'''Minimal HTTP/1.1 GET, return (status, headers, body, keepAlive)'''
+		reader, writer = conn
+		scheme, host, port = key
+		if port in (80, 443):
+			lines = ['GET ' + path + ' HTTP/1.1', 'Host: ' + host]
+		else:
+			lines = ['GET ' + path + ' HTTP/1.1', 'Host: ' + host + ':' + str(port)]
+		for k, v in self.srv.headers.items():
+			lines.append(k + ': ' + str(v))
+		writer.write( ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') )
+		await writer.drain()
+
+		#status line
+		line = await reader.readline()
+		if not line:
+			raise EOFError('Connection closed by server')
+		version, status = line.split()[:2]
+		status = int(status)
+
+		#headers
+		headers = {}
+		while True:
+			line = await reader.readline()
+			if line in (b'\r\n', b'\n', b''):
+				break
+			k, v = line.decode('latin-1').split(':', 1)
+			headers[k.strip().lower()] = v.strip()
+
+		keepAlive = version == b'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+		#body
+		if status in (204, 304) or 100 <= status < 200:
+			data = b''
+		elif headers.get('transfer-encoding', '').lower() == 'chunked':
+			chunks = []
+			while True:
+				size = int((await reader.readline()).split(b';')[0], 16)
+				if size == 0:
+					#skip trailers
+					while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+						pass
+					break
+				chunks.append(await reader.readexactly(size))
+				await reader.readexactly(2)
+			data = b''.join(chunks)
+		elif 'content-length' in headers:
+			data = await reader.readexactly(int(headers['content-length']))
+		else:
+			#body is delimited by the end of the connection
+			data = await reader.read()
+			keepAlive = False
+
+		return status, headers, data, keepAlive
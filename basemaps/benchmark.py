@@ -0,0 +1,731 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+# Basemaps benchmark
+# A local tile server stands in for the real providers, with configurable latency, bandwidth and
+# error rate, and scripted scenarios drive MapService.getImage like the map viewer does.
+# Sources are copies of servicesDefs.SOURCES entries whose host is replaced by the local server,
+# so the urls of each service type (TMS, quadkey, WMTS, WMS) are built by the real code.
+# The server counts the TCP connections it accepts, they are reported with the connections opened
+# by the keep-alive pool, which must not exceed its per host limit over a run of the thread engine.
+# The lookup mode checks that GeoPackage.getTiles returns exactly the requested tiles, with both
+# storage layouts, then times bulk lookups of 1k and 10k tiles.
+# The blockwarp and tilewarp scenarios (not run by default) compare the tiles/s of Web Mercator tiles reprojected
+# to Lambert 93 by blocks (MapService.warpTiles) and one tile at a time, on a square of 10x10 destination tiles.
+# The get-tile mode times single tile lookups (GeoPackage.getTile) through the per thread pooled connection
+# against a new connection per call, as the cache did before the connections pool.
+# The failures mode scripts 404/410, 503 then 200 and always 500 responses on the server and checks
+# that they are respectively cached as missing, retried and stop the requests by opening the circuit breaker.
+#
+# Command line usage, with the python bundled with Blender (no user interface is needed) :
+# blender -b --python-expr "import sys;from BlenderGIS.basemaps import benchmark;benchmark.main(sys.argv[sys.argv.index('--')+1:])" -- --latency 0.05 --json results.json
+# blender -b --python-expr "import sys;from BlenderGIS.basemaps import benchmark;benchmark.main(sys.argv[sys.argv.index('--')+1:])" -- --styles TMS --scenarios blockwarp tilewarp
+# blender -b --python-expr "import sys;from BlenderGIS.basemaps import benchmark;benchmark.main(sys.argv[sys.argv.index('--')+1:])" -- --lookup 1000 10000
+# blender -b --python-expr "import sys;from BlenderGIS.basemaps import benchmark;benchmark.main(sys.argv[sys.argv.index('--')+1:])" -- --failures
+# blender -b --python-expr "import sys;from BlenderGIS.basemaps import benchmark;benchmark.main(sys.argv[sys.argv.index('--')+1:])" -- --get-tile 1000
+
+#built-in imports
+import os
+import io
+import math
+import copy
+import json
+import time
+import random
+import shutil
+import sqlite3
+import datetime
+import tempfile
+import argparse
+import threading
+import tracemalloc
+import urllib.parse
+import http.server
+import socketserver
+
+#deps imports
+import numpy as np
+from PIL import Image
+
+#addon import
+from .servicesDefs import SOURCES
+from .mapservice import MapService, GeoPackage, TileMatrix
+
+
+#url style : source definition used as model
+STYLES = {
+	'TMS': 'OSM',
+	'QUADKEY': 'BING',
+	'WMTS': 'GEOPORTAIL',
+	'WMS': 'OSM_WMS'
+}
+
+SCENARIOS = ('cold', 'warm', 'pan', 'zoom', 'reproj')
+#reprojection of a block of tiles by warpTiles and one tile at a time, they need a reprojection engine for the warp grid
+WARP_SCENARIOS = ('blockwarp', 'tilewarp')
+
+LOOKUP_SIZES = (1000, 10000) #number of tiles requested at once by the lookup benchmark
+GET_TILE_CALLS = 1000 #number of single tile lookups timed by the connections benchmark
+
+
+class _TileServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+	daemon_threads = True
+	owner = None
+
+	def get_request(self):
+		'''Accept a connection and count it'''
+		request = super().get_request()
+		self.owner.addConnection()
+		return request
+
+
+class TileServer():
+	'''
+	Local HTTP server answering any GET request with a tile
+		latency : seconds waited before answering
+		bandwidth : bytes per second per request, zero means unlimited
+		errorRate : probability (0-1) of answering a 503 error
+	Responses to given urls can be scripted (see script()) to check how failures are handled.
+	Tiles are taken from a small pool of images encoded once per size, so serving them costs nothing.
+	The size of the image is given by the WIDTH and HEIGHT parameters of WMS requests (metatiles)
+	Accepted TCP connections are counted, to be compared with the connections opened by the client pool
+	'''
+
+	def __init__(self, latency=0.05, bandwidth=0, errorRate=0, tileSize=256, seed=0):
+		self.latency = latency
+		self.bandwidth = bandwidth
+		self.errorRate = errorRate
+		self.tileSize = tileSize
+		self._random = random.Random(seed)
+		self._lock = threading.Lock()
+		self.tiles = {} #{(format, width, height, index) : encoded image}
+		self.nbRequests = 0
+		self.nbErrors = 0
+		self.nbBytes = 0
+		self.nbConnections = 0
+		self.scripts = {} #{path : [status]}
+		self.scriptCounts = {} #{path : number of requests}
+
+		#textured images so that their encoded size is close to real tiles
+		rnd = np.random.RandomState(seed)
+		y, x = np.mgrid[0:tileSize, 0:tileSize]
+		self.images = []
+		for i in range(8):
+			base = (np.sin(x / (10 + i)) + np.cos(y / (15 + 2*i))) * 60 + 128
+			a = base[:, :, None] + rnd.randint(-12, 12, (tileSize, tileSize, 3))
+			self.images.append(np.clip(a, 0, 255).astype(np.uint8))
+		for fmt in ('png', 'jpeg'):
+			for i in range(len(self.images)):
+				self.getTile(fmt, tileSize, tileSize, i)
+
+		self.server = None
+		self.thread = None
+
+	def getTile(self, fmt, width, height, index):
+		'''Return an image of the pool encoded in this format and size'''
+		key = (fmt, width, height, index)
+		with self._lock:
+			data = self.tiles.get(key)
+		if data is None:
+			a = self.images[index]
+			a = np.tile(a, (height // self.tileSize + 1, width // self.tileSize + 1, 1))[:height, :width]
+			b = io.BytesIO()
+			Image.fromarray(a).save(b, format=fmt)
+			data = b.getvalue()
+			with self._lock:
+				self.tiles[key] = data
+		return data
+
+	def script(self, path, statuses):
+		'''
+		Answer the requests of this path (including its query string) with the given http status in turn,
+		the last one is repeated. Status 200 is answered with a tile, others with an error message
+		'''
+		with self._lock:
+			self.scripts[path] = list(statuses)
+			self.scriptCounts[path] = 0
+
+	def addConnection(self):
+		with self._lock:
+			self.nbConnections += 1
+
+	@property
+	def url(self):
+		host, port = self.server.server_address
+		return 'http://{}:{}'.format(host, port)
+
+	def start(self):
+		owner = self
+
+		class Handler(http.server.BaseHTTPRequestHandler):
+			protocol_version = 'HTTP/1.1'
+			def do_GET(self):
+				owner.handle(self)
+			def log_message(self, *args):
+				pass
+
+		self.server = _TileServer(('127.0.0.1', 0), Handler)
+		self.server.owner = self
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.setDaemon(True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+		if self.server is not None:
+			self.server.shutdown()
+			self.server.server_close()
+			self.server = None
+
+	def handle(self, request):
+		with self._lock:
+			self.nbRequests += 1
+			statuses = self.scripts.get(request.path)
+			if statuses is not None:
+				n = self.scriptCounts[request.path]
+				self.scriptCounts[request.path] = n + 1
+				status = statuses[min(n, len(statuses) - 1)]
+			elif self._random.random() < self.errorRate:
+				status = 503
+			else:
+				status = 200
+		time.sleep(self.latency)
+		if status != 200:
+			with self._lock:
+				self.nbErrors += 1
+			body = request.responses.get(status, ('Error',))[0].encode()
+			request.send_response(status)
+		else:
+			u = urllib.parse.urlsplit(request.path)
+			fmt = 'jpeg' if 'jpeg' in (u.path + urllib.parse.unquote(u.query)).lower() else 'png'
+			params = {k.upper(): v for k, v in urllib.parse.parse_qsl(u.query)}
+			try:
+				width = int(params.get('WIDTH', self.tileSize))
+				height = int(params.get('HEIGHT', self.tileSize))
+			except ValueError:
+				width = height = self.tileSize
+			body = self.getTile(fmt, width, height, hash(request.path) % len(self.images))
+			if self.bandwidth > 0:
+				time.sleep(len(body) / self.bandwidth)
+			with self._lock:
+				self.nbBytes += len(body)
+			request.send_response(200)
+			request.send_header('Content-Type', 'image/' + fmt)
+		request.send_header('Content-Length', str(len(body)))
+		request.end_headers()
+		request.wfile.write(body)
+
+
+
+def localSource(style, url):
+	'''
+	Register a copy of the source definition used as model for this url style, whose host is
+	replaced by url, and return its key. The source is removed by removeSource()
+	'''
+	model = STYLES[style]
+	src = copy.deepcopy(SOURCES[model])
+	if isinstance(src['urlTemplate'], dict):
+		u = urllib.parse.urlsplit(src['urlTemplate']['BASE_URL'])
+		src['urlTemplate']['BASE_URL'] = url + u.path + '?'
+	else:
+		u = urllib.parse.urlsplit(src['urlTemplate'])
+		#placeholders are not url encoded, so the template is rebuilt by hand
+		src['urlTemplate'] = url + src['urlTemplate'][len(u.scheme) + 3 + len(u.netloc):]
+	src['name'] = 'Benchmark ' + style
+	srckey = 'BENCH_' + style
+	SOURCES[srckey] = src
+	return srckey
+
+def removeSource(srckey):
+	SOURCES.pop(srckey, None)
+	MapService.BREAKERS.pop(srckey, None)
+
+
+
+class Benchmark():
+	'''
+	Run the scenarios on a map service source served by the local tile server
+		cold : view requested with empty caches
+		warm : same view requested again, tiles are read from the GeoPackage cache
+		pan : view moved by half its width several times, incremental mosaics
+		zoom : zooming in on the view center level by level
+		reproj : cold view on a destination grid, tiles are reprojected
+		blockwarp : square of warpSize tiles of the warp grid built by MapService.warpTiles
+		tilewarp : same tiles built one at a time by MapService.getTile
+	The source tiles of the warp scenarios are fetched before they are timed, so they only compare the warping
+	If the tile server is given, the TCP connections it accepts are reported with those opened by the connections pool
+	'''
+
+	def __init__(self, srckey, lon=6.0, lat=45.2, zoom=12, viewSize=(1280, 720), nbThread=10,
+		dstGridKey='WGS84', nbSteps=5, traceMemory=True, server=None, warpGridKey='LB93', warpSize=10):
+		self.srckey = srckey
+		self.laykey = list(SOURCES[srckey]['layers'].keys())[0]
+		self.lon, self.lat = lon, lat
+		self.zoom = zoom
+		self.viewSize = viewSize
+		self.nbThread = nbThread
+		self.dstGridKey = dstGridKey
+		self.nbSteps = nbSteps
+		self.traceMemory = traceMemory
+		self.server = server
+		self.warpGridKey = warpGridKey
+		self.warpSize = warpSize
+		self.folder = None
+		self.services = []
+
+	def getService(self, dstGridKey=None):
+		srv = MapService(self.srckey, self.folder, dstGridKey)
+		self.services.append(srv)
+		return srv
+
+	def getView(self, tm, zoom, dx=0):
+		'''bbox of the view centered on lon, lat, shifted by dx view widths'''
+		cx, cy = tm.geoToProj(self.lon, self.lat)
+		res = tm.getRes(zoom)
+		w, h = self.viewSize[0] * res, self.viewSize[1] * res
+		cx += dx * w
+		return (cx - w/2, cy - h/2, cx + w/2, cy + h/2)
+
+	def request(self, srv, bbox, zoom, toDstGrid=False, incremental=False):
+		'''Request a mosaic, return its number of tiles'''
+		srv.newRequest()
+		img = srv.getImage(self.laykey, bbox, zoom, toDstGrid=toDstGrid, nbThread=self.nbThread, cpt=False, incremental=incremental)
+		if img is None:
+			return 0
+		tm = srv.dstTms if toDstGrid else srv.srcTms
+		w, h = img.size
+		return (w // tm.tileSize) * (h // tm.tileSize)
+
+	#Scenarios, they return the number of tiles of the requested mosaics
+
+	def coldScenario(self):
+		srv = self.getService()
+		return srv, self.request(srv, self.getView(srv.srcTms, self.zoom), self.zoom)
+
+	def warmScenario(self):
+		#the cache files filled by the cold scenario are reused, but not the memory cache
+		srv = self.getService()
+		return srv, self.request(srv, self.getView(srv.srcTms, self.zoom), self.zoom)
+
+	def panScenario(self):
+		srv = self.getService()
+		n = 0
+		for i in range(self.nbSteps):
+			n += self.request(srv, self.getView(srv.srcTms, self.zoom, dx=i/2), self.zoom, incremental=True)
+		return srv, n
+
+	def zoomScenario(self):
+		srv = self.getService()
+		n = 0
+		for z in range(self.zoom, self.zoom + self.nbSteps):
+			n += self.request(srv, self.getView(srv.srcTms, z), z)
+		return srv, n
+
+	def reprojScenario(self):
+		srv = self.getService(self.dstGridKey)
+		return srv, self.request(srv, self.getView(srv.dstTms, self.zoom), self.zoom, toDstGrid=True)
+
+	def getWarpTiles(self, tm):
+		'''Square of warpSize x warpSize tiles centered on lon, lat'''
+		cx, cy = tm.geoToProj(self.lon, self.lat)
+		col, row = tm.getTileNumber(cx, cy, self.zoom)
+		col, row = col - self.warpSize // 2, row - self.warpSize // 2
+		return [ (col + i, row + j, self.zoom) for i in range(self.warpSize) for j in range(self.warpSize) ]
+
+	def warpPrepare(self):
+		'''Fetch the source tiles of the warp scenarios, so that they are read from the cache'''
+		srv = self.getService(self.warpGridKey)
+		srv.newRequest()
+		srv.warpTiles(self.laykey, self.getWarpTiles(srv.dstTms), nbThread=self.nbThread, cpt=False)
+		srv.flush()
+
+	blockwarpPrepare = tilewarpPrepare = warpPrepare
+
+	def blockwarpScenario(self):
+		srv = self.getService(self.warpGridKey)
+		srv.newRequest()
+		tiles = srv.warpTiles(self.laykey, self.getWarpTiles(srv.dstTms), nbThread=self.nbThread, cpt=False)
+		return srv, sum(1 for t in tiles if t[3] is not None)
+
+	def tilewarpScenario(self):
+		srv = self.getService(self.warpGridKey)
+		srv.newRequest()
+		n = 0
+		for col, row, z in self.getWarpTiles(srv.dstTms):
+			if srv.getTile(self.laykey, col, row, z, toDstGrid=True, useCache=False) is not None:
+				n += 1
+		return srv, n
+
+
+	def run(self, scenarios=SCENARIOS):
+		'''Run the scenarios in a temporary cache folder and return a list of results dictionaries'''
+		self.folder = tempfile.mkdtemp(prefix='bgis_bench_') + os.sep
+		results = []
+		try:
+			for name in scenarios:
+				prepare = getattr(self, name + 'Prepare', None)
+				if prepare is not None:
+					prepare()
+				#the memory cache is emptied so every scenario reads the GeoPackage cache or the server,
+				#the cache files are kept so the warm scenario reads the tiles downloaded by the cold one
+				MapService.MEM_CACHE.clear()
+				pool = MapService.HTTP_POOL
+				nbConnections = self.server.nbConnections if self.server is not None else 0
+				nbOpened, nbRequests, nbReused = pool.nbOpened, pool.nbRequests, pool.nbReused
+				if self.traceMemory:
+					tracemalloc.start()
+				t0 = time.perf_counter()
+				srv, nbTiles = getattr(self, name + 'Scenario')()
+				t = time.perf_counter() - t0
+				#downloads don't wait for the cache writes, but the next scenarios read them
+				srv.flush()
+				peak = 0
+				if self.traceMemory:
+					peak = tracemalloc.get_traced_memory()[1]
+					tracemalloc.stop()
+				snap = srv.metrics.snapshot()
+				latency = snap['timers'].get('download', {})
+				nbRequests = pool.nbRequests - nbRequests
+				results.append({
+					'source': self.srckey,
+					'scenario': name,
+					'tiles': nbTiles,
+					'seconds': t,
+					'tilesPerSec': nbTiles / t if t > 0 else 0,
+					'downloads': snap['counters'].get('downloads', 0),
+					'diskHits': snap['counters'].get('disk_hits', 0),
+					'errors': snap['counters'].get('download_errors', 0),
+					'latencyP50': latency.get('p50', 0),
+					'latencyP95': latency.get('p95', 0),
+					'peakMemory': peak,
+					'connections': self.server.nbConnections - nbConnections if self.server is not None else None,
+					'poolOpened': pool.nbOpened - nbOpened,
+					'reuseRatio': (pool.nbReused - nbReused) / nbRequests if nbRequests else 0
+				})
+		finally:
+			for srv in self.services:
+				srv.close()
+			self.services = []
+			shutil.rmtree(self.folder, ignore_errors=True)
+		return results
+
+
+
+def tileBlob(x, y, z):
+	'''Distinct fake tile data, GeoPackage doesn't decode the tiles'''
+	return '{},{},{}'.format(x, y, z).encode()
+
+def checkLookup(folder, dedup=False):
+	'''
+	Check that GeoPackage.getTiles returns exactly the requested tiles and their data
+	A square block of tiles is stored, then its diagonal is requested with duplicates and tiles outside
+	the block, so a lookup by ranges of columns and rows would return the whole block
+	Raise AssertionError if the result differs
+	'''
+	z, n = 10, 32
+	path = os.path.join(folder, 'check_{}.gpkg'.format('dedup' if dedup else 'plain'))
+	with GeoPackage(path, TileMatrix.get('WM'), dedup) as cache:
+		cache.putTiles([ (x, y, z, tileBlob(x, y, z)) for x in range(n) for y in range(n) ])
+		diagonal = [ (i, i, z) for i in range(n) ]
+		outside = [ (n, n, z), (0, n, z), (0, 0, z + 1), (1, 1, z - 1) ]
+		result = cache.getTiles(diagonal + outside + diagonal[:4])
+	assert len(result) == n, 'expected {} tiles, got {}'.format(n, len(result))
+	assert set(r[:3] for r in result) == set(diagonal), 'unexpected tiles returned'
+	assert all(data == tileBlob(x, y, z) for x, y, z, data in result), 'tiles data mismatch'
+
+def timeLookup(folder, sizes=LOOKUP_SIZES, dedup=False, repeat=3):
+	'''
+	Time GeoPackage.getTiles requests of random tiles in a cache holding twice the largest request
+	Return a list of results dictionaries, with the best time of repeat requests
+	'''
+	z = 12
+	n = int(math.ceil(math.sqrt(2 * max(sizes))))
+	stored = [ (x, y, z) for x in range(n) for y in range(n) ]
+	rnd = random.Random(0)
+	results = []
+	path = os.path.join(folder, 'lookup_{}.gpkg'.format('dedup' if dedup else 'plain'))
+	with GeoPackage(path, TileMatrix.get('WM'), dedup) as cache:
+		cache.putTiles([ t + (tileBlob(*t),) for t in stored ])
+		for size in sizes:
+			tiles = rnd.sample(stored, size)
+			times = []
+			for i in range(repeat):
+				t0 = time.perf_counter()
+				result = cache.getTiles(tiles)
+				times.append(time.perf_counter() - t0)
+			assert len(result) == size
+			t = min(times)
+			results.append({'layout': 'dedup' if dedup else 'plain', 'tiles': size, 'seconds': t, 'tilesPerSec': size / t})
+	return results
+
+def runLookup(sizes=LOOKUP_SIZES):
+	'''Check and time the bulk lookups of both storage layouts in a temporary folder'''
+	folder = tempfile.mkdtemp(prefix='bgis_lookup_')
+	results = []
+	try:
+		for dedup in (False, True):
+			checkLookup(folder, dedup)
+			results.extend(timeLookup(folder, sizes, dedup))
+	finally:
+		shutil.rmtree(folder, ignore_errors=True)
+	return results
+
+
+def getTileNewConnection(path, x, y, z, maxDays):
+	'''Reference single tile lookup, with a new connection per call as before the connections pool'''
+	db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+	query = 'SELECT tile_data, last_modified FROM gpkg_tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+	result = db.execute(query, (z, x, y)).fetchone()
+	db.close()
+	if result is None:
+		return None
+	if (datetime.datetime.now() - result[1]).days > maxDays:
+		return None
+	return result[0]
+
+def timeGetTile(nbCalls=GET_TILE_CALLS, repeat=3):
+	'''
+	Time nbCalls GeoPackage.getTile lookups of random stored tiles, through the pooled connection of the calling
+	thread and with a new connection per call, check that both return the same data
+	Return a list of results dictionaries, with the best time of repeat runs
+	'''
+	folder = tempfile.mkdtemp(prefix='bgis_gettile_')
+	z = 12
+	n = int(math.ceil(math.sqrt(nbCalls)))
+	stored = [ (x, y, z) for x in range(n) for y in range(n) ]
+	tiles = random.Random(0).sample(stored, nbCalls)
+	path = os.path.join(folder, 'gettile.gpkg')
+	results = []
+	try:
+		with GeoPackage(path, TileMatrix.get('WM'), False) as cache:
+			cache.putTiles([ t + (tileBlob(*t),) for t in stored ])
+			methods = (
+				('new connection', lambda x, y, z: getTileNewConnection(path, x, y, z, cache.MAX_DAYS)),
+				('pooled', cache.getTile)
+			)
+			for name, getTile in methods:
+				times = []
+				for i in range(repeat):
+					t0 = time.perf_counter()
+					data = [getTile(*t) for t in tiles]
+					times.append(time.perf_counter() - t0)
+				assert data == [tileBlob(*t) for t in tiles], 'tiles data mismatch'
+				t = min(times)
+				results.append({'connection': name, 'calls': nbCalls, 'seconds': t, 'callsPerSec': nbCalls / t})
+	finally:
+		shutil.rmtree(folder, ignore_errors=True)
+	return results
+
+def reportGetTile(results):
+	print('getTile check : ok')
+	print('{:<15} {:>6} {:>9} {:>11} {:>9}'.format('connection', 'calls', 'ms', 'calls/s', 'us/call'))
+	for r in results:
+		print('{:<15} {:>6} {:>9.1f} {:>11.0f} {:>9.1f}'.format(r['connection'], r['calls'], r['seconds']*1e3,
+			r['callsPerSec'], r['seconds'] / r['calls'] * 1e6))
+
+
+def urlPath(url):
+	'''Return the path and query string of an url, as received by the server'''
+	u = urllib.parse.urlsplit(url)
+	return u.path + ('?' + u.query if u.query else '')
+
+def checkFailures(server, folder):
+	'''
+	Check how MapService handles failing tiles against responses scripted on the local tile server :
+		404 and 410 are stored in the negative cache and are not requested again
+		503 then 200 succeeds after a retry
+		always 500 opens the circuit breaker, then the source is not requested anymore
+	Return a dictionary of the observed outcomes, raise AssertionError if one is unexpected
+	'''
+	srckey = localSource('TMS', server.url)
+	try:
+		srv = MapService(srckey, folder)
+		srv.RETRY_BACKOFF = 0.01
+		#retries are cancelled if no request is running
+		srv.newRequest()
+		laykey = list(srv.layers.keys())[0]
+		z = 10
+		paths = {}
+		def script(col, statuses):
+			path = paths[col] = urlPath(srv.buildUrl(laykey, col, 0, z))
+			server.script(path, statuses)
+		def getTile(col):
+			return srv.getTile(laykey, col, 0, z, toDstGrid=False)
+
+		#missing tiles
+		script(0, [404])
+		script(1, [410])
+		for col in (0, 1):
+			assert getTile(col) is None, 'missing tile {} returned data'.format(col)
+			assert getTile(col) is None
+			assert server.scriptCounts[paths[col]] == 1, 'missing tile {} requested again'.format(col)
+		assert srv.getCache(laykey, False).getMissing([(0, 0, z), (1, 0, z)]) == {(0, 0, z), (1, 0, z)}, 'missing tiles not cached'
+
+		#transient error
+		script(2, [503, 200])
+		assert getTile(2) is not None, 'tile not downloaded after a retry'
+		assert server.scriptCounts[paths[2]] == 2, 'unexpected number of requests for the retried tile'
+
+		#server down
+		breaker = srv.getBreaker()
+		assert breaker.state == 'CLOSED'
+		cols = range(3, 3 + srv.BREAKER_THRESHOLD)
+		for col in cols:
+			script(col, [500])
+		for col in cols:
+			assert getTile(col) is None
+		nbRequests = sum(server.scriptCounts[paths[col]] for col in cols)
+		assert breaker.state == 'OPEN', 'circuit breaker not opened'
+		assert nbRequests <= srv.BREAKER_THRESHOLD, '{} requests sent to a failing server'.format(nbRequests)
+		#not cached as missing, so that they are requested again once the server is back
+		assert not srv.getCache(laykey, False).getMissing([(col, 0, z) for col in cols]), 'failed tiles cached as missing'
+
+		srv.flush()
+		snap = srv.metrics.snapshot()['counters']
+		srv.close()
+	finally:
+		removeSource(srckey)
+	return {'missing': snap.get('missing_tiles', 0), 'negativeHits': snap.get('negative_hits', 0),
+		'retries': snap.get('download_retries', 0), 'errors': snap.get('download_errors', 0), 'breakerRequests': nbRequests}
+
+def runFailures():
+	'''Check the handling of failing tiles with a local tile server and a temporary cache folder'''
+	folder = tempfile.mkdtemp(prefix='bgis_failures_') + os.sep
+	server = TileServer(latency=0).start()
+	try:
+		return checkFailures(server, folder)
+	finally:
+		server.stop()
+		shutil.rmtree(folder, ignore_errors=True)
+
+
+def reportFailures(result):
+	print('failures check : ok')
+	print('missing tiles {missing}, negative cache hits {negativeHits}, retries {retries}, errors {errors}, '
+		'requests before the breaker opened {breakerRequests}'.format(**result))
+
+def reportLookup(results):
+	print('lookup check : ok')
+	print('{:<7} {:>6} {:>9} {:>11}'.format('layout', 'tiles', 'ms', 'tiles/s'))
+	for r in results:
+		print('{:<7} {:>6} {:>9.1f} {:>11.0f}'.format(r['layout'], r['tiles'], r['seconds']*1e3, r['tilesPerSec']))
+
+def report(results):
+	print('{:<14} {:<7} {:>6} {:>8} {:>9} {:>9} {:>9} {:>9} {:>6} {:>6} {:>6}'.format('source', 'scenario', 'tiles', 'seconds', 'tiles/s',
+		'p50 ms', 'p95 ms', 'peak MB', 'conns', 'opened', 'reuse'))
+	for r in results:
+		print('{:<14} {:<7} {:>6} {:>8.2f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>6} {:>6} {:>6.0%}'.format(r['source'], r['scenario'], r['tiles'],
+			r['seconds'], r['tilesPerSec'], r['latencyP50']*1e3, r['latencyP95']*1e3, r['peakMemory']/1024**2,
+			r['connections'] if r['connections'] is not None else '-', r['poolOpened'], r['reuseRatio']))
+	#warping by blocks against one tile at a time
+	warps = {(r['source'], r['scenario']): r for r in results if r['scenario'] in WARP_SCENARIOS}
+	for source in sorted(set(source for source, scenario in warps)):
+		block, tile = warps.get((source, 'blockwarp')), warps.get((source, 'tilewarp'))
+		if block is not None and tile is not None and tile['tilesPerSec'] > 0:
+			print('{} : blocks warping {:.1f} tiles/s, one tile at a time {:.1f} tiles/s (x{:.1f})'.format(source,
+				block['tilesPerSec'], tile['tilesPerSec'], block['tilesPerSec'] / tile['tilesPerSec']))
+
+def checkConnections(server, pool, nbOpened, engine):
+	'''
+	Report the TCP connections accepted by the local server over a run with those opened by the pool
+	since nbOpened, and check that the pool has opened at most maxSize connections to this single host
+	The asyncio engine opens its own connections, so the check is only done with the thread engine
+	'''
+	nbOpened = pool.nbOpened - nbOpened
+	print('connections : {} accepted by the server, {} opened by the pool (max {} per host), reuse ratio {:.0%}'.format(
+		server.nbConnections, nbOpened, pool.maxSize, pool.reuseRatio))
+	if engine == 'THREAD':
+		assert nbOpened <= pool.maxSize, 'the pool has opened {} connections to one host'.format(nbOpened)
+		assert server.nbConnections <= pool.maxSize, 'the server has accepted {} connections'.format(server.nbConnections)
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(description='Benchmark BlenderGIS basemaps tiles pipeline against a local tile server')
+	parser.add_argument('--styles', nargs='+', choices=list(STYLES.keys()), default=list(STYLES.keys()), help='url styles of the tested sources')
+	parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS + WARP_SCENARIOS, default=list(SCENARIOS))
+	parser.add_argument('--latency', type=float, default=0.05, help='server latency in seconds')
+	parser.add_argument('--bandwidth', type=float, default=0, help='server bandwidth in bytes/s per request (0 : unlimited)')
+	parser.add_argument('--error-rate', type=float, default=0, help='probability of a server error (0-1)')
+	parser.add_argument('--zoom', type=int, default=12)
+	parser.add_argument('--size', type=int, nargs=2, default=(1280, 720), metavar=('WIDTH', 'HEIGHT'), help='view size in pixels')
+	parser.add_argument('--threads', type=int, default=10, help='max number of concurrent downloads')
+	parser.add_argument('--engine', choices=['THREAD', 'ASYNC'], default=MapService.FETCH_ENGINE)
+	parser.add_argument('--grid', default='WGS84', help='destination grid of the reproj scenario')
+	parser.add_argument('--warp-grid', default='LB93', help='destination grid of the warp scenarios (a grid other than WM, WGS84 and UTM needs GDAL)')
+	parser.add_argument('--warp-size', type=int, default=10, help='number of tiles per side warped by the warp scenarios')
+	parser.add_argument('--no-memory', action='store_true', help="don't trace memory allocations (faster)")
+	parser.add_argument('--json', help='write the results to this json file')
+	parser.add_argument('--lookup', type=int, nargs='*', metavar='N', help='instead of the scenarios, check the cache bulk lookups and time requests of N tiles (default 1000 10000)')
+	parser.add_argument('--get-tile', type=int, nargs='?', const=GET_TILE_CALLS, metavar='N', help='instead of the scenarios, time N single tile cache lookups with a new connection per call and with the pooled connection (default 1000)')
+	parser.add_argument('--failures', action='store_true', help='instead of the scenarios, check the negative cache, retries and circuit breaker against scripted server errors')
+	args = parser.parse_args(args)
+
+	if args.get_tile is not None:
+		results = timeGetTile(args.get_tile)
+		reportGetTile(results)
+		if args.json:
+			with open(args.json, 'w') as f:
+				json.dump(results, f, indent=2)
+		return results
+
+	if args.failures:
+		result = runFailures()
+		reportFailures(result)
+		if args.json:
+			with open(args.json, 'w') as f:
+				json.dump(result, f, indent=2)
+		return result
+
+	if args.lookup is not None:
+		results = runLookup(args.lookup or LOOKUP_SIZES)
+		reportLookup(results)
+		if args.json:
+			with open(args.json, 'w') as f:
+				json.dump(results, f, indent=2)
+		return results
+
+	MapService.FETCH_ENGINE = args.engine
+	server = TileServer(args.latency, args.bandwidth, args.error_rate).start()
+	#connections kept alive by a previous run would not be counted by this server
+	pool = MapService.HTTP_POOL
+	pool.clear()
+	nbOpened = pool.nbOpened
+	results = []
+	try:
+		for style in args.styles:
+			srckey = localSource(style, server.url)
+			try:
+				bench = Benchmark(srckey, zoom=args.zoom, viewSize=args.size, nbThread=args.threads,
+					dstGridKey=args.grid, traceMemory=not args.no_memory, server=server, warpGridKey=args.warp_grid, warpSize=args.warp_size)
+				results.extend(bench.run(args.scenarios))
+			finally:
+				removeSource(srckey)
+	finally:
+		server.stop()
+
+	report(results)
+	checkConnections(server, pool, nbOpened, args.engine)
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump(results, f, indent=2)
+	return results
+
+
+if __name__ == '__main__':
+	main()
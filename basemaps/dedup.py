@@ -0,0 +1,68 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+# Tiles deduplication of the GeoPackage cache
+# Report the deduplication ratio and the space saved by a cache, or convert an existing cache to
+# the deduplicated layout (see GeoPackage.deduplicate). New caches use this layout if GeoPackage.DEDUP is set.
+#
+# Command line usage, with the python bundled with Blender :
+# blender -b --python-expr "import sys;from BlenderGIS.basemaps import dedup;dedup.main(sys.argv[sys.argv.index('--')+1:])" -- convert OSM MAPNIK --cache /path/to/cache
+
+#built-in imports
+import os
+import time
+import argparse
+
+#addon import
+from .servicesDefs import GRIDS, SOURCES
+from .mapservice import MapService
+
+
+def report(stats):
+	mb = 1024**2
+	print('{} tiles stored in {} blobs - dedup ratio {:.2f}'.format(stats['tiles'], stats['blobs'], stats['ratio']))
+	print('tiles data {:.1f} MB, stored {:.1f} MB, saved {:.1f} MB - database {:.1f} MB'.format(
+		stats['dataSize'] / mb, stats['storedSize'] / mb, stats['savedSize'] / mb, stats['fileSize'] / mb))
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(description='Deduplicate the tiles of a BlenderGIS basemaps cache')
+	parser.add_argument('action', choices=['stats', 'convert'])
+	parser.add_argument('source', choices=list(SOURCES.keys()), help='map service source key')
+	parser.add_argument('layer', help='layer key')
+	parser.add_argument('--grid', choices=list(GRIDS.keys()), help='tile matrix key (default to the source grid)')
+	parser.add_argument('--cache', required=True, help='cache folder')
+	args = parser.parse_args(args)
+
+	srv = MapService(args.source, os.path.join(args.cache, ''), args.grid)
+	if args.layer not in srv.layers:
+		parser.error('unknown layer ' + args.layer + ', choose from ' + ', '.join(srv.layers.keys()))
+	cache = srv.getCache(args.layer, srv.dstGridKey is not None)
+	try:
+		if args.action == 'convert':
+			size, t0 = cache.getSize(), time.time()
+			cache.deduplicate()
+			print('Converted in {:.1f}s, database size {:.1f} MB -> {:.1f} MB'.format(time.time() - t0, size / 1024**2, cache.getSize() / 1024**2))
+		report(cache.getDedupStats())
+	finally:
+		srv.close()
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,452 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+# Streaming GeoTIFF export
+# Write the mosaic of a large area to a tiled GeoTIFF without building the whole image in memory.
+# The raster is aligned on the tile matrix so each tile of the map service is one tile of the tiff,
+# tiles are requested by windows and written to the file as soon as they are decoded.
+# Internal overviews are built at the end by reading back the tiles of the previous level, so memory
+# usage only depends on the window size. Files that may exceed 4GB are written as BigTIFF.
+# https://www.awaresystems.be/imaging/tiff/bigtiff.html
+# http://docs.opengeospatial.org/is/19-008r4/19-008r4.html
+#
+# Command line usage, with the python bundled with Blender :
+# blender -b --python-expr "import sys;from BlenderGIS.basemaps import geotiff;geotiff.main(sys.argv[sys.argv.index('--')+1:])" -- OSM MAPNIK /path/to/file.tif --bbox 5.9 45.8 6.3 46.1 --zoom 15 --cache /path/to/cache
+
+#built-in imports
+import os
+import io
+import math
+import time
+import zlib
+import struct
+import argparse
+
+#deps imports
+import numpy as np
+from PIL import Image
+
+#addon import
+from .servicesDefs import GRIDS, SOURCES
+from .mapservice import MapService
+
+from ..utils.proj import reprojBbox, SRS
+from ..io_georaster import Tyf
+
+
+COMPRESSION = {'NONE': 1, 'DEFLATE': 8} #tiff compression codes
+
+#struct formats of the tiff field types (16 is LONG8, BigTIFF only)
+FIELD_TYPES = {1: 'B', 2: 's', 3: 'H', 4: 'I', 11: 'f', 12: 'd', 16: 'Q'}
+
+
+def geoKeys(crs, xmin, ymax, res):
+	'''
+	Return the GeoTIFF tags [(tag, type, values)] of a north up raster whose top left corner is (xmin, ymax)
+	GeoKeys are encoded by Tyf, but the directory is built here because Gkd.to_ifd() passes the values
+	of the tags as their type to TiffTag
+	'''
+	srs = SRS(crs)
+	geographic = srs.isGeo
+	gkd = Tyf.Gkd({33550: (res, res, 0.), 33922: (0., 0., 0., xmin, ymax, 0.)})
+	gkd['GTModelTypeGeoKey'] = 2 if geographic else 1
+	gkd['GTRasterTypeGeoKey'] = 1 #pixel is area
+	gkd['GTCitationGeoKey'] = crs
+	if srs.isEPSG:
+		key = 2048 if geographic else 3072 #GeographicTypeGeoKey, ProjectedCSTypeGeoKey
+		try:
+			gkd[key] = srs.code
+		except ValueError:
+			#Tyf only knows the codes of the GeoTIFF 1.0 tables, others are valid EPSG codes too
+			gkd[key] = 32767
+			dict.__getitem__(gkd, key).value = (srs.code,)
+
+	directory, doubles, ascii = [], (), b''
+	for key, tag in sorted(gkd.items()):
+		if tag.type == 0: #short value stored in the directory
+			directory.append( (key, 0, 1) + tuple(tag.value) )
+		elif tag.type == 34736: #GeoDoubleParamsTag
+			directory.append( (key, 34736, tag.count, len(doubles)) )
+			doubles += tuple(tag.value)
+		elif tag.type == 34737: #GeoAsciiParamsTag
+			directory.append( (key, 34737, tag.count + 1, len(ascii)) )
+			ascii += tag.value + b'|'
+
+	header = (gkd.version,) + tuple(gkd.revision) + (len(directory),)
+	tags = [
+		(33550, 12, tuple(gkd.get(33550))), #ModelPixelScaleTag
+		(33922, 12, tuple(gkd.get(33922)[0])), #ModelTiepointTag
+		(34735, 3, header + sum(directory, ())) #GeoKeyDirectoryTag
+	]
+	if doubles:
+		tags.append( (34736, 12, doubles) )
+	if ascii:
+		tags.append( (34737, 2, ascii) )
+	return tags
+
+
+def _packValues(typ, values):
+	'''Return the little endian bytes of the values of a tiff field'''
+	if typ == 2: #ascii, null terminated
+		if isinstance(values, str):
+			values = values.encode()
+		return values + b'\0'
+	if isinstance(values, np.ndarray):
+		return values.astype('<' + FIELD_TYPES[typ]).tobytes()
+	return struct.pack('<{}{}'.format(len(values), FIELD_TYPES[typ]), *values)
+
+
+class TiledTiffWriter():
+	'''
+	Write a tiled tiff file (RGB or RGBA 8 bits, chunky) tile by tile, in any order
+	Tiles are compressed and appended to the file as they come, their offsets are kept in memory and
+	the image file directories (IFD) are written at the end by close(), after the internal overviews.
+	Tiles that are never written reference one shared empty tile.
+		bigtiff : True, False or None to use BigTIFF only if the file may exceed the 4GB limit of classic tiff
+		nbOverviews : number of overviews levels, None to reduce the image until it fits in one tile
+		geoTags : extra tags [(tag, type, values)] of the full resolution image, like those of geoKeys()
+	'''
+
+	MAX_CLASSIC = 2**32 - 2**26 #above this estimated size, BigTIFF is used (with room left for the IFDs)
+
+	def __init__(self, path, width, height, nbBands=4, tileSize=256, compression='DEFLATE', bigtiff=None, nbOverviews=None, geoTags=None):
+		if nbBands not in (3, 4):
+			raise ValueError('Only RGB and RGBA images are supported')
+		if compression not in COMPRESSION:
+			raise ValueError('Unknown compression ' + compression)
+		if tileSize % 16 != 0:
+			raise ValueError('Tile size must be a multiple of 16')
+		self.path = path
+		self.nbBands = nbBands
+		self.tileSize = tileSize
+		self.compression = compression
+		self.geoTags = geoTags or []
+
+		#size of each level, from the full resolution image to the smallest overview
+		self.sizes = [(width, height)]
+		while (nbOverviews is None and max(width, height) > tileSize) or len(self.sizes) <= (nbOverviews or 0):
+			width, height = math.ceil(width / 2), math.ceil(height / 2)
+			self.sizes.append((width, height))
+			if width == 1 and height == 1:
+				break
+
+		if bigtiff is None:
+			rawSize = sum( self.getMatrixSize(level)[0] * self.getMatrixSize(level)[1] for level in range(len(self.sizes)) )
+			bigtiff = rawSize * tileSize**2 * nbBands > self.MAX_CLASSIC
+		self.bigtiff = bigtiff
+
+		#offsets and byte counts of the tiles of each level, by line
+		self.offsets = [np.zeros(self.getMatrixSize(level)[::-1], dtype=np.uint64) for level in range(len(self.sizes))]
+		self.byteCounts = [np.zeros(self.getMatrixSize(level)[::-1], dtype=np.uint64) for level in range(len(self.sizes))]
+		self._empty = None #(offset, byte count) of the shared empty tile
+
+		self.file = open(path, 'w+b')
+		#header, the offset of the first IFD is written by close()
+		if self.bigtiff:
+			self.file.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, 0))
+		else:
+			self.file.write(b'II' + struct.pack('<HI', 42, 0))
+		self._end = self.file.tell()
+
+	@property
+	def width(self):
+		return self.sizes[0][0]
+
+	@property
+	def height(self):
+		return self.sizes[0][1]
+
+	@property
+	def nbOverviews(self):
+		return len(self.sizes) - 1
+
+	def getMatrixSize(self, level=0):
+		'''Number of tiles (columns, rows) of a level'''
+		w, h = self.sizes[level]
+		return math.ceil(w / self.tileSize), math.ceil(h / self.tileSize)
+
+
+	def encode(self, a):
+		'''Return the compressed bytes of a tile array'''
+		if self.compression == 'DEFLATE':
+			#horizontal differencing predictor, samples are differences with the previous pixel of the line
+			a = a.copy()
+			a[:, 1:] -= a[:, :-1].copy()
+			return zlib.compress(a.tobytes(), 6)
+		return a.tobytes()
+
+	def decode(self, data):
+		'''Return the tile array of compressed bytes'''
+		if self.compression == 'DEFLATE':
+			data = zlib.decompress(data)
+		a = np.frombuffer(data, dtype=np.uint8).reshape(self.tileSize, self.tileSize, self.nbBands)
+		if self.compression == 'DEFLATE':
+			a = np.cumsum(a, axis=1, dtype=np.uint8)
+		return a
+
+	def _append(self, data):
+		self.file.seek(self._end)
+		self.file.write(data)
+		offset, self._end = self._end, self._end + len(data)
+		return offset, len(data)
+
+	def _getEmpty(self):
+		if self._empty is None:
+			self._empty = self._append(self.encode(np.zeros((self.tileSize, self.tileSize, self.nbBands), dtype=np.uint8)))
+		return self._empty
+
+	def writeTile(self, col, row, a, level=0):
+		'''
+		Write the tile (col, row) of a level (0 is the full resolution image), counted from the top left
+		a is an uint8 array (height, width, bands) of the tile, smaller arrays are padded and None is an empty tile
+		'''
+		if a is None:
+			offset, byteCount = self._getEmpty()
+		else:
+			h, w = a.shape[:2]
+			if a.shape[2] != self.nbBands or w > self.tileSize or h > self.tileSize:
+				raise ValueError('Invalid tile shape {}'.format(a.shape))
+			if w < self.tileSize or h < self.tileSize:
+				tile = np.zeros((self.tileSize, self.tileSize, self.nbBands), dtype=np.uint8)
+				tile[:h, :w] = a
+				a = tile
+			offset, byteCount = self._append(self.encode(np.ascontiguousarray(a, dtype=np.uint8)))
+		self.offsets[level][row, col] = offset
+		self.byteCounts[level][row, col] = byteCount
+
+	def readTile(self, col, row, level=0):
+		'''Return the array of a written tile, or None if it's empty'''
+		offset, byteCount = int(self.offsets[level][row, col]), int(self.byteCounts[level][row, col])
+		if byteCount == 0 or (self._empty is not None and offset == self._empty[0]):
+			return None
+		self.file.seek(offset)
+		return self.decode(self.file.read(byteCount))
+
+
+	def buildOverview(self, level):
+		'''Build the tiles of an overview level from the 2x2 children tiles of the previous level'''
+		tileSize = self.tileSize
+		w, h = self.getMatrixSize(level - 1)
+		for row in range(self.getMatrixSize(level)[1]):
+			for col in range(self.getMatrixSize(level)[0]):
+				mosaic = np.zeros((2*tileSize, 2*tileSize, self.nbBands), dtype=np.float32)
+				valid = False
+				for j in range(2):
+					for i in range(2):
+						if 2*col + i >= w or 2*row + j >= h:
+							continue
+						a = self.readTile(2*col + i, 2*row + j, level - 1)
+						if a is not None:
+							mosaic[j*tileSize:(j+1)*tileSize, i*tileSize:(i+1)*tileSize] = a
+							valid = True
+				if not valid:
+					self.writeTile(col, row, None, level)
+					continue
+				if self.nbBands == 4:
+					#colors premultiplied by alpha, otherwise transparent pixels would darken the borders
+					mosaic[:, :, :3] *= mosaic[:, :, 3:] / 255
+				tile = mosaic.reshape(tileSize, 2, tileSize, 2, self.nbBands).mean(axis=(1, 3))
+				if self.nbBands == 4:
+					alpha = tile[:, :, 3:]
+					tile[:, :, :3] *= np.where(alpha > 0, 255 / np.maximum(alpha, 1e-6), 0)
+				self.writeTile(col, row, np.clip(np.rint(tile), 0, 255).astype(np.uint8), level)
+
+	def getIFD(self, level):
+		'''Return the tags [(tag, type, values)] of the image file directory of a level'''
+		w, h = self.sizes[level]
+		offsetType = 16 if self.bigtiff else 4
+		tags = [
+			(254, 4, (0 if level == 0 else 1,)), #NewSubfileType, 1 is a reduced resolution image
+			(256, 4, (w,)), #ImageWidth
+			(257, 4, (h,)), #ImageLength
+			(258, 3, (8,) * self.nbBands), #BitsPerSample
+			(259, 3, (COMPRESSION[self.compression],)), #Compression
+			(262, 3, (2,)), #PhotometricInterpretation RGB
+			(277, 3, (self.nbBands,)), #SamplesPerPixel
+			(284, 3, (1,)), #PlanarConfiguration chunky
+			(322, 3, (self.tileSize,)), #TileWidth
+			(323, 3, (self.tileSize,)), #TileLength
+			(324, offsetType, self.offsets[level].ravel()), #TileOffsets
+			(325, offsetType, self.byteCounts[level].ravel()), #TileByteCounts
+			(339, 3, (1,) * self.nbBands) #SampleFormat unsigned integer
+		]
+		if self.compression == 'DEFLATE':
+			tags.append( (317, 3, (2,)) ) #Predictor horizontal differencing
+		if self.nbBands == 4:
+			tags.append( (338, 3, (2,)) ) #ExtraSamples unassociated alpha
+		if level == 0:
+			tags.append( (305, 2, 'BlenderGIS') ) #Software
+			tags.extend(self.geoTags)
+		return sorted(tags, key=lambda t: t[0])
+
+	def packIFD(self, tags, start, nextIFD):
+		'''Return the bytes of an IFD written at start, its values which don't fit in the entries follow it'''
+		if self.bigtiff:
+			countFmt, entryFmt, offsetFmt, inline = '<Q', '<HHQ', '<Q', 8
+		else:
+			countFmt, entryFmt, offsetFmt, inline = '<H', '<HHI', '<I', 4
+		entrySize = struct.calcsize(entryFmt) + inline
+		dataStart = start + struct.calcsize(countFmt) + len(tags) * entrySize + struct.calcsize(offsetFmt)
+		entries, data = bytearray(struct.pack(countFmt, len(tags))), bytearray()
+		for tag, typ, values in tags:
+			payload = _packValues(typ, values)
+			count = len(payload) // struct.calcsize(FIELD_TYPES[typ])
+			if len(payload) <= inline:
+				field = payload.ljust(inline, b'\0')
+			else:
+				field = struct.pack(offsetFmt, dataStart + len(data))
+				data += payload + b'\0' * (len(payload) % 2) #values start on a word boundary
+			entries += struct.pack(entryFmt, tag, typ, count) + field
+		return bytes(entries + struct.pack(offsetFmt, nextIFD) + data)
+
+	def close(self):
+		'''Build the overviews, write the IFDs at the end of the file and link the first one in the header'''
+		for level in range(1, len(self.sizes)):
+			self.buildOverview(level)
+		#tiles never written are empty
+		for offsets, byteCounts in zip(self.offsets, self.byteCounts):
+			if not byteCounts.all():
+				offset, byteCount = self._getEmpty()
+				offsets[byteCounts == 0] = offset
+				byteCounts[byteCounts == 0] = byteCount
+
+		start = self._end + self._end % 2
+		firstIFD = start
+		for level in range(len(self.sizes)):
+			tags = self.getIFD(level)
+			ifd = self.packIFD(tags, start, 0)
+			if level < self.nbOverviews:
+				ifd = self.packIFD(tags, start, start + len(ifd))
+			self.file.seek(start)
+			self.file.write(ifd)
+			start += len(ifd)
+
+		if not self.bigtiff and start > 2**32 - 1:
+			raise ValueError('The file is too large for a classic tiff, use BigTIFF')
+		self.file.seek(8 if self.bigtiff else 4)
+		self.file.write(struct.pack('<Q' if self.bigtiff else '<I', firstIFD))
+		self.file.close()
+
+	def abort(self):
+		'''Close and remove the partial file'''
+		self.file.close()
+		os.remove(self.path)
+
+
+
+def exportGeoTiff(srv, laykey, bbox, zoom, path, bboxCRS=None, toDstGrid=False, compression='DEFLATE', bigtiff=None, overviews=True, window=4096, useCache=True, nbThread=10, overwrite=False, report=True):
+	'''
+	Write the tiles of a layer covering bbox at a zoom level to a tiled GeoTIFF file
+	bbox can be expressed in any crs (bboxCRS), it's reprojected to the grid crs if needed
+	Tiles are requested by windows of window x window pixels, so memory usage doesn't depend on the
+	size of the area. Missing tiles are transparent.
+	Exporting is a request of the map service, it can be stopped by srv.cancel() or by a new request,
+	the partial file is then removed. Return the number of exported tiles
+	'''
+	if os.path.exists(path) and not overwrite:
+		raise FileExistsError(path)
+	tm = srv.dstTms if toDstGrid else srv.srcTms
+	if bboxCRS is not None and bboxCRS != tm.CRS:
+		bbox = reprojBbox(bboxCRS, tm.CRS, bbox)
+
+	colMin, rowMin, colMax, rowMax = tm.getTileRange(bbox, zoom)
+	nbCols, nbRows = colMax - colMin + 1, rowMax - rowMin + 1
+	tileSize = tm.tileSize
+	#rows of the tiff are numbered from the top, those of the grid from the bottom on a south west grid
+	if tm.originLoc == 'NW':
+		topRow, toLine = rowMin, lambda row: row - rowMin
+	else:
+		topRow, toLine = rowMax, lambda row: rowMax - row
+	xmin, ymax = tm.getTileCoords(colMin, topRow, zoom)
+
+	writer = TiledTiffWriter(path, nbCols * tileSize, nbRows * tileSize, 4, tileSize, compression, bigtiff,
+		None if overviews else 0, geoKeys(tm.CRS, xmin, ymax, tm.getRes(zoom)))
+	step = max(1, window // tileSize)
+	nbDone, t0 = 0, time.time()
+	generation = srv.newRequest()
+	try:
+		for j in range(0, nbRows, step):
+			for i in range(0, nbCols, step):
+				lines = range(j, min(j + step, nbRows))
+				tiles = [ (colMin + col, rowMin + line if tm.originLoc == 'NW' else rowMax - line, zoom)
+					for line in lines for col in range(i, min(i + step, nbCols)) ]
+				tiles = srv.getTiles(laykey, tiles, [], toDstGrid, useCache=useCache, nbThread=nbThread, cpt=False)
+				if not srv.isAlive(generation):
+					writer.abort()
+					return 0
+				for col, row, z, data in tiles:
+					a = None
+					if data is not None:
+						try:
+							img = Image.open(io.BytesIO(data)).convert('RGBA')
+						except Exception:
+							img = None
+						if img is not None and img.size == (tileSize, tileSize):
+							a = np.asarray(img)
+					writer.writeTile(col - colMin, toLine(row), a)
+				nbDone += len(tiles)
+				if report:
+					t = max(time.time() - t0, 1e-6)
+					print('Exporting z{} : {}/{} tiles - {:.1f} tiles/s'.format(zoom, nbDone, nbCols * nbRows, nbDone / t))
+		if report and writer.nbOverviews:
+			print('Building {} overviews'.format(writer.nbOverviews))
+		writer.close()
+	except:
+		writer.abort()
+		raise
+	finally:
+		srv.cancel(generation)
+	return nbDone
+
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(description='Export a BlenderGIS basemap to a tiled GeoTIFF')
+	parser.add_argument('source', choices=list(SOURCES.keys()), help='map service source key')
+	parser.add_argument('layer', help='layer key')
+	parser.add_argument('tiff', help='path of the GeoTIFF file')
+	parser.add_argument('--grid', choices=list(GRIDS.keys()), help='tile matrix key (default to the source grid)')
+	parser.add_argument('--bbox', nargs=4, type=float, required=True, metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'))
+	parser.add_argument('--crs', default='EPSG:4326', help='crs of the bbox (default EPSG:4326)')
+	parser.add_argument('--zoom', type=int, required=True)
+	parser.add_argument('--cache', required=True, help='cache folder')
+	parser.add_argument('--compression', choices=list(COMPRESSION.keys()), default='DEFLATE')
+	parser.add_argument('--bigtiff', action='store_true', default=None, help='force BigTIFF (default to BigTIFF only if the file may exceed 4GB)')
+	parser.add_argument('--no-overviews', action='store_true', help="don't build internal overviews")
+	parser.add_argument('--window', type=int, default=4096, help='size in pixels of the windows requested at once')
+	parser.add_argument('--threads', type=int, default=10, help='max number of concurrent downloads')
+	parser.add_argument('--overwrite', action='store_true', help='replace the existing file')
+	args = parser.parse_args(args)
+
+	srv = MapService(args.source, os.path.join(args.cache, ''), args.grid)
+	if args.layer not in srv.layers:
+		parser.error('unknown layer ' + args.layer + ', choose from ' + ', '.join(srv.layers.keys()))
+	try:
+		exportGeoTiff(srv, args.layer, args.bbox, args.zoom, args.tiff, bboxCRS=args.crs, toDstGrid=srv.dstGridKey is not None,
+			compression=args.compression, bigtiff=args.bigtiff, overviews=not args.no_overviews, window=args.window,
+			nbThread=args.threads, overwrite=args.overwrite)
+	except KeyboardInterrupt:
+		srv.cancel()
+		print('Export interrupted')
+	finally:
+		srv.close()
+
+
+if __name__ == '__main__':
+	main()
@@ -19,14 +19,21 @@
 
 #built-in imports
 import math
+import bisect
 import os
 import io
 import threading
 import queue
 import datetime
+import time
+import random
+import hashlib
 import sqlite3
-import urllib.request
+import http.client
 import imghdr
+import collections
+import copy
+import concurrent.futures
 
 
 #deps imports
@@ -49,10 +56,13 @@ else:
 
 #addon import
 from .servicesDefs import GRIDS, SOURCES
+from .asyncfetch import AsyncTilesFetcher
 
 #reproj functions
 from ..utils.geom import BBOX
-from ..utils.proj import reprojPt, reprojBbox, dd2meters, SRS
+from ..utils.proj import Reproj, ArrayReproj, reprojPt, reprojBbox, dd2meters, meters2dd, SRS
+from ..utils.httppool import HTTPConnectionPool, CircuitBreaker
+from ..utils.metrics import Metrics
 #Constants
 
 
@@ -67,11 +77,113 @@ from ..utils.proj import reprojPt, reprojBbox, dd2meters, SRS
 #table_name refer to the name of the table witch contains tiles data
 #here for simplification, table_name will always be named "gpkg_tiles"
 
+#Deduplicated layout : identical tiles (oceans, empty coverage...) are stored once in a blobs table
+#keyed by content hash, and referenced by a tiles index. gpkg_tiles is then a view joining both tables,
+#with triggers forwarding writes, so the file stays a valid GeoPackage for other readers and the
+#queries of this module work with both layouts. Blobs are deleted when their last tile is deleted.
+
+_lastHash = (None, None)
+
+def tileHash(data):
+	"""Content hash of a tile, the triggers hash the same data several times so the last digest is kept"""
+	global _lastHash
+	last, digest = _lastHash
+	if data != last:
+		digest = hashlib.sha1(data).digest()
+		_lastHash = (data, digest)
+	return digest
+
+DEDUP_SCHEMA = (
+	"""CREATE TABLE bgis_tile_blobs (
+		id INTEGER PRIMARY KEY,
+		hash BLOB NOT NULL UNIQUE,
+		tile_data BLOB NOT NULL)""",
+
+	"""CREATE TABLE bgis_tiles (
+		id INTEGER PRIMARY KEY AUTOINCREMENT,
+		zoom_level INTEGER NOT NULL,
+		tile_column INTEGER NOT NULL,
+		tile_row INTEGER NOT NULL,
+		blob_id INTEGER NOT NULL REFERENCES bgis_tile_blobs(id),
+		last_modified TIMESTAMP DEFAULT (datetime('now','localtime')),
+		last_access INTEGER NOT NULL DEFAULT 0,
+		UNIQUE (zoom_level, tile_column, tile_row))""",
+
+	"CREATE INDEX idx_tiles_blob ON bgis_tiles (blob_id)",
+
+	#blobs which may be no more referenced, they are checked by GeoPackage.deleteOrphanBlobs()
+	"CREATE TABLE bgis_orphan_blobs (blob_id INTEGER PRIMARY KEY)",
+
+	"""CREATE VIEW gpkg_tiles AS
+		SELECT t.id, t.zoom_level, t.tile_column, t.tile_row, b.tile_data, t.last_modified, t.last_access
+		FROM bgis_tiles AS t JOIN bgis_tile_blobs AS b ON b.id = t.blob_id""",
+
+	#the conflict clause of a statement on the view (INSERT OR REPLACE...) overrides those of the
+	#triggers statements, so the blob insertion must not rely on a conflict to skip existing blobs
+	"""CREATE TRIGGER gpkg_tiles_insert INSTEAD OF INSERT ON gpkg_tiles
+	BEGIN
+		INSERT INTO bgis_tile_blobs (hash, tile_data)
+			SELECT bgis_tile_hash(NEW.tile_data), NEW.tile_data
+			WHERE NOT EXISTS (SELECT 1 FROM bgis_tile_blobs WHERE hash = bgis_tile_hash(NEW.tile_data));
+		INSERT INTO bgis_tiles (zoom_level, tile_column, tile_row, blob_id, last_modified, last_access)
+			VALUES (NEW.zoom_level, NEW.tile_column, NEW.tile_row,
+			(SELECT id FROM bgis_tile_blobs WHERE hash = bgis_tile_hash(NEW.tile_data)),
+			COALESCE(NEW.last_modified, datetime('now','localtime')), COALESCE(NEW.last_access, 0));
+		--the tile insertion is skipped by INSERT OR IGNORE statements, the new blob may be unused
+		INSERT OR IGNORE INTO bgis_orphan_blobs (blob_id)
+			SELECT id FROM bgis_tile_blobs WHERE hash = bgis_tile_hash(NEW.tile_data)
+			AND NOT EXISTS (SELECT 1 FROM bgis_tiles WHERE blob_id = bgis_tile_blobs.id);
+	END""",
+
+	"""CREATE TRIGGER gpkg_tiles_update INSTEAD OF UPDATE ON gpkg_tiles
+	BEGIN
+		INSERT INTO bgis_tile_blobs (hash, tile_data)
+			SELECT bgis_tile_hash(NEW.tile_data), NEW.tile_data
+			WHERE NEW.tile_data IS NOT OLD.tile_data
+			AND NOT EXISTS (SELECT 1 FROM bgis_tile_blobs WHERE hash = bgis_tile_hash(NEW.tile_data));
+		UPDATE bgis_tiles SET zoom_level = NEW.zoom_level, tile_column = NEW.tile_column, tile_row = NEW.tile_row,
+			blob_id = (SELECT id FROM bgis_tile_blobs WHERE hash = bgis_tile_hash(NEW.tile_data)),
+			last_modified = NEW.last_modified, last_access = NEW.last_access
+			WHERE id = OLD.id;
+	END""",
+
+	"""CREATE TRIGGER gpkg_tiles_delete INSTEAD OF DELETE ON gpkg_tiles
+	BEGIN
+		DELETE FROM bgis_tiles WHERE id = OLD.id;
+	END""",
+
+	#also fired by the rows replaced on conflict (recursive triggers are enabled by GeoPackage._connect)
+	"""CREATE TRIGGER bgis_tiles_delete AFTER DELETE ON bgis_tiles
+	BEGIN
+		INSERT OR IGNORE INTO bgis_orphan_blobs (blob_id) VALUES (OLD.blob_id);
+	END""",
+
+	"""CREATE TRIGGER bgis_tiles_update AFTER UPDATE OF blob_id ON bgis_tiles
+	WHEN NEW.blob_id IS NOT OLD.blob_id
+	BEGIN
+		INSERT OR IGNORE INTO bgis_orphan_blobs (blob_id) VALUES (OLD.blob_id);
+	END"""
+)
+
 class GeoPackage():
 
 	MAX_DAYS = 90
 
-	def __init__(self, path, tm):
+	#Storage layout of new caches
+	DEDUP = False #deduplicate identical tiles
+
+	#Cache lifecycle settings
+	MAX_SIZE = 0 #max size of the database file in bytes, zero means no limit
+	ACCESS_RESOLUTION = 3600 #seconds, last access time of a tile is not updated more often
+	MAINTENANCE_INTERVAL = 1000 #number of tiles written between two background maintenance passes
+	EVICTION_BATCH = 500 #number of tiles deleted per transaction during eviction
+	MISSING_TTL = 7 * 24 * 3600 #seconds during which a tile missing on the server is not requested again
+
+	#sqlite connections settings
+	TIMEOUT = 30 #seconds to wait for a lock before raising an error
+	CACHED_STATEMENTS = 64 #number of prepared statements kept by each connection
+
+	def __init__(self, path, tm, dedup=None):
 		self.dbPath = path
 		self.name = os.path.splitext(os.path.basename(path))[0]
 
@@ -82,7 +194,20 @@ class GeoPackage():
 		self.xmin, self.ymin, self.xmax, self.ymax = tm.globalbbox
 		self.resolutions = tm.getResList()
 
+		#Connections pool, one connection per thread reused for the object's lifetime
+		self._pool = {}
+		self._lock = threading.Lock()
+
+		#Tiles read since last flush {(x,y,z) : time}, last access times are written lazily
+		self._accessed = {}
+		#Background maintenance
+		self._maintenance = None
+		self._nbPut = 0
+		#Background writes
+		self.writer = CacheWriter(self)
+
 		if not self.isGPKG():
+			self.dedup = self.DEDUP if dedup is None else dedup
 			self.create()
 			self.insertMetadata()
 
@@ -91,17 +216,77 @@ class GeoPackage():
 			#self.insertCRS(4326, "WGS84")
 
 			self.insertTileMatrixSet()
+		else:
+			self.dedup = self.isDedup()
+			self.upgrade()
+
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+
+	def _connect(self):
+		"""Open a new connection to the database with write ahead log journaling"""
+		#detect_types parameter is used to automatically convert date to Python object
+		#check_same_thread is disabled because connections of terminated threads are recycled,
+		#a connection is never used by more than one thread at the same time
+		db = sqlite3.connect(self.dbPath, timeout=self.TIMEOUT, detect_types=sqlite3.PARSE_DECLTYPES,
+			cached_statements=self.CACHED_STATEMENTS, check_same_thread=False)
+		#Allow to release free pages without a full vacuum, this has effect only
+		#on new databases, so it must be set before anything is written to the file
+		db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+		#WAL allows readers to not block the writer (and vice versa)
+		db.execute("PRAGMA journal_mode=WAL")
+		#in WAL mode, NORMAL sync is safe against corruption and avoid a fsync at each commit
+		db.execute("PRAGMA synchronous=NORMAL")
+		#used by the triggers of the deduplicated layout, replaced rows must fire the delete triggers
+		db.create_function('bgis_tile_hash', 1, tileHash)
+		db.execute("PRAGMA recursive_triggers=ON")
+		return db
+
+	def getConnection(self):
+		"""
+		Return the connection owned by the calling thread
+		Connections left by terminated threads are reassigned instead of opening new ones
+		"""
+		thread = threading.current_thread()
+		with self._lock:
+			db = self._pool.get(thread)
+			if db is None:
+				dead = [t for t in self._pool if not t.is_alive()]
+				if dead:
+					db = self._pool.pop(dead.pop())
+					for t in dead:
+						self._pool.pop(t).close()
+				else:
+					db = self._connect()
+				self._pool[thread] = db
+		return db
+
+	def close(self):
+		"""Commit queued tiles and close all opened connections, a new one will be opened if the cache is requested again"""
+		self.writer.close()
+		#the last writes may have started a maintenance, its connection must not be closed under it
+		maintenance = self._maintenance
+		if maintenance is not None and maintenance is not threading.current_thread():
+			maintenance.join()
+		with self._lock:
+			for db in self._pool.values():
+				db.close()
+			self._pool.clear()
 
 
 	def isGPKG(self):
 		if not os.path.exists(self.dbPath):
 			return False
-		db = sqlite3.connect(self.dbPath)
+		db = self.getConnection()
 
 		#check application id
 		app_id = db.execute("PRAGMA application_id").fetchone()
 		if not app_id[0] == 1196437808:
-			db.close()
 			return False
 		#quick check of table schema
 		try:
@@ -111,21 +296,20 @@ class GeoPackage():
 			db.execute('SELECT table_name FROM gpkg_tile_matrix LIMIT 1')
 			db.execute('SELECT zoom_level, tile_column, tile_row, tile_data FROM gpkg_tiles LIMIT 1')
 		except:
-			db.close()
 			return False
 		else:
-			db.close()
 			return True
 
 
 	def create(self):
 		"""Create default geopackage schema on the database."""
-		db = sqlite3.connect(self.dbPath) #this attempt will create a new file if not exist
+		db = self.getConnection() #this attempt will create a new file if not exist
 		cursor = db.cursor()
 
 		# Add GeoPackage version 1.0 ("GP10" in ASCII) to the Sqlite header
 		cursor.execute("PRAGMA application_id = 1196437808;")
 
+
 		cursor.execute("""
 			CREATE TABLE gpkg_contents (
 				table_name TEXT NOT NULL PRIMARY KEY,
@@ -182,22 +366,71 @@ class GeoPackage():
 					REFERENCES gpkg_contents(table_name));
 		""")
 
-		cursor.execute("""
-			CREATE TABLE gpkg_tiles (
-				id INTEGER PRIMARY KEY AUTOINCREMENT,
+		if self.dedup:
+			self.createDedupTables()
+		else:
+			cursor.execute("""
+				CREATE TABLE gpkg_tiles (
+					id INTEGER PRIMARY KEY AUTOINCREMENT,
+					zoom_level INTEGER NOT NULL,
+					tile_column INTEGER NOT NULL,
+					tile_row INTEGER NOT NULL,
+					tile_data BLOB NOT NULL,
+					last_modified TIMESTAMP DEFAULT (datetime('now','localtime')),
+					last_access INTEGER NOT NULL DEFAULT 0,
+					UNIQUE (zoom_level, tile_column, tile_row));
+			""")
+
+		self.createIndexes()
+
+		db.commit()
+
+
+	def createDedupTables(self):
+		"""Create the tables, the gpkg_tiles view and the triggers of the deduplicated layout"""
+		db = self.getConnection()
+		#statements are executed one by one, executescript would commit the current transaction
+		for statement in DEDUP_SCHEMA:
+			db.execute(statement)
+
+	def isDedup(self):
+		"""Return True if the cache use the deduplicated layout"""
+		db = self.getConnection()
+		result = db.execute("SELECT type FROM sqlite_master WHERE name = 'gpkg_tiles'").fetchone()
+		return result is not None and result[0] == 'view'
+
+	@property
+	def tilesTable(self):
+		"""Table holding the tiles index columns (coordinates and dates), used by the lifecycle queries"""
+		return 'bgis_tiles' if self.dedup else 'gpkg_tiles'
+
+	def createIndexes(self):
+		"""Indexes used by expiry and least recently used eviction, and the negative cache table"""
+		db = self.getConnection()
+		db.execute("CREATE INDEX IF NOT EXISTS idx_tiles_last_access ON " + self.tilesTable + " (last_access)")
+		db.execute("CREATE INDEX IF NOT EXISTS idx_tiles_last_modified ON " + self.tilesTable + " (last_modified)")
+		#tiles missing on the server (404 over the oceans, out of the layer coverage...)
+		db.execute("""CREATE TABLE IF NOT EXISTS bgis_missing_tiles (
 				zoom_level INTEGER NOT NULL,
 				tile_column INTEGER NOT NULL,
 				tile_row INTEGER NOT NULL,
-				tile_data BLOB NOT NULL,
-				last_modified TIMESTAMP DEFAULT (datetime('now','localtime')),
-				UNIQUE (zoom_level, tile_column, tile_row));
-		""")
+				status INTEGER,
+				expires INTEGER NOT NULL,
+				PRIMARY KEY (zoom_level, tile_column, tile_row)) WITHOUT ROWID""")
+		db.commit()
 
-		db.close()
+	def upgrade(self):
+		"""Add the last access column, the lifecycle indexes and the negative cache to caches created by previous versions"""
+		db = self.getConnection()
+		columns = [r[1] for r in db.execute("PRAGMA table_info(" + self.tilesTable + ")")]
+		if 'last_access' not in columns:
+			#non constant default values are not allowed by alter table
+			db.execute("ALTER TABLE gpkg_tiles ADD COLUMN last_access INTEGER NOT NULL DEFAULT 0")
+		self.createIndexes()
 
 
 	def insertMetadata(self):
-		db = sqlite3.connect(self.dbPath)
+		db = self.getConnection()
 		query = """INSERT INTO gpkg_contents (
 					table_name, data_type,
 					identifier, description,
@@ -206,11 +439,10 @@ class GeoPackage():
 				VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);"""
 		db.execute(query, ("gpkg_tiles", "tiles", self.name, "Created with BlenderGIS", self.xmin, self.ymin, self.xmax, self.ymax, self.code))
 		db.commit()
-		db.close()
 
 
 	def insertCRS(self, code, name, auth='EPSG', wkt=''):
-		db = sqlite3.connect(self.dbPath)
+		db = self.getConnection()
 		db.execute(""" INSERT INTO gpkg_spatial_ref_sys (
 					srs_id,
 					organization,
@@ -220,11 +452,10 @@ class GeoPackage():
 				VALUES (?, ?, ?, ?, ?)
 			""", (code, auth, code, name, wkt))
 		db.commit()
-		db.close()
 
 
 	def insertTileMatrixSet(self):
-		db = sqlite3.connect(self.dbPath)
+		db = self.getConnection()
 
 		#Tile matrix set
 		query = """INSERT OR REPLACE INTO gpkg_tile_matrix_set (
@@ -250,61 +481,620 @@ class GeoPackage():
 
 
 		db.commit()
-		db.close()
 
 
 	def getTile(self, x, y, z):
-		#connect with detect_types parameter for automatically convert date to Python object
-		db = sqlite3.connect(self.dbPath, detect_types=sqlite3.PARSE_DECLTYPES)
+		pending = self.writer.getPending([(x, y, z)])
+		if pending:
+			return pending[0][3]
+		db = self.getConnection()
 		query = 'SELECT tile_data, last_modified FROM gpkg_tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
 		result = db.execute(query, (z, x, y)).fetchone()
-		db.close()
 		if result is None:
 			return None
 		timeDelta = datetime.datetime.now() - result[1]
 		if timeDelta.days > self.MAX_DAYS:
 			return None
+		self.touch([(x, y, z)])
 		return result[0]
 
 	def putTile(self, x, y, z, data):
-		db = sqlite3.connect(self.dbPath)
-		query = """INSERT OR REPLACE INTO gpkg_tiles
-		(tile_column, tile_row, zoom_level, tile_data) VALUES (?,?,?,?)"""
-		db.execute(query, (x, y, z, data))
-		db.commit()
-		db.close()
+		self.putTiles([(x, y, z, data)])
+
+	def flush(self):
+		"""Wait for the tiles queued in the background writer to be committed"""
+		self.writer.flush()
 
 
 	def getTiles(self, tiles):
 		"""tiles = list of (x,y,z) tuple
 		return list of (x,y,z,data) tuple"""
-		n = len(tiles)
-		xs, ys, zs = zip(*tiles)
-		lst = list(xs) + list(ys) + list(zs)
-
-		db = sqlite3.connect(self.dbPath, detect_types=sqlite3.PARSE_DECLTYPES)
-		query = "SELECT tile_column, tile_row, zoom_level, tile_data FROM gpkg_tiles WHERE tile_column IN (" + ','.join('?'*n) + ") AND tile_row IN (" + ','.join('?'*n) + ") AND zoom_level IN (" + ','.join('?'*n) + ")"
-
-		result = db.execute(query, lst).fetchall()
-		db.close()
+		if not tiles:
+			return []
 
+		#Requested tiles are loaded in a temporary table (private to this connection) and joined
+		#against the unique index of gpkg_tiles, so only the exact (x,y,z) triplets are returned
+		db = self.getConnection()
+		db.execute("""CREATE TEMP TABLE IF NOT EXISTS requested_tiles (
+				zoom_level INTEGER NOT NULL,
+				tile_column INTEGER NOT NULL,
+				tile_row INTEGER NOT NULL,
+				PRIMARY KEY (zoom_level, tile_column, tile_row)) WITHOUT ROWID""")
+		try:
+			db.executemany("INSERT OR IGNORE INTO temp.requested_tiles (tile_column, tile_row, zoom_level) VALUES (?,?,?)", tiles)
+			#expired tiles are ignored (same rule as getTile : more than MAX_DAYS elapsed days)
+			query = """SELECT t.tile_column, t.tile_row, t.zoom_level, t.tile_data
+				FROM temp.requested_tiles AS r
+				JOIN gpkg_tiles AS t
+				ON t.zoom_level=r.zoom_level AND t.tile_column=r.tile_column AND t.tile_row=r.tile_row
+				WHERE t.last_modified > datetime('now', 'localtime', ?)"""
+			result = db.execute(query, (self._expiryModifier,)).fetchall()
+		finally:
+			#discard the requested tiles list and release the read transaction
+			db.rollback()
+
+		self.touch( [r[:3] for r in result] )
+
+		#tiles queued in the background writer are newer than the committed ones
+		pending = self.writer.getPending(tiles)
+		if pending:
+			queued = set( t[:3] for t in pending )
+			result = [r for r in result if r[:3] not in queued] + pending
 		return result
 
 
 	def putTiles(self, tiles):
 		"""tiles = list of (x,y,z,data) tuple"""
-		db = sqlite3.connect(self.dbPath)
+		db = self.getConnection()
 		query = """INSERT OR REPLACE INTO gpkg_tiles
-		(tile_column, tile_row, zoom_level, tile_data) VALUES (?,?,?,?)"""
-		db.executemany(query, tiles)
+		(tile_column, tile_row, zoom_level, tile_data, last_access) VALUES (?,?,?,?,?)"""
+		now = int(time.time())
+		db.executemany(query, [t + (now,) for t in tiles])
+		#piggyback the pending last access times on this write transaction
+		self._flushAccess(db)
 		db.commit()
-		db.close()
+
+		self._nbPut += len(tiles)
+		if self._nbPut >= self.MAINTENANCE_INTERVAL:
+			self._nbPut = 0
+			self.startMaintenance()
+
+
+	###########
+	#Cache lifecycle
+
+	@property
+	def _expiryModifier(self):
+		"""sqlite datetime modifier matching the oldest valid last_modified value"""
+		return '-' + str(self.MAX_DAYS + 1) + ' days'
+
+	def touch(self, tiles):
+		"""Record the access to some tiles [(x,y,z)], they will be written to the database later"""
+		now = int(time.time())
+		with self._lock:
+			for tile in tiles:
+				self._accessed[tile] = now
+
+	def _flushAccess(self, db):
+		with self._lock:
+			accessed, self._accessed = self._accessed, {}
+		#tiles accessed recently enough are not updated to avoid useless writes
+		query = """UPDATE """ + self.tilesTable + """ SET last_access=?
+			WHERE zoom_level=? AND tile_column=? AND tile_row=? AND last_access<?"""
+		db.executemany(query, [(t, z, x, y, t - self.ACCESS_RESOLUTION) for (x, y, z), t in accessed.items()])
+
+	def flushAccess(self):
+		"""Write pending last access times to the database"""
+		db = self.getConnection()
+		self._flushAccess(db)
+		db.commit()
+
+	def getSize(self):
+		"""Size in bytes of the database pages in use (free pages are excluded)"""
+		db = self.getConnection()
+		pageSize = db.execute("PRAGMA page_size").fetchone()[0]
+		pageCount = db.execute("PRAGMA page_count").fetchone()[0]
+		freeCount = db.execute("PRAGMA freelist_count").fetchone()[0]
+		return (pageCount - freeCount) * pageSize
+
+	def deleteExpired(self):
+		"""Delete expired tiles by batches, return the number of deleted tiles"""
+		db = self.getConnection()
+		query = """DELETE FROM {0} WHERE id IN (
+			SELECT id FROM {0} WHERE last_modified <= datetime('now', 'localtime', ?) LIMIT ?)""".format(self.tilesTable)
+		n = 0
+		while True:
+			nb = db.execute(query, (self._expiryModifier, self.EVICTION_BATCH)).rowcount
+			db.commit()
+			n += nb
+			if nb < self.EVICTION_BATCH:
+				self.deleteOrphanBlobs()
+				return n
+
+	def deleteExpiredMissing(self):
+		"""Forget the missing tiles whose time to live is over"""
+		db = self.getConnection()
+		n = db.execute("DELETE FROM bgis_missing_tiles WHERE expires <= ?", (int(time.time()),)).rowcount
+		db.commit()
+		return n
+
+	def evict(self, maxSize):
+		"""Delete least recently used tiles by batches until the database size fit maxSize bytes"""
+		db = self.getConnection()
+		query = """DELETE FROM {0} WHERE id IN (
+			SELECT id FROM {0} ORDER BY last_access LIMIT ?)""".format(self.tilesTable)
+		n = 0
+		while self.getSize() > maxSize:
+			nb = db.execute(query, (self.EVICTION_BATCH,)).rowcount
+			db.commit()
+			#blobs pages are released only once they are no more referenced
+			self.deleteOrphanBlobs()
+			if nb == 0:
+				break
+			n += nb
+		return n
+
+	def deleteOrphanBlobs(self):
+		"""Delete the blobs no more referenced by a tile (deduplicated layout), return their number"""
+		if not self.dedup:
+			return 0
+		db = self.getConnection()
+		n = db.execute("""DELETE FROM bgis_tile_blobs WHERE id IN (SELECT blob_id FROM bgis_orphan_blobs)
+			AND NOT EXISTS (SELECT 1 FROM bgis_tiles WHERE blob_id = bgis_tile_blobs.id)""").rowcount
+		db.execute("DELETE FROM bgis_orphan_blobs")
+		db.commit()
+		return n
+
+	def deduplicate(self):
+		"""
+		Convert a cache to the deduplicated layout, return the number of stored blobs
+		The tiles are copied in one transaction, so the file needs room for a second copy of the distinct tiles
+		"""
+		db = self.getConnection()
+		if self.dedup:
+			return db.execute("SELECT COUNT(*) FROM bgis_tile_blobs").fetchone()[0]
+		self.flush()
+		maintenance = self._maintenance
+		if maintenance is not None:
+			maintenance.join()
+		#schema statements don't begin a transaction implicitly
+		db.commit()
+		db.execute("BEGIN")
+		try:
+			db.execute("ALTER TABLE gpkg_tiles RENAME TO bgis_tiles_old")
+			for index in ('idx_tiles_last_access', 'idx_tiles_last_modified'):
+				db.execute("DROP INDEX IF EXISTS " + index)
+			self.dedup = True
+			self.createDedupTables()
+			db.execute("""INSERT OR IGNORE INTO bgis_tile_blobs (hash, tile_data)
+				SELECT bgis_tile_hash(tile_data), tile_data FROM bgis_tiles_old""")
+			db.execute("""INSERT INTO bgis_tiles (id, zoom_level, tile_column, tile_row, blob_id, last_modified, last_access)
+				SELECT o.id, o.zoom_level, o.tile_column, o.tile_row, b.id, o.last_modified, o.last_access
+				FROM bgis_tiles_old AS o JOIN bgis_tile_blobs AS b ON b.hash = bgis_tile_hash(o.tile_data)""")
+			db.execute("DROP TABLE bgis_tiles_old")
+			db.commit()
+		except:
+			db.rollback()
+			self.dedup = False
+			raise
+		self.createIndexes()
+		self.vacuum()
+		return db.execute("SELECT COUNT(*) FROM bgis_tile_blobs").fetchone()[0]
+
+	def getDedupStats(self):
+		"""
+		Return a dictionnary with the number of tiles and stored blobs, the dedup ratio (tiles per blob),
+		the size of the tiles data with and without deduplication and the size of the database
+		"""
+		db = self.getConnection()
+		nbTiles, dataSize = db.execute("SELECT COUNT(*), TOTAL(LENGTH(tile_data)) FROM gpkg_tiles").fetchone()
+		if self.dedup:
+			nbBlobs, storedSize = db.execute("SELECT COUNT(*), TOTAL(LENGTH(tile_data)) FROM bgis_tile_blobs").fetchone()
+		else:
+			nbBlobs, storedSize = nbTiles, dataSize
+		return {
+			'tiles': nbTiles,
+			'blobs': nbBlobs,
+			'ratio': nbTiles / nbBlobs if nbBlobs else 1,
+			'dataSize': int(dataSize),
+			'storedSize': int(storedSize),
+			'savedSize': int(dataSize - storedSize),
+			'fileSize': self.getSize()
+		}
+
+	def vacuum(self):
+		"""Release free pages to the file system"""
+		db = self.getConnection()
+		if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+			#cache created by a previous version, a full vacuum is needed once to enable incremental mode
+			db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+			db.execute("VACUUM")
+		else:
+			#executescript steps the pragma to completion, a single execute() frees only one page
+			db.executescript("PRAGMA incremental_vacuum;")
+		#file is truncated only when the write ahead log is checkpointed
+		db.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+	def maintain(self):
+		"""Flush last access times, delete expired tiles, then evict tiles exceeding MAX_SIZE"""
+		self.flushAccess()
+		self.deleteExpiredMissing()
+		n = self.deleteExpired()
+		if self.MAX_SIZE > 0:
+			n += self.evict(self.MAX_SIZE)
+		if n > 0:
+			self.vacuum()
+
+	def startMaintenance(self):
+		"""Run the maintenance in a background thread, if it's not already running"""
+		with self._lock:
+			if self._maintenance is not None and self._maintenance.is_alive():
+				return
+			self._maintenance = threading.Thread(target=self.maintain)
+			self._maintenance.setDaemon(True)
+			self._maintenance.start()
+
+
+	#Seeding journal, this table is not part of the GeoPackage spec but additional tables are allowed
+
+	def getMissing(self, tiles):
+		"""Return the set of tiles [(x,y,z)] known to be missing on the server"""
+		if len(tiles) == 0:
+			return set()
+		db = self.getConnection()
+		zooms = set(z for x, y, z in tiles)
+		xmin, xmax = min(x for x, y, z in tiles), max(x for x, y, z in tiles)
+		query = """SELECT tile_column, tile_row, zoom_level FROM bgis_missing_tiles
+		WHERE zoom_level=? AND tile_column BETWEEN ? AND ? AND expires > ?"""
+		now = int(time.time())
+		missing = set()
+		for z in zooms:
+			missing.update(db.execute(query, (z, xmin, xmax, now)).fetchall())
+		return missing.intersection(tiles)
+
+	def putMissing(self, tiles, status=None):
+		"""Store tiles [(x,y,z)] missing on the server in the negative cache for MISSING_TTL seconds"""
+		db = self.getConnection()
+		expires = int(time.time()) + self.MISSING_TTL
+		query = """INSERT OR REPLACE INTO bgis_missing_tiles
+		(tile_column, tile_row, zoom_level, status, expires) VALUES (?,?,?,?,?)"""
+		db.executemany(query, [(x, y, z, status, expires) for x, y, z in tiles])
+		db.commit()
+
+	def clearMissing(self):
+		db = self.getConnection()
+		db.execute("DELETE FROM bgis_missing_tiles")
+		db.commit()
+
+
+	def getSeedProgress(self, job):
+		"""Return the number of tiles already processed by a seeding job (0 if unknown)"""
+		db = self.getConnection()
+		db.execute("""CREATE TABLE IF NOT EXISTS bgis_seed_journal (
+				job TEXT NOT NULL PRIMARY KEY,
+				tiles_done INTEGER NOT NULL,
+				tiles_total INTEGER NOT NULL,
+				last_update TIMESTAMP DEFAULT (datetime('now','localtime')))""")
+		db.commit()
+		result = db.execute("SELECT tiles_done FROM bgis_seed_journal WHERE job=?", (job,)).fetchone()
+		if result is None:
+			return 0
+		return result[0]
+
+	def setSeedProgress(self, job, nbDone, nbTotal):
+		db = self.getConnection()
+		query = """INSERT OR REPLACE INTO bgis_seed_journal
+		(job, tiles_done, tiles_total, last_update) VALUES (?,?,?,datetime('now','localtime'))"""
+		db.execute(query, (job, nbDone, nbTotal))
+		db.commit()
+
+	def getSeedFailed(self, job):
+		"""Return the list of tiles [(x,y,z)] a seeding job has given up, they are not cached"""
+		db = self.getConnection()
+		db.execute("""CREATE TABLE IF NOT EXISTS bgis_seed_failed (
+				job TEXT NOT NULL,
+				tile_column INTEGER NOT NULL,
+				tile_row INTEGER NOT NULL,
+				zoom_level INTEGER NOT NULL,
+				PRIMARY KEY (job, zoom_level, tile_column, tile_row)) WITHOUT ROWID""")
+		db.commit()
+		query = "SELECT tile_column, tile_row, zoom_level FROM bgis_seed_failed WHERE job=? ORDER BY zoom_level, tile_column, tile_row"
+		return db.execute(query, (job,)).fetchall()
+
+	def putSeedFailed(self, job, tiles):
+		db = self.getConnection()
+		query = "INSERT OR IGNORE INTO bgis_seed_failed (job, tile_column, tile_row, zoom_level) VALUES (?,?,?,?)"
+		db.executemany(query, [(job,) + tuple(t) for t in tiles])
+		db.commit()
+
+	def deleteSeedFailed(self, job, tiles=None):
+		"""Forget the given failed tiles [(x,y,z)] of a seeding job, or all of them"""
+		db = self.getConnection()
+		if tiles is None:
+			db.execute("DELETE FROM bgis_seed_failed WHERE job=?", (job,))
+		else:
+			query = "DELETE FROM bgis_seed_failed WHERE job=? AND tile_column=? AND tile_row=? AND zoom_level=?"
+			db.executemany(query, [(job,) + tuple(t) for t in tiles])
+		db.commit()
+
+
+
+class CacheWriter():
+	"""
+	Background writer of a GeoPackage cache
+	Tiles are queued by the downloading threads and written by a single thread that commits
+	every BATCH_SIZE tiles or FLUSH_INTERVAL seconds, so downloads never wait for sqlite locks.
+	The queue is bounded : producers are blocked when the writer is late, so memory stays flat
+	whatever the number of requested tiles, and at most one batch is lost if the process crashes.
+	Queued tiles not yet committed are returned by getPending() so they can be read meanwhile.
+	The thread is started on demand and stops after IDLE_TIMEOUT seconds without tile to write.
+	"""
+
+	QUEUE_SIZE = 1024 #max number of queued tiles
+	BATCH_SIZE = 256 #max number of tiles per transaction
+	FLUSH_INTERVAL = 0.5 #seconds, max delay before queued tiles are committed
+	IDLE_TIMEOUT = 30 #seconds
+
+	def __init__(self, cache, metrics=None):
+		self.cache = cache
+		self.metrics = metrics
+		self._queue = queue.Queue(self.QUEUE_SIZE)
+		self._pending = {} #{(x,y,z) : data} queued tiles not yet committed
+		self._nbQueued = 0 #number of items put or being put in the queue and not yet processed
+		self._lock = threading.Lock()
+		self._thread = None
+
+	def _reserve(self):
+		"""Count an item about to be queued, so the thread doesn't stop before getting it, and start the thread if needed"""
+		with self._lock:
+			self._nbQueued += 1
+			if self._thread is None:
+				self._thread = threading.Thread(target=self.run)
+				self._thread.setDaemon(True)
+				self._thread.start()
+
+	def put(self, tile):
+		"""Queue a tile (x,y,z,data) to write, block if the queue is full"""
+		with self._lock:
+			self._pending[tile[:3]] = tile[3]
+		self._reserve()
+		#the lock is released, the writer may need it to free some space in the queue
+		self._queue.put(tile)
+
+	def getPending(self, tiles):
+		"""Return the tiles [(x,y,z,data)] among the requested ones [(x,y,z)] which are not yet committed"""
+		with self._lock:
+			if not self._pending:
+				return []
+			return [ t + (self._pending[t],) for t in tiles if t in self._pending ]
+
+	def flush(self):
+		"""Wait until all queued tiles are committed"""
+		self._queue.join()
+
+	def close(self):
+		"""Commit the queued tiles and stop the thread"""
+		with self._lock:
+			thread = self._thread
+		if thread is not None:
+			self._reserve()
+			self._queue.put(None)
+			thread.join()
+
+	def run(self):
+		batch = []
+		t0 = time.time()
+		while True:
+			timeout = self.FLUSH_INTERVAL - (time.time() - t0) if batch else self.IDLE_TIMEOUT
+			try:
+				tile = self._queue.get(timeout=max(timeout, 0))
+			except queue.Empty:
+				tile = False
+			if tile and not batch:
+				t0 = time.time()
+			if tile:
+				batch.append(tile)
+			if batch and (not tile or len(batch) >= self.BATCH_SIZE or time.time() - t0 >= self.FLUSH_INTERVAL):
+				self.write(batch)
+				batch = []
+			if tile is None: #stop request
+				with self._lock:
+					self._nbQueued -= 1
+					self._thread = None
+				self._queue.task_done()
+				return
+			if tile is False: #idle
+				with self._lock:
+					if self._nbQueued == 0:
+						self._thread = None
+						return
+
+	def write(self, batch):
+		try:
+			if self.metrics is not None:
+				with self.metrics.timer('cache_write', {'tiles': len(batch)}):
+					self.cache.putTiles(batch)
+			else:
+				self.cache.putTiles(batch)
+		except Exception as e:
+			print('WARN : cannot write tiles in cache - ' + str(e))
+			try:
+				self.cache.getConnection().rollback()
+			except Exception:
+				pass
+		with self._lock:
+			self._nbQueued -= len(batch)
+			for x, y, z, data in batch:
+				#keep the tile if it has been queued again meanwhile
+				if self._pending.get((x, y, z)) is data:
+					del self._pending[(x, y, z)]
+		for tile in batch:
+			self._queue.task_done()
 
 
 
 
 ###############################"
 
+class TilesMemCache():
+	"""
+	Thread safe in memory LRU cache of decoded tiles (RGBA numpy arrays)
+	Keys are (srckey, laykey, grdkey, zoom, col, row) tuples
+	Cache size is bounded by the number of bytes of the decoded images, least recently used
+	tiles are evicted first when the limit is reached. A max size of zero disables the cache.
+	"""
+
+	def __init__(self, maxSize=256*1024**2):
+		self.maxSize = maxSize #bytes
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self._tiles = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._tiles)
+
+	@staticmethod
+	def getImgSize(img):
+		"""Memory footprint of a decoded tile"""
+		return img.nbytes
+
+	def get(self, key):
+		"""Return the decoded tile or None if it is not in cache"""
+		with self._lock:
+			img = self._tiles.get(key)
+			if img is None:
+				self.misses += 1
+				return None
+			self._tiles.move_to_end(key)
+			self.hits += 1
+			return img
+
+	def put(self, key, img):
+		"""Add a decoded tile to the cache, then evict old tiles if needed"""
+		imgSize = self.getImgSize(img)
+		if imgSize > self.maxSize:
+			return
+		with self._lock:
+			old = self._tiles.pop(key, None)
+			if old is not None:
+				self.size -= self.getImgSize(old)
+			self._tiles[key] = img
+			self.size += imgSize
+			self._evict()
+
+	def _evict(self):
+		while self.size > self.maxSize:
+			key, img = self._tiles.popitem(last=False)
+			self.size -= self.getImgSize(img)
+
+	def resize(self, maxSize):
+		"""Change the max size (in bytes) and evict tiles exceeding the new limit"""
+		with self._lock:
+			self.maxSize = maxSize
+			self._evict()
+
+	def clear(self):
+		with self._lock:
+			self._tiles.clear()
+			self.size = 0
+			self.hits, self.misses = 0, 0
+
+	@property
+	def hitRatio(self):
+		n = self.hits + self.misses
+		if n == 0:
+			return 0
+		return self.hits / n
+
+
+
+class InflightCall():
+	"""A call registered in a SingleFlight registry, its result is shared with the waiting callers"""
+
+	def __init__(self):
+		self.event = threading.Event()
+		self.result = None
+		self.cancelled = False
+
+
+class SingleFlight():
+	"""
+	Thread safe registry of in-flight calls (single-flight deduplication)
+	Concurrent calls with the same key share one execution : the first caller (the leader) performs the call,
+	the others wait for its result. If the leader fails or is cancelled, a waiting caller takes over.
+	"""
+
+	#interval (seconds) at which waiting callers check if they have been cancelled
+	POLL_INTERVAL = 0.05
+
+	def __init__(self):
+		self._calls = {}
+		self._lock = threading.Lock()
+		self.nbShared = 0 #number of calls served by another caller
+
+	def __len__(self):
+		return len(self._calls)
+
+	def begin(self, key):
+		"""Return (call, isLeader), the leader must perform the call then end() it"""
+		with self._lock:
+			call = self._calls.get(key)
+			if call is not None:
+				self.nbShared += 1
+				return call, False
+			call = self._calls[key] = InflightCall()
+			return call, True
+
+	def end(self, key, call, result=None, cancelled=False):
+		"""Publish the result of the leader and wake up the waiting callers"""
+		with self._lock:
+			if self._calls.get(key) is call:
+				del self._calls[key]
+		call.result = result
+		call.cancelled = cancelled
+		call.event.set()
+
+	def wait(self, call, isAlive=None):
+		"""Wait for the call to end, return False if the waiting caller has been cancelled (isAlive() is False)"""
+		while not call.event.wait(self.POLL_INTERVAL):
+			if isAlive is not None and not isAlive():
+				return False
+		return True
+
+	def do(self, key, func, *args, isAlive=None):
+		"""Return func(*args), sharing its execution with the concurrent calls of the same key"""
+		while True:
+			call, leader = self.begin(key)
+			if leader:
+				try:
+					result = func(*args)
+				except:
+					self.end(key, call, cancelled=True)
+					raise
+				self.end(key, call, result)
+				return result
+			if not self.wait(call, isAlive):
+				return None
+			if not call.cancelled:
+				return call.result
+
+
+
+###############################"
+
+def clearServicesDefs(srckey=None, grdkey=None):
+	"""
+	Invalidate the shared objects built from servicesDefs, to call after editing a source
+	or a grid definition. Without keys, everything is rebuilt on next request
+	Decoded tiles in memory may not match the new definition, so they are dropped too
+	"""
+	TileMatrix.clear(grdkey)
+	MapService.clear(srckey, grdkey)
+	MapService.MEM_CACHE.clear()
+
+
 class TileMatrix():
 	"""
 	Will inherit attributes from grid source definition
@@ -326,10 +1116,39 @@ class TileMatrix():
 	# - submit a list of "resolutions" (This parameters override the others)
 	# - submit "resFactor" and "initRes"
 	# - submit just "resFactor" (initRes will be computed)
+
+	Tile matrices are immutable, the ones built from servicesDefs are shared (see get())
 	"""
 
 	defaultNbLevels = 24
 
+	#shared tile matrices by grid key
+	_registry = {}
+	_lock = threading.Lock()
+
+	@classmethod
+	def get(cls, grdkey):
+		"""Return the shared tile matrix of a grid defined in servicesDefs, built on first request"""
+		with cls._lock:
+			tm = cls._registry.get(grdkey)
+			if tm is None:
+				tm = cls._registry[grdkey] = cls(GRIDS[grdkey])
+		return tm
+
+	@classmethod
+	def clear(cls, grdkey=None):
+		"""Forget the shared tile matrix of a grid (or all of them), to call after editing its definition"""
+		with cls._lock:
+			if grdkey is None:
+				cls._registry.clear()
+			else:
+				cls._registry.pop(grdkey, None)
+
+	def __setattr__(self, name, value):
+		if getattr(self, '_frozen', False):
+			raise AttributeError('TileMatrix is immutable')
+		object.__setattr__(self, name, value)
+
 	def __init__(self, gridDef):
 
 		#create class attributes from grid dictionnary
@@ -365,7 +1184,8 @@ class TileMatrix():
 				self.nbLevels = self.defaultNbLevels
 
 		else:
-			self.resolutions.sort(reverse=True)
+			#sorted copy, the list of the grid definition is shared
+			self.resolutions = tuple(sorted(self.resolutions, reverse=True))
 			self.nbLevels = len(self.resolutions)
 
 
@@ -383,6 +1203,16 @@ class TileMatrix():
 		else: #(if units cannot be determined we assume its meters)
 			self.units = 'meters'
 
+		#Resolutions table, computed once (descending order)
+		if hasattr(self, 'resolutions'):
+			self._resList = self.resolutions
+		else:
+			self._resList = tuple(self.initRes / self.resFactor**zoom for zoom in range(self.nbLevels))
+		#ascending opposite resolutions, for bisect searches
+		self._negResList = tuple(-res for res in self._resList)
+
+		self._frozen = True
+
 
 	@property
 	def globalbbox(self):
@@ -405,17 +1235,15 @@ class TileMatrix():
 
 
 	def getResList(self):
-		if hasattr(self, 'resolutions'):
-			return self.resolutions
-		else:
-			return [self.initRes / self.resFactor**zoom for zoom in range(self.nbLevels)]
+		"""Resolutions of all zoom levels, as a tuple"""
+		return self._resList
 
 	def getRes(self, zoom):
 		"""Resolution (meters/pixel) for given zoom level (measured at Equator)"""
+		if 0 <= zoom < self.nbLevels:
+			return self._resList[zoom]
 		if hasattr(self, 'resolutions'):
-			if zoom > len(self.resolutions):
-				zoom = len(self.resolutions)
-			return self.resolutions[zoom]
+			return self._resList[-1] if zoom > 0 else self._resList[0]
 		else:
 			return self.initRes / self.resFactor**zoom
 
@@ -425,32 +1253,26 @@ class TileMatrix():
 		Return the zoom level closest to the submited resolution
 		rule in ['closer', 'lower', 'higher']
 		lower return the previous zoom level, higher return the next
+		Resolutions out of the table range return the first or last zoom level
 		"""
-		resLst = self.getResList() #ordered
-
-		for z1, v1 in enumerate(resLst):
-			if v1 == res:
-				return z1
-			if z1 == len(resLst) - 1:
+		z2 = bisect.bisect_left(self._negResList, -res) #first level whose resolution is <= res
+		if z2 == self.nbLevels:
+			return z2 - 1
+		if z2 == 0 or self._resList[z2] == res:
+			return z2
+		z1 = z2 - 1
+		if rule == 'lower':
+			return z1
+		elif rule == 'higher':
+			return z2
+		else: #closer
+			d1 = self._resList[z1] - res
+			d2 = res - self._resList[z2]
+			if d1 < d2:
 				return z1
-			z2 = z1+1
-			v2 = resLst[z2]
-			if v2 == res:
+			else:
 				return z2
 
-			if v1 > res > v2:
-				if rule == 'lower':
-					return z1
-				elif rule == 'higher':
-					return z2
-				else: #closer
-					d1 = v1 - res
-					d2 = res - v2
-					if d1 < d2:
-						return z1
-					else:
-						return z2
-
 	def getPrevResFac(self, z):
 		"""return res factor to previous zoom level"""
 		return self.getFromToResFac(z, z-1)
@@ -511,6 +1333,67 @@ class TileMatrix():
 		ymin = ymax - (self.tileSize * self.getRes(zoom))
 		return xmin, ymin, xmax, ymax
 
+	def getMatrixSize(self, zoom):
+		"""Number of tiles (columns, rows) of the matrix at given zoom level"""
+		geoTileSize = self.tileSize * self.getRes(zoom)
+		w = math.ceil( (self.xmax - self.xmin) / geoTileSize )
+		h = math.ceil( (self.ymax - self.ymin) / geoTileSize )
+		return w, h
+
+	def getTileRange(self, bbox, zoom):
+		"""
+		Return (colMin, rowMin, colMax, rowMax) numbers (inclusive) of the tiles covering
+		the bbox, clipped to the tile matrix extent
+		"""
+		xmin, ymin, xmax, ymax = bbox
+		col1, row1 = self.getTileNumber(xmin, ymax, zoom)
+		col2, row2 = self.getTileNumber(xmax, ymin, zoom)
+		w, h = self.getMatrixSize(zoom)
+		colMin, colMax = max(0, min(col1, col2)), min(w-1, max(col1, col2))
+		rowMin, rowMax = max(0, min(row1, row2)), min(h-1, max(row1, row2))
+		return colMin, rowMin, colMax, rowMax
+
+
+	#Vectorized versions, numpy arrays in, numpy arrays out
+
+	def getTileNumberArray(self, xs, ys, zoom):
+		"""Convert arrays of projeted coords to arrays of tiles numbers (cols, rows)"""
+		geoTileSize = self.tileSize * self.getRes(zoom)
+		dx = np.asarray(xs, dtype=np.float64) - self.originx
+		if self.originLoc == "NW":
+			dy = self.originy - np.asarray(ys, dtype=np.float64)
+		else:
+			dy = np.asarray(ys, dtype=np.float64) - self.originy
+		cols = np.floor(dx / geoTileSize).astype(np.int64)
+		rows = np.floor(dy / geoTileSize).astype(np.int64)
+		return cols, rows
+
+	def getTileCoordsArray(self, cols, rows, zoom):
+		"""Convert arrays of tiles numbers to arrays of projeted coords of their top left corner"""
+		geoTileSize = self.tileSize * self.getRes(zoom)
+		xs = self.originx + np.asarray(cols) * geoTileSize
+		if self.originLoc == "NW":
+			ys = self.originy - np.asarray(rows) * geoTileSize
+		else:
+			ys = self.originy + (np.asarray(rows) + 1) * geoTileSize
+		return xs, ys
+
+	def getTileBboxArray(self, cols, rows, zoom):
+		"""Return (xmin, ymin, xmax, ymax) arrays of the tiles bboxes"""
+		geoTileSize = self.tileSize * self.getRes(zoom)
+		xmin, ymax = self.getTileCoordsArray(cols, rows, zoom)
+		return xmin, ymax - geoTileSize, xmin + geoTileSize, ymax
+
+	def getTilesArray(self, bbox, zoom):
+		"""
+		Return (cols, rows) arrays of the tiles covering the bbox, clipped to the tile matrix extent
+		Tiles are ordered by column then by row
+		"""
+		colMin, rowMin, colMax, rowMax = self.getTileRange(bbox, zoom)
+		cols = np.arange(colMin, colMax + 1)
+		rows = np.arange(rowMin, rowMax + 1)
+		return np.repeat(cols, len(rows)), np.tile(rows, len(cols))
+
 
 
 
@@ -633,6 +1516,70 @@ class MapService():
 	# resampling algo for reprojection
 	RESAMP_ALG = 'BL' #NN:Nearest Neighboor, BL:Bilinear, CB:Cubic, CBS:Cubic Spline, LCZ:Lanczos
 
+	# in memory cache of decoded tiles, shared by all map services
+	MEM_CACHE = TilesMemCache()
+
+	# persistent http connections, shared by all map services and downloading threads
+	HTTP_POOL = HTTPConnectionPool(maxSize=10, idleTimeout=30, timeout=3)
+
+	# tiles downloading engine : 'THREAD' (one thread per queue worker) or 'ASYNC' (asyncio event loop)
+	FETCH_ENGINE = 'THREAD'
+
+	# in-flight downloads, shared by all map services so that a tile requested by several
+	# requests at the same time (viewer, prefetcher...) is downloaded only once
+	INFLIGHT = SingleFlight()
+
+	# retry policy for transient download errors (connection errors, timeouts, 408, 429 and 5xx status)
+	MAX_RETRIES = 2
+	RETRY_BACKOFF = 0.25 #seconds, base delay doubled at each retry, with full jitter
+
+	# http status meaning that the tile does not exist, such tiles are stored in the negative cache
+	MISSING_STATUS = (204, 404, 410)
+
+	# circuit breakers by source, a source is not requested during BREAKER_COOLDOWN seconds
+	# after BREAKER_THRESHOLD consecutive failures
+	BREAKER_THRESHOLD = 5
+	BREAKER_COOLDOWN = 30
+	BREAKERS = {}
+	_breakersLock = threading.Lock()
+
+	# max number of destination tiles per side warped at once when reprojecting tiles by blocks
+	WARP_BLOCK_SIZE = 8
+
+	#shared map services by (source key, cache folder, destination grid key)
+	_registry = {}
+	_lock = threading.Lock()
+
+	@classmethod
+	def get(cls, srckey, cacheFolder, dstGridKey=None):
+		"""
+		Return the map service shared by all the callers of this source, cache folder and destination grid
+		The request generation is shared too, so a new request (newRequest()) outdates the pending ones
+		Destination grid of a shared map service must not be changed, request another one instead
+		"""
+		if dstGridKey == SOURCES[srckey]['grid']:
+			dstGridKey = None
+		key = (srckey, cacheFolder, dstGridKey)
+		with cls._lock:
+			srv = cls._registry.get(key)
+			if srv is None:
+				srv = cls._registry[key] = cls(srckey, cacheFolder, dstGridKey)
+		return srv
+
+	@classmethod
+	def clear(cls, srckey=None, grdkey=None):
+		"""
+		Forget the shared map services of a source and/or using a grid (all of them if no key is given),
+		to call after editing their definitions. Forgotten services remain usable by their current owners
+		"""
+		with cls._lock:
+			for key, srv in list(cls._registry.items()):
+				if srckey is not None and srv.srckey != srckey:
+					continue
+				if grdkey is not None and grdkey not in (srv.srcGridKey, srv.dstGridKey):
+					continue
+				del cls._registry[key]
+
 	def __init__(self, srckey, cacheFolder, dstGridKey=None):
 
 
@@ -642,6 +1589,12 @@ class MapService():
 		for k, v in source.items():
 			setattr(self, k, v)
 
+		#WMS tiles requested by blocks (optional), {"size": [cols, rows], "buffer": pixels}
+		if self.service == 'WMS':
+			self.metatile = source.get('metatile')
+		else:
+			self.metatile = None
+
 		#Build objects from layers definitions
 		class Layer(): pass
 		layersObj = {}
@@ -654,14 +1607,15 @@ class MapService():
 
 		#Build source tile matrix set
 		self.srcGridKey = self.grid
-		self.srcTms = TileMatrix(GRIDS[self.srcGridKey])
+		self.srcTms = TileMatrix.get(self.srcGridKey)
 
 		#Build destination tile matrix set
 		self.setDstGrid(dstGridKey)
 
-		#Init cache dict
+		#Init cache dict, shared with the forks of this map service and filled by the downloading threads
 		self.cacheFolder = cacheFolder
 		self.caches = {}
+		self._cachesLock = threading.Lock()
 
 		#Fake browser header
 		self.headers = {
@@ -676,16 +1630,99 @@ class MapService():
 
 		#Downloading progress
 		self.running = False
+		self._progressLock = threading.Lock()
+		self._progressT0 = None
+		self._progressSkip = 0
+		#Request generation, requests of a previous generation are outdated and stop by themselves
+		self.generation = 0
+		self._genLock = threading.Lock()
 		self.nbTiles = 0
 		self.cptTiles = 0
 		self.report = None
 
+		#Cache hits, downloads, timings... of the tiles pipeline (see utils.metrics)
+		self.metrics = Metrics()
+
+		#Last mosaic built in incremental mode (key, numpy RGBA array, cols, rows, placeholder tiles)
+		self.prevMosaic = None
+
+
+	def newRequest(self):
+		"""
+		Start a new request generation and return it
+		Requests of the previous generations are dropped as soon as they check isAlive(),
+		so there is no need to wait for their threads
+		"""
+		with self._genLock:
+			self.generation += 1
+			self.running = True
+			return self.generation
+
+	def cancel(self, generation=None):
+		"""Stop the requests, or only those of the given generation if it's still the current one"""
+		with self._genLock:
+			if generation is None or generation == self.generation:
+				self.running = False
+
+	def isAlive(self, generation):
+		"""Return True if a request of this generation must go on"""
+		return self.running and generation == self.generation
+
+	def fork(self):
+		"""
+		Return a map service sharing the caches (databases connections and background writers) and the
+		metrics of this one, but with its own request generation and progress, so that its requests
+		(prefetching...) neither outdate nor are outdated by the requests of this map service
+		"""
+		#shallow copy, the caches dict and its lock are shared
+		srv = copy.copy(self)
+		srv._genLock = threading.Lock()
+		srv._progressLock = threading.Lock()
+		srv.running = False
+		srv.generation = 0
+		srv.resetProgress()
+		srv.report = None
+		srv.prevMosaic = None
+		return srv
+
+
+	#Progress counters (nbTiles, cptTiles), updated by the downloading threads
+
+	def startProgress(self, nbTiles):
+		with self._progressLock:
+			self.nbTiles, self.cptTiles = nbTiles, 0
+			self._progressT0, self._progressSkip = time.time(), 0
+
+	def skipProgress(self, n):
+		"""Count tiles obtained without delay (cache hits), they are excluded from the rate"""
+		with self._progressLock:
+			self.cptTiles += n
+			self._progressSkip += n
+
+	def addProgress(self, n=1):
+		with self._progressLock:
+			self.cptTiles += n
+
+	def resetProgress(self):
+		with self._progressLock:
+			self.nbTiles, self.cptTiles = 0, 0
+			self._progressT0 = None
+
+	def getProgress(self):
+		"""Return (done, total, tiles per second, estimated remaining seconds or None)"""
+		with self._progressLock:
+			cpt, nb, t0, skip = self.cptTiles, self.nbTiles, self._progressT0, self._progressSkip
+		if t0 is None or cpt - skip <= 0:
+			return cpt, nb, 0, None
+		rate = (cpt - skip) / max(time.time() - t0, 1e-6)
+		return cpt, nb, rate, (nb - cpt) / rate
+
 
 	def setDstGrid(self, grdkey):
 		'''Set destination tile matrix'''
 		if grdkey is not None and grdkey != self.srcGridKey:
 			self.dstGridKey = grdkey
-			self.dstTms = TileMatrix(GRIDS[grdkey])
+			self.dstTms = TileMatrix.get(grdkey)
 		else:
 			self.dstGridKey = None
 			self.dstTms = None
@@ -704,13 +1741,30 @@ class MapService():
 			tm = self.srcTms
 
 		mapKey = self.srckey + '_' + laykey + '_' + grdkey
-		cache = self.caches.get(mapKey)
-		if cache is None:
-			dbPath = self.cacheFolder + mapKey + ".gpkg"
-			self.caches[mapKey] = GeoPackage(dbPath, tm)
-			return self.caches[mapKey]
-		else:
-			return cache
+		#one GeoPackage object (and background writer) per file, even if several threads ask for it at once
+		with self._cachesLock:
+			cache = self.caches.get(mapKey)
+			if cache is None:
+				dbPath = self.cacheFolder + mapKey + ".gpkg"
+				cache = self.caches[mapKey] = GeoPackage(dbPath, tm)
+				cache.writer.metrics = self.metrics
+				#expiry and eviction run off the calling thread
+				cache.startMaintenance()
+		return cache
+
+	def flush(self):
+		'''Wait for the tiles queued in the caches background writers to be committed'''
+		with self._cachesLock:
+			caches = list(self.caches.values())
+		for cache in caches:
+			cache.flush()
+
+	def close(self):
+		'''Commit queued tiles and close the databases connections of all opened caches'''
+		with self._cachesLock:
+			caches = list(self.caches.values())
+		for cache in caches:
+			cache.close()
 
 
 	def buildUrl(self, laykey, col, row, zoom):
@@ -746,26 +1800,35 @@ class MapService():
 			url = url.replace("{Z}", str(zoom))
 
 		if self.service == 'WMS':
-			url = self.urlTemplate['BASE_URL']
-			if url[-1] != '?' :
-				url += '?'
-			params = ['='.join([k,v]) for k, v in self.urlTemplate.items() if k != 'BASE_URL']
-			url += '&'.join(params)
-			url = url.replace("{LAY}", lay.urlKey)
-			url = url.replace("{FORMAT}", lay.format)
-			url = url.replace("{STYLE}", lay.style)
-			url = url.replace("{CRS}", str(tm.CRS))
-			url = url.replace("{WIDTH}", str(tm.tileSize))
-			url = url.replace("{HEIGHT}", str(tm.tileSize))
-
-			xmin, ymax = tm.getTileCoords(col, row, zoom)
-			xmax = xmin + tm.tileSize * tm.getRes(zoom)
-			ymin = ymax - tm.tileSize * tm.getRes(zoom)
-			if self.urlTemplate['VERSION'] == '1.3.0' and tm.CRS == 'EPSG:4326':
-				bbox = ','.join(map(str,[ymin,xmin,ymax,xmax]))
-			else:
-				bbox = ','.join(map(str,[xmin,ymin,xmax,ymax]))
-			url = url.replace("{BBOX}", bbox)
+			url = self.buildWmsUrl(laykey, tm.getTileBbox(col, row, zoom), tm.tileSize, tm.tileSize)
+
+		return url
+
+	def buildWmsUrl(self, laykey, bbox, width, height):
+		"""
+		Build a WMS GetMap request url of an image of width x height pixels covering bbox,
+		in source tile matrix crs
+		"""
+		lay = self.layers[laykey]
+		tm = self.srcTms
+		url = self.urlTemplate['BASE_URL']
+		if url[-1] != '?' :
+			url += '?'
+		params = ['='.join([k,v]) for k, v in self.urlTemplate.items() if k != 'BASE_URL']
+		url += '&'.join(params)
+		url = url.replace("{LAY}", lay.urlKey)
+		url = url.replace("{FORMAT}", lay.format)
+		url = url.replace("{STYLE}", lay.style)
+		url = url.replace("{CRS}", str(tm.CRS))
+		url = url.replace("{WIDTH}", str(width))
+		url = url.replace("{HEIGHT}", str(height))
+
+		xmin, ymin, xmax, ymax = bbox
+		if self.urlTemplate['VERSION'] == '1.3.0' and tm.CRS == 'EPSG:4326':
+			bbox = ','.join(map(str,[ymin,xmin,ymax,xmax]))
+		else:
+			bbox = ','.join(map(str,[xmin,ymin,xmax,ymax]))
+		url = url.replace("{BBOX}", bbox)
 
 		return url
 
@@ -784,10 +1847,55 @@ class MapService():
 		return quadKey
 
 
+	def getBreaker(self):
+		"""Return the circuit breaker of this source, shared by all map services"""
+		with self._breakersLock:
+			breaker = self.BREAKERS.get(self.srckey)
+			if breaker is None:
+				breaker = self.BREAKERS[self.srckey] = CircuitBreaker(self.BREAKER_THRESHOLD, self.BREAKER_COOLDOWN)
+			return breaker
+
+	def getRetryDelay(self, attempt):
+		"""Delay before retry number attempt (from 0) : exponential backoff with full jitter"""
+		return random.uniform(0, self.RETRY_BACKOFF * 2 ** attempt)
+
+	def checkTile(self, laykey, col, row, zoom, status, data, missing=None):
+		"""
+		Classify the result of a tile download (status is None if the request has failed)
+		Return 'OK', 'MISSING' (stored in the negative cache), 'RETRY' for transient errors or 'FAILED'
+		Only the MISSING_STATUS codes mean the tile is missing, they are cached for MISSING_TTL
+		The circuit breaker of the source is updated accordingly
+		missing is the list of tiles [(x,y,z)] to store in the negative cache, default to the requested tile
+		"""
+		breaker = self.getBreaker()
+		if data is not None:
+			self.metrics.incr('bytes_downloaded', len(data))
+		if status == 200 and data is not None and imghdr.what(None, data) is not None:
+			breaker.success()
+			self.metrics.incr('downloads')
+			return 'OK'
+		if status in self.MISSING_STATUS:
+			#the server works but has no tile here
+			breaker.success()
+			self.metrics.incr('missing_tiles')
+			if missing is None:
+				missing = [(col, row, zoom)]
+			self.getCache(laykey, False).putMissing(missing, status)
+			return 'MISSING'
+		breaker.failure()
+		self.metrics.incr('download_errors')
+		#a 200 response which is not an image is a server fault (WMS exception, proxy page, truncated body)
+		if status is None or status == 200 or status in (408, 429) or status >= 500:
+			return 'RETRY'
+		return 'FAILED'
+
+
 	def downloadTile(self, laykey, col, row, zoom):
 		"""
 		Download bytes data of requested tile in source tile matrix space
 		Return None if unable to download a valid stream
+		Transient errors are retried (see MAX_RETRIES), tiles missing on the server are stored in
+		the negative cache and nothing is requested while the circuit breaker of the source is open
 
 		Notes:
 		bytes object can be converted to bytesio (stream buffer) and opened with PIL
@@ -799,25 +1907,132 @@ class MapService():
 		url = self.buildUrl(laykey, col, row, zoom)
 		#print(url)
 
-		try:
-			#make request
-			req = urllib.request.Request(url, None, self.headers)
-			handle = urllib.request.urlopen(req, timeout=3)
-			#open image stream
-			data = handle.read()
-			handle.close()
-		except:
+		data, failed = self.request(url, laykey, col, row, zoom)
+		if failed:
 			print("Can't download tile x"+str(col)+" y"+str(row))
 			print(url)
-			data = None
+		return data
 
-		#Make sure the stream is correct
-		if data is not None:
-			format = imghdr.what(None, data)
-			if format is None:
-				data = None
+	def request(self, url, laykey, col, row, zoom, missing=None):
+		"""
+		Request the url of a tile (or of a metatile whose tiles are listed by missing, see checkTile)
+		Return (data, failed), data is None if the tile is missing on the server or if the request has failed
+		"""
+		breaker = self.getBreaker()
+		self.metrics.gauge('inflight', 1)
+		try:
+			for attempt in range(self.MAX_RETRIES + 1):
+				if attempt > 0:
+					if not self.running:
+						break
+					self.metrics.incr('download_retries')
+					time.sleep(self.getRetryDelay(attempt - 1))
+				if not breaker.allow():
+					break
+				try:
+					#make request through a kept alive connection
+					with self.metrics.timer('download'):
+						status, data = self.HTTP_POOL.request(url, self.headers)
+				except Exception:
+					status, data = None, None
+				result = self.checkTile(laykey, col, row, zoom, status, data, missing)
+				if result == 'OK':
+					return data, False
+				elif result == 'MISSING':
+					return None, False
+				elif result == 'FAILED':
+					break
+		finally:
+			self.metrics.gauge('inflight', -1)
+		return None, True
 
-		return data
+
+	def getMetatileKey(self, col, row):
+		"""Return the numbers (mcol, mrow) of the metatile containing a tile"""
+		n, m = self.metatile['size']
+		return col // n, row // m
+
+	def getMetatileRange(self, mcol, mrow, zoom):
+		"""Return the range of tiles (col0, row0, col1, row1) of a metatile (inclusive), clipped to the matrix"""
+		n, m = self.metatile['size']
+		w, h = self.srcTms.getMatrixSize(zoom)
+		return mcol * n, mrow * m, min((mcol + 1) * n, w) - 1, min((mrow + 1) * m, h) - 1
+
+	def downloadMetatile(self, laykey, mcol, mrow, zoom):
+		"""
+		Download a block of tiles with a single WMS request and split it into tiles
+		The requested image is extended by a buffer (in pixels, clipped to the matrix extent) so that
+		labels and symbols crossing the metatile edges are not truncated
+		Return a dictionnary {(col, row) : data}, empty if the metatile can't be downloaded
+		"""
+		tm = self.srcTms
+		res = tm.getRes(zoom)
+		tileSize = tm.tileSize
+		buffer = self.metatile.get('buffer', 0)
+		col0, row0, col1, row1 = self.getMetatileRange(mcol, mrow, zoom)
+		tiles = [(col, row) for col in range(col0, col1 + 1) for row in range(row0, row1 + 1)]
+
+		#union of the corners tiles bboxes, rows numbering depends on the matrix origin
+		xmin, ymin, xmax, ymax = tm.getTileBbox(col0, row0, zoom)
+		_xmin, _ymin, _xmax, _ymax = tm.getTileBbox(col1, row1, zoom)
+		xmin, ymin, xmax, ymax = min(xmin, _xmin), min(ymin, _ymin), max(xmax, _xmax), max(ymax, _ymax)
+		left = max(0, min(buffer, int(round((xmin - tm.xmin) / res))))
+		right = max(0, min(buffer, int(round((tm.xmax - xmax) / res))))
+		bottom = max(0, min(buffer, int(round((ymin - tm.ymin) / res))))
+		top = max(0, min(buffer, int(round((tm.ymax - ymax) / res))))
+		width = (col1 - col0 + 1) * tileSize + left + right
+		height = (row1 - row0 + 1) * tileSize + top + bottom
+		bbox = (xmin - left * res, ymin - bottom * res, xmax + right * res, ymax + top * res)
+
+		url = self.buildWmsUrl(laykey, bbox, width, height)
+		data, failed = self.request(url, laykey, col0, row0, zoom, missing=[(col, row, zoom) for col, row in tiles])
+		if data is None:
+			if failed:
+				print("Can't download metatile x"+str(col0)+"-"+str(col1)+" y"+str(row0)+"-"+str(row1))
+				print(url)
+			return {}
+
+		#split the image into tiles
+		with self.metrics.timer('split', {'tiles': len(tiles)}):
+			try:
+				img = Image.open(io.BytesIO(data))
+				format = 'JPEG' if img.format == 'JPEG' else 'PNG'
+				if img.mode not in ('L', 'RGB', 'RGBA'):
+					img = img.convert('RGBA')
+				a = np.asarray(img)
+			except Exception as e:
+				print('WARN : cannot decode metatile - ' + str(e))
+				return {}
+			if a.shape[:2] != (height, width):
+				print('WARN : unexpected metatile size ' + str(a.shape[1]) + 'x' + str(a.shape[0]))
+				return {}
+			result = {}
+			for col, row in tiles:
+				x, y = tm.getTileCoords(col, row, zoom)
+				i = int(round((x - xmin) / res)) + left
+				j = int(round((ymax - y) / res)) + top
+				b = io.BytesIO()
+				Image.fromarray(a[j:j+tileSize, i:i+tileSize]).save(b, format=format)
+				result[(col, row)] = b.getvalue()
+		self.metrics.incr('metatiles')
+		return result
+
+	def getMetatile(self, laykey, mcol, mrow, zoom, useCache=True):
+		"""
+		Return the tiles {(col, row) : data} of a metatile, sharing the download with the concurrent
+		requests of the same metatile. The tiles are queued to the cache writer by the request that downloads them
+		"""
+		def download():
+			tiles = self.downloadMetatile(laykey, mcol, mrow, zoom)
+			if useCache and tiles:
+				cache = self.getCache(laykey, False)
+				for (col, row), data in tiles.items():
+					cache.writer.put( (col, row, zoom, data) )
+			return tiles
+
+		key = (self.srckey, laykey, self.srcGridKey, zoom, 'METATILE', mcol, mrow)
+		tiles = self.INFLIGHT.do(key, download, isAlive=lambda: self.running)
+		return tiles or {}
 
 
 
@@ -853,12 +2068,27 @@ class MapService():
 			if data is not None:
 				format = imghdr.what(None, data)
 				if format is not None:
+					self.metrics.incr('disk_hits')
 					return data
+			self.metrics.incr('disk_misses')
+
+			#don't request again a tile known to be missing
+			if not toDstGrid and cache.getMissing([(col, row, zoom)]):
+				self.metrics.incr('negative_hits')
+				return None
 
 		#if tile does not exists in cache or is corrupted, try to download it from map service
 		if not toDstGrid:
 
-			data = self.downloadTile(laykey, col, row, zoom)
+			if self.metatile:
+				#the other tiles of the metatile are cached by getMetatile
+				mcol, mrow = self.getMetatileKey(col, row)
+				data = self.getMetatile(laykey, mcol, mrow, zoom, useCache).get((col, row))
+				useCache = False
+			else:
+				#share the download with the concurrent requests of the same tile
+				key = (self.srckey, laykey, self.srcGridKey, zoom, col, row)
+				data = self.INFLIGHT.do(key, self.downloadTile, laykey, col, row, zoom, isAlive=lambda: self.running)
 
 		else: # build a reprojected tile
 
@@ -868,14 +2098,7 @@ class MapService():
 
 			#get closest zoom level
 			res = self.dstTms.getRes(zoom)
-			if self.dstTms.units == 'degrees' and self.srcTms.units == 'meters':
-				res2 = dd2meters(res)
-			elif self.srcTms.units == 'degrees' and self.dstTms.units == 'meters':
-				res2 = meters2dd(res)
-			else:
-				res2 = res
-			_zoom = self.srcTms.getNearestZoom(res2)
-			_res = self.srcTms.getRes(_zoom)
+			_zoom = self.getSrcZoom(zoom)
 
 			#reproj bbox
 			crs1, crs2 = self.srcTms.CRS, self.dstTms.CRS
@@ -893,68 +2116,247 @@ class MapService():
 
 			tileSize = self.dstTms.tileSize
 
-			img = reprojImg(crs1, crs2, mosaic, out_ul=(xmin,ymax), out_size=(tileSize,tileSize), out_res=res, resamplAlg=self.RESAMP_ALG)
+			with self.metrics.timer('reproj'):
+				img = reprojImg(crs1, crs2, mosaic, out_ul=(xmin,ymax), out_size=(tileSize,tileSize), out_res=res, resamplAlg=self.RESAMP_ALG)
 
 			#Get BLOB
-			b = io.BytesIO()
-			img.save(b, format='PNG')
-			data = b.getvalue() #convert bytesio to bytes
+			with self.metrics.timer('encode'):
+				b = io.BytesIO()
+				img.save(b, format='PNG')
+				data = b.getvalue() #convert bytesio to bytes
 
-		#put the tile in cache database
+		#queue the tile to be written in cache database
 		if useCache and data is not None:
-			cache.putTile(col, row, self.zoom, data)
+			cache.writer.put( (col, row, zoom, data) )
 
 		return data
 
 
 
-	def getTiles(self, laykey, tiles, tilesData = [], toDstGrid=True, useCache=True, nbThread=10, cpt=True):
+	def getSrcZoom(self, zoom):
+		"""Return the source zoom level whose resolution is the closest to the destination zoom level one"""
+		res = self.dstTms.getRes(zoom)
+		if self.dstTms.units == 'degrees' and self.srcTms.units == 'meters':
+			res = dd2meters(res)
+		elif self.srcTms.units == 'degrees' and self.dstTms.units == 'meters':
+			res = meters2dd(res)
+		return self.srcTms.getNearestZoom(res)
+
+
+	def warpTiles(self, laykey, tiles, tilesData=None, nbThread=10, cpt=True, callback=None, encode=True, incomplete=None):
+		"""
+		Build reprojected tiles of the destination grid by blocks
+		input: [(x,y,z)] >> output: [(x,y,z,data)]
+		For each block of adjacent destination tiles, the source tiles covering the whole block are
+		fetched and merged once, then warped once into a destination mosaic sliced into tiles.
+		This avoids to fetch, decode and warp the same source tiles for each neighbouring destination tile.
+		Source tiles that cannot be fetched are left transparent, the destination tiles they overlap are
+		added to the optional incomplete set before being output, they should not be cached
+		If encode is False, data are PIL images instead of PNG bytes (no encoding if the tiles are not cached)
+		Tiles out of the grid bounds have None data, cache is not used (see getTiles)
+		"""
+		if tilesData is None:
+			tilesData = []
+		if incomplete is None:
+			incomplete = set()
+		generation = self.generation
+		tm = self.dstTms
+		tileSize = tm.tileSize
+		crs1, crs2 = self.srcTms.CRS, tm.CRS
+		n = self.WARP_BLOCK_SIZE
+
+		def output(col, row, zoom, data):
+			if encode and data is not None and not isinstance(data, bytes):
+				with self.metrics.timer('encode'):
+					b = io.BytesIO()
+					data.save(b, format='PNG')
+					data = b.getvalue()
+			tilesData.append( (col, row, zoom, data) )
+			if cpt:
+				self.addProgress()
+			if callback is not None:
+				callback( (col, row, zoom, data) )
+
+		#group the tiles by zoom level and by blocks of n*n tiles
+		blocks = {}
+		for col, row, zoom in tiles:
+			x, y = tm.getTileCoords(col, row, zoom)
+			if row < 0 or col < 0 or not tm.xmin <= x < tm.xmax or not tm.ymin < y <= tm.ymax:
+				output(col, row, zoom, None)
+				continue
+			blocks.setdefault( (zoom, col // n, row // n), [] ).append( (col, row) )
+
+		for (zoom, i, j), block in sorted(blocks.items()):
+
+			if not self.isAlive(generation):
+				break
+
+			#extent of the block, restricted to the requested tiles
+			cols = [c for c, r in block]
+			rows = [r for c, r in block]
+			colMin, colMax, rowMin, rowMax = min(cols), max(cols), min(rows), max(rows)
+			xmin, ymin, xmax, ymax = tm.getTileBbox(colMin, rowMin, zoom)
+			_xmin, _ymin, _xmax, _ymax = tm.getTileBbox(colMax, rowMax, zoom)
+			bbox = (min(xmin, _xmin), min(ymin, _ymin), max(xmax, _xmax), max(ymax, _ymax))
+			if tm.originLoc == "NW":
+				firstRow = rowMin
+			else:
+				firstRow = rowMax
+
+			res = tm.getRes(zoom)
+			_zoom = self.getSrcZoom(zoom)
+
+			mosaic = None
+			emptyTiles = set()
+			try:
+				_bbox = reprojBbox(crs2, crs1, bbox)
+			except Exception as e:
+				print('WARN : cannot reproj tiles block bbox - ' + str(e))
+			else:
+				#one request for all the source tiles required by the block, missing ones are left transparent
+				mosaic = self.getImage(laykey, _bbox, _zoom, toDstGrid=False, useCache=True, nbThread=nbThread, cpt=False, emptyTiles=emptyTiles)
+
+			if mosaic is None:
+				if not self.isAlive(generation):
+					break
+				#the block can't be reprojected as a whole, fallback to one tile at a time
+				for col, row in block:
+					output(col, row, zoom, self.getTile(laykey, col, row, zoom, toDstGrid=True, useCache=False))
+				continue
+
+			if emptyTiles:
+				for col, row in block:
+					#extended by one pixel, resampling reads the neighbouring source pixels
+					x1, y1, x2, y2 = tm.getTileBbox(col, row, zoom)
+					if self.overlapsTiles((x1 - res, y1 - res, x2 + res, y2 + res), _zoom, emptyTiles):
+						incomplete.add( (col, row, zoom) )
+
+			#one warp for the whole block
+			size = ( (colMax - colMin + 1) * tileSize, (rowMax - rowMin + 1) * tileSize )
+			with self.metrics.timer('reproj', {'tiles': len(block)}):
+				img = reprojImg(crs1, crs2, mosaic, out_ul=(bbox[0], bbox[3]), out_size=size, out_res=res, resamplAlg=self.RESAMP_ALG).img
+
+			for col, row in block:
+				posx = (col - colMin) * tileSize
+				posy = abs(row - firstRow) * tileSize
+				output(col, row, zoom, img.crop( (posx, posy, posx + tileSize, posy + tileSize) ))
+
+		return tilesData
+
+	def overlapsTiles(self, bbox, zoom, tiles):
+		"""Return True if the destination grid bbox overlaps one of the source tiles [(x,y,z)] at this zoom level"""
+		try:
+			xmin, ymin, xmax, ymax = reprojBbox(self.dstTms.CRS, self.srcTms.CRS, bbox)
+		except Exception:
+			return True
+		colMin, rowMin, colMax, rowMax = self.srcTms.getTileRange((xmin, ymin, xmax, ymax), zoom)
+		return any(colMin <= col <= colMax and rowMin <= row <= rowMax for col, row, z in tiles)
+
+
+	def getTiles(self, laykey, tiles, tilesData = [], toDstGrid=True, useCache=True, nbThread=10, cpt=True, engine=None, callback=None):
 		"""
 		Return bytes data of requested tiles
 		input: [(x,y,z)] >> output: [(x,y,z,data)]
 		Tiles are downloaded from map service or directly pick up from cache database.
-		Downloads are performed through thread to speed up
+		Downloads are performed through thread or asyncio engine (default to FETCH_ENGINE) to speed up
+		With the asyncio engine, nbThread is the max number of tiles downloaded at the same time
+		WMS sources with metatiling are downloaded by metatiles through threads, whatever the engine
 		Possibility to pass a list 'tilesData' as argument to seed it
+		Optional callback is called with each downloaded (x,y,z,data) tuple as soon as it is available
+		Reprojected tiles are not downloaded but built by blocks (see warpTiles)
+		New tiles are queued to the cache background writer as soon as they are available, they may
+		not be committed yet when this function returns (see GeoPackage.flush)
 		"""
 
 		def downloading(laykey, tilesQueue, tilesData, toDstGrid):
 			'''Worker that process the queue and seed tilesData array [(x,y,z,data)]'''
 			#infinite loop that processes items into the queue
 			while not tilesQueue.empty():
-				#cancel thread if requested
-				if not self.running:
+				#cancel thread if requested or if the request is outdated
+				if not self.isAlive(generation):
 					break
-				#Get a job into the queue
-				col, row, zoom = tilesQueue.get()
+				#Get a job into the queue : a tile or the requested tiles of a metatile
+				job = tilesQueue.get()
 				#do the job
-				data = self.getTile(laykey, col, row, zoom, toDstGrid, useCache=False)
-				tilesData.append( (col, row, zoom, data) )
-				if cpt:
-					self.cptTiles += 1
+				if metatiling:
+					(mcol, mrow, zoom), requested = job
+					data = self.getMetatile(laykey, mcol, mrow, zoom, useCache)
+					fetched = [ (col, row, zoom, data.get((col, row))) for col, row, zoom in requested ]
+				else:
+					col, row, zoom = job
+					fetched = [ (col, row, zoom, self.getTile(laykey, col, row, zoom, toDstGrid, useCache=False)) ]
+				for tile in fetched:
+					tilesData.append(tile)
+					if cpt:
+						self.addProgress()
+					output(tile)
 				#flag it's done
 				tilesQueue.task_done()
 
+		if engine is None:
+			engine = self.FETCH_ENGINE
+
+		generation = self.generation
+		metatiling = self.metatile is not None and not toDstGrid
+
 		if cpt:
 			#init cpt progress
-			self.nbTiles = len(tiles)
-			self.cptTiles = 0
+			self.startProgress(len(tiles))
 
 		if useCache:
 			cache = self.getCache(laykey, toDstGrid)
-			result = cache.getTiles(tiles) #return [(x,y,z,data)]
+			with self.metrics.timer('cache_read', {'tiles': len(tiles)}):
+				result = cache.getTiles(tiles) #return [(x,y,z,data)]
 			existing = set([ r[:-1] for r in result])
 			missing = [t for t in tiles if t not in existing]
+			self.metrics.incr('disk_hits', len(result))
+			self.metrics.incr('disk_misses', len(missing))
+			if not toDstGrid:
+				#don't request again the tiles known to be missing on the server
+				known = cache.getMissing(missing)
+				if known:
+					missing = [t for t in missing if t not in known]
+					result.extend( (x, y, z, None) for x, y, z in known )
+					self.metrics.incr('negative_hits', len(known))
 			if cpt:
-				self.cptTiles += len(result)
+				self.skipProgress(len(result))
 		else:
 			missing = tiles
 
-		if len(missing) > 0:
+		#reprojected tiles warped with missing source tiles
+		incomplete = set()
+
+		def output(tile):
+			'''Queue a new tile to be written in cache and forward it to the callback'''
+			#metatiles are queued to the cache as a whole by getMetatile
+			if useCache and tile[3] is not None and not metatiling and tile[:3] not in incomplete:
+				cache.writer.put(tile)
+			if callback is not None:
+				callback(tile)
+
+		if len(missing) > 0 and toDstGrid:
+
+			self.warpTiles(laykey, missing, tilesData, nbThread, cpt, output, incomplete=incomplete)
+
+		elif len(missing) > 0 and engine == 'ASYNC' and not metatiling:
+
+			fetcher = AsyncTilesFetcher(self, maxConcurrency=nbThread)
+			fetcher.getTiles(laykey, missing, tilesData, cpt, output)
+
+		elif len(missing) > 0:
 
 			#Seed the queue
 			jobs = queue.Queue()
-			for tile in missing:
-				jobs.put(tile)
+			if metatiling:
+				metatiles = collections.OrderedDict()
+				for col, row, zoom in missing:
+					mcol, mrow = self.getMetatileKey(col, row)
+					metatiles.setdefault((mcol, mrow, zoom), []).append( (col, row, zoom) )
+				for job in metatiles.items():
+					jobs.put(job)
+			else:
+				for tile in missing:
+					jobs.put(tile)
 
 			#Launch threads
 			threads = []
@@ -969,13 +2371,9 @@ class MapService():
 			for t in threads:
 				t.join()
 
-			#Put all missing tiles in cache
-			if useCache:
-				cache.putTiles( [t for t in tilesData if t[3] is not None] )
-
 		#Reinit cpt progress
 		if cpt:
-			self.nbTiles, self.cptTiles = 0, 0
+			self.resetProgress()
 
 		#Add existing tiles to final list
 		if useCache:
@@ -985,11 +2383,21 @@ class MapService():
 
 
 
-	def getImage(self, laykey, bbox, zoom, toDstGrid=True, useCache=True, nbThread=10, cpt=True, outCRS=None, allowEmptyTile=True):
+	def getImage(self, laykey, bbox, zoom, toDstGrid=True, useCache=True, nbThread=10, cpt=True, outCRS=None, allowEmptyTile=True, incremental=False, emptyTiles=None):
 		"""
 		Build a mosaic of tiles covering the requested bounding box
 		return GeoImage object (PIL image + georef infos)
+		If incremental is True, the tiles already contained in the previous incremental mosaic
+		built for the same layer, grid and zoom level are reused instead of being fetched again
+		If a set is given as emptyTiles, it's seeded with the (x,y,z) of the tiles that cannot be fetched,
+		they are left transparent instead of being filled with a placeholder color
 		"""
+		with self.metrics.timer('getImage', {'zoom': zoom, 'toDstGrid': toDstGrid}):
+			return self._getImage(laykey, bbox, zoom, toDstGrid, useCache, nbThread, cpt, outCRS, allowEmptyTile, incremental, emptyTiles)
+
+	def _getImage(self, laykey, bbox, zoom, toDstGrid, useCache, nbThread, cpt, outCRS, allowEmptyTile, incremental, emptyTiles):
+
+		generation = self.generation
 
 		#Select tile matrix set
 		if toDstGrid:
@@ -1016,52 +2424,159 @@ class MapService():
 		nbTilesY = math.ceil( (ymax - ymin) / (tileSize * res) )
 
 		#Build list of required column and row numbers
-		cols = [firstCol+i for i in range(nbTilesX)]
+		cols = firstCol + np.arange(nbTilesX)
 		if tm.originLoc == "NW":
-			rows = [firstRow+i for i in range(nbTilesY)]
+			rows = firstRow + np.arange(nbTilesY)
 		else:
-			rows = [firstRow-i for i in range(nbTilesY)]
+			rows = firstRow - np.arange(nbTilesY)
 
-		#Create PIL image in memory
+		#Preallocate the mosaic buffer, tiles are decoded straight into their slice of it
 		img_w, img_h = len(cols) * tileSize, len(rows) * tileSize
-		mosaic = Image.new("RGBA", (img_w , img_h), None)
+		mosaic = np.zeros((img_h, img_w, 4), dtype=np.uint8)
 
-		#Get tiles from www or cache
-		tiles = [ (c, r, zoom) for c in cols for r in rows]
+		tiles = list(zip(np.repeat(cols, nbTilesY).tolist(), np.tile(rows, nbTilesX).tolist(), [zoom] * (nbTilesX * nbTilesY)))
+		cols, rows = cols.tolist(), rows.tolist()
+		grdkey = self.dstGridKey if toDstGrid else self.srcGridKey
+		mosaicKey = (laykey, grdkey, zoom)
+		placeholders = set() #placeholder tiles, they must not be reused by the next incremental mosaic
 
-		tiles = self.getTiles(laykey, tiles, [], toDstGrid, useCache, nbThread, cpt)
+		def tileSlice(col, row):
+			posx = (col - firstCol) * tileSize
+			posy = abs((row - firstRow)) * tileSize
+			return mosaic[posy:posy+tileSize, posx:posx+tileSize]
+
+		#Shift the previous mosaic by whole tiles and only request the newly exposed tiles
+		if incremental and self.prevMosaic is not None and self.prevMosaic[0] == mosaicKey:
+			_, prevMosaic, prevCols, prevRows, prevPlaceholders = self.prevMosaic
+			posx = (prevCols[0] - firstCol) * tileSize
+			if tm.originLoc == "NW":
+				posy = (prevRows[0] - firstRow) * tileSize
+			else:
+				posy = (firstRow - prevRows[0]) * tileSize
+			#copy the overlapping area
+			prev_h, prev_w = prevMosaic.shape[:2]
+			x1, y1 = max(posx, 0), max(posy, 0)
+			x2, y2 = min(posx + prev_w, img_w), min(posy + prev_h, img_h)
+			if x1 < x2 and y1 < y2:
+				mosaic[y1:y2, x1:x2] = prevMosaic[y1-posy:y2-posy, x1-posx:x2-posx]
+			prevCols, prevRows = set(prevCols), set(prevRows)
+			tiles = [ (c, r, z) for c, r, z in tiles if c not in prevCols or r not in prevRows or (c, r) in prevPlaceholders ]
+
+		#Get already decoded tiles from memory cache
+		if useCache:
+			missing = []
+			for tile in tiles:
+				col, row, z = tile
+				a = self.MEM_CACHE.get( (self.srckey, laykey, grdkey, z, col, row) )
+				if a is not None:
+					tileSlice(col, row)[...] = a
+				else:
+					missing.append(tile)
+			self.metrics.incr('mem_hits', len(tiles) - len(missing))
+			self.metrics.incr('mem_misses', len(missing))
+			tiles = missing
+
+		#Get others tiles from www or cache
+		if len(tiles) > 0 and toDstGrid:
+			#reprojected tiles are warped by blocks and pasted without PNG roundtrip, they are encoded only to be cached
+			if useCache:
+				cache = self.getCache(laykey, toDstGrid)
+				with self.metrics.timer('cache_read', {'tiles': len(tiles)}):
+					existing = cache.getTiles(tiles)
+				found = set( t[:-1] for t in existing )
+				missing = [t for t in tiles if t not in found]
+				self.metrics.incr('disk_hits', len(existing))
+				self.metrics.incr('disk_misses', len(missing))
+			else:
+				existing, missing = [], tiles
+			if cpt:
+				self.startProgress(len(tiles))
+				self.skipProgress(len(existing))
+			incomplete = set()
+			warped = self.warpTiles(laykey, missing, [], nbThread, cpt, encode=False, incomplete=incomplete)
+			if cpt:
+				self.resetProgress()
+			if useCache and len(warped) > 0:
+				encoded = []
+				with self.metrics.timer('encode', {'tiles': len(warped)}):
+					for col, row, z, img in warped:
+						#tiles with transparent holes are displayed but not cached, they will be built again
+						if img is not None and (col, row, z) not in incomplete:
+							b = io.BytesIO()
+							img.save(b, format='PNG')
+							encoded.append( (col, row, z, b.getvalue()) )
+				for tile in encoded:
+					cache.writer.put(tile)
+			tiles = existing + warped
+		elif len(tiles) > 0:
+			tiles = self.getTiles(laykey, tiles, [], toDstGrid, useCache, nbThread, cpt)
+
+		def decode(tile):
+			'''Decode a tile into its slice of the mosaic, return False if it's not a valid image'''
+			col, row, z, data = tile
+			#skip the remaining tiles of an outdated request, so they don't compete with the current one
+			if data is None or not self.isAlive(generation):
+				return False
+			try:
+				t0 = time.perf_counter()
+				if isinstance(data, bytes):
+					img = Image.open(io.BytesIO(data))
+				else:
+					img = data #reprojected tile already decoded
+				if img.mode != 'RGBA':
+					img = img.convert('RGBA')
+				a = np.asarray(img)
+				t1 = time.perf_counter()
+				tileSlice(col, row)[...] = a
+				t2 = time.perf_counter()
+			except:
+				return False
+			self.metrics.observe('decode', t1 - t0, t0)
+			self.metrics.observe('paste', t2 - t1, t1)
+			if useCache:
+				self.MEM_CACHE.put( (self.srckey, laykey, grdkey, z, col, row), a)
+			return True
 
-		for tile in tiles:
+		if not self.isAlive(generation):
+			return None
 
-			if not self.running:
-				return None
+		#PIL releases the GIL while decoding, so tiles are decoded by a pool of threads
+		if len(tiles) > 1 and nbThread > 1:
+			with concurrent.futures.ThreadPoolExecutor(min(nbThread, len(tiles))) as pool:
+				decoded = list(pool.map(decode, tiles))
+		else:
+			decoded = [decode(tile) for tile in tiles]
+
+		if not self.isAlive(generation):
+			return None
 
+		for tile, ok in zip(tiles, decoded):
+			if ok:
+				continue
+			if not allowEmptyTile:
+				return None
+			#create an empty tile if we are unable to get a valid stream
 			col, row, z, data = tile
-			if data is None:
-				#create an empty tile
-				if allowEmptyTile:
-					img = Image.new("RGBA", (tileSize , tileSize), "lightgrey")
-				else:
-					return None
+			if emptyTiles is not None:
+				emptyTiles.add( (col, row, z) )
+			elif data is None:
+				tileSlice(col, row)[...] = (211, 211, 211, 255) #lightgrey
 			else:
-				try:
-					img = Image.open(io.BytesIO(data))
-				except:
-					if allowEmptyTile:
-						#create an empty tile if we are unable to get a valid stream
-						img = Image.new("RGBA", (tileSize , tileSize), "pink")
-					else:
-						return None
-			posx = (col - firstCol) * tileSize
-			posy = abs((row - firstRow)) * tileSize
-			mosaic.paste(img, (posx, posy))
+				tileSlice(col, row)[...] = (255, 192, 203, 255) #pink
+			placeholders.add( (col, row) )
+			self.metrics.incr('empty_tiles')
+
+		if incremental and self.isAlive(generation):
+			self.prevMosaic = (mosaicKey, mosaic, cols, rows, placeholders)
 
+		mosaic = Image.fromarray(mosaic)
 		geoimg = GeoImage(mosaic, (xmin, ymax), res)
 
 		if outCRS is not None and outCRS != tm.CRS:
-			geoimg = reprojImg(tm.CRS, outCRS, geoimg, resamplAlg=self.RESAMP_ALG)
+			with self.metrics.timer('reproj'):
+				geoimg = reprojImg(tm.CRS, outCRS, geoimg, resamplAlg=self.RESAMP_ALG)
 
-		if self.running:
+		if self.isAlive(generation):
 			return geoimg
 		else:
 			return None
@@ -1069,6 +2584,364 @@ class MapService():
 
 
 
+class ImgWarper():
+	"""
+	Reusable GDAL warper for a given (crs1, crs2, resampling algo) combination
+	Spatial refs, WKT strings and the points transformer are built once and shared by all
+	the images reprojected with the same parameters, use ImgWarper.get() to pick up the cached instance
+	(a NpImgWarper if GDAL is not available)
+	"""
+
+	# Error threshold in pixels for the approximated transformer (0 will use the exact transformer)
+	ERROR_THRESHOLD = 0.125
+
+	# Warp options (http://www.gdal.org/structGDALWarpOptions.html)
+	WARP_OPTIONS = ['NUM_THREADS=ALL_CPUS', 'SAMPLE_GRID=YES']
+
+	# Memory limit of the warping engine in bytes (0 = gdal default)
+	MEM_LIMIT = 0
+
+	_warpers = {}
+	_lock = threading.Lock()
+
+	@classmethod
+	def get(cls, crs1, crs2, resamplAlg='BL'):
+		key = (str(crs1), str(crs2), resamplAlg)
+		with cls._lock:
+			warper = cls._warpers.get(key)
+			if warper is None:
+				if GDAL:
+					warper = ImgWarper(crs1, crs2, resamplAlg)
+				else:
+					warper = NpImgWarper(crs1, crs2, resamplAlg)
+				cls._warpers[key] = warper
+		return warper
+
+	@classmethod
+	def clear(cls):
+		with cls._lock:
+			cls._warpers.clear()
+
+	def __init__(self, crs1, crs2, resamplAlg='BL'):
+		if not GDAL:
+			raise NotImplementedError
+
+		self.crs1, self.crs2 = crs1, crs2
+		self.prj1 = SRS(crs1).getOgrSpatialRef()
+		self.prj2 = SRS(crs2).getOgrSpatialRef()
+		self.wkt1 = self.prj1.ExportToWkt()
+		self.wkt2 = self.prj2.ExportToWkt()
+
+		#points transformer, osr transformations are not thread safe
+		self.reproj = Reproj(crs1, crs2)
+		self._reprojLock = threading.Lock()
+
+		# Resample algo
+		if resamplAlg == 'NN' : self.alg = gdal.GRA_NearestNeighbour
+		elif resamplAlg == 'BL' : self.alg = gdal.GRA_Bilinear
+		elif resamplAlg == 'CB' : self.alg = gdal.GRA_Cubic
+		elif resamplAlg == 'CBS' : self.alg = gdal.GRA_CubicSpline
+		elif resamplAlg == 'LCZ' : self.alg = gdal.GRA_Lanczos
+		else:
+			raise ValueError('Unknown resampling algorithm ' + str(resamplAlg))
+
+		#gdal.Warp and its options parameter start with gdal 2.1
+		if hasattr(gdal, 'Warp'):
+			self.options = gdal.WarpOptions(resampleAlg=self.alg, errorThreshold=self.ERROR_THRESHOLD,
+				warpMemoryLimit=self.MEM_LIMIT or None, multithread=True, warpOptions=self.WARP_OPTIONS)
+		else:
+			self.options = None
+
+	def reprojPt(self, x, y):
+		with self._reprojLock:
+			return self.reproj.pt(x, y)
+
+	def reprojBbox(self, bbox):
+		with self._reprojLock:
+			return self.reproj.bbox(bbox)
+
+
+	def getOutGeometry(self, geoimg, out_ul=None, out_size=None, out_res=None):
+		"""
+		Return (xmin, ymax, res, width, height) of the reprojected image
+		out_ul >> output raster top left coords (same as input if None)
+		out_size >> output raster size (same as input is None)
+		out_res >> output raster resolution (same as input if None)
+		"""
+		xmin, ymax = geoimg.ul
+		res = geoimg.res
+		img_w, img_h = geoimg.img.size
+
+		if out_ul is not None:
+			xmin, ymax = out_ul
+		else:
+			xmin, ymax = self.reprojPt(xmin, ymax)
+
+		#submit resolution and size
+		if out_res is not None and out_size is not None:
+			res = out_res
+			img_w, img_h = out_size
+
+		#submit resolution and auto compute the best image size
+		if out_res is not None and out_size is None:
+			res = out_res
+			#reprojected image size depend on final bbox and expected resolution
+			xmin, ymin, xmax, ymax = self.reprojBbox(geoimg.bbox)
+			img_w = int( (xmax - xmin) / res )
+			img_h = int( (ymax - ymin) / res )
+
+		#submit image size and ...
+		if out_res is None and out_size is not None:
+			img_w, img_h = out_size
+			#...let's res as source value ? (image will be croped)
+
+		#Keep original image px size and compute resolution to approximately preserve geosize
+		if out_res is None and out_size is None:
+			#find the res that match source diagolal size
+			xmin, ymin, xmax, ymax = self.reprojBbox(geoimg.bbox)
+			dst_diag = math.sqrt( (xmax - xmin)**2 + (ymax - ymin)**2)
+			px_diag = math.sqrt(img_w**2 + img_h**2)
+			res = dst_diag / px_diag
+
+		return xmin, ymax, res, img_w, img_h
+
+
+	def warp(self, geoimg, out_ul=None, out_size=None, out_res=None):
+		"""
+		Reproject a GeoImage object (PIL image + georef infos)
+		out_ul >> output raster top left coords (same as input if None)
+		out_size >> output raster size (same as input is None)
+		out_res >> output raster resolution (same as input if None)
+		"""
+		img = geoimg.img
+		if img.mode not in ('L', 'RGB', 'RGBA'):
+			img = img.convert('RGBA')
+		img_w, img_h = img.size
+		nbBands = len(img.getbands())
+		mode = img.mode
+
+		#Create an in memory gdal raster and write the pixel interleaved PIL buffer in one call
+		ds1 = gdal.GetDriverByName('MEM').Create('', img_w, img_h, nbBands, gdal.GDT_Byte)
+		ds1.WriteRaster(0, 0, img_w, img_h, img.tobytes(), band_list=list(range(1, nbBands+1)),
+			buf_pixel_space=nbBands, buf_line_space=img_w*nbBands, buf_band_space=1)
+
+		#Assign georef infos
+		ds1.SetGeoTransform( (geoimg.ul[0], geoimg.res, 0, geoimg.ul[1], 0, -geoimg.res) )
+		ds1.SetProjection(self.wkt1)
+
+		#Build destination dataset
+		# ds2 will be a template empty raster to reproject the data into
+		# we can directly set its size, res and top left coord as expected
+		# warp function will match the template (clip and resampling)
+		xmin, ymax, res, img_w, img_h = self.getOutGeometry(geoimg, out_ul, out_size, out_res)
+
+		ds2 = gdal.GetDriverByName('MEM').Create('', img_w, img_h, nbBands, gdal.GDT_Byte)
+		ds2.SetGeoTransform( (xmin, res, 0, ymax, 0, -res) )
+		ds2.SetProjection(self.wkt2)
+
+		#Perform the projection/resampling
+		if self.options is not None:
+			gdal.Warp(ds2, ds1, options=self.options)
+		else:
+			gdal.ReprojectImage(ds1, ds2, self.wkt1, self.wkt2, self.alg, self.MEM_LIMIT, self.ERROR_THRESHOLD)
+
+		#Convert to PIL image, reading all bands at once in a pixel interleaved buffer
+		data = ds2.ReadRaster(0, 0, img_w, img_h, band_list=list(range(1, nbBands+1)),
+			buf_pixel_space=nbBands, buf_line_space=img_w*nbBands, buf_band_space=1)
+		img = Image.frombytes(mode, (img_w, img_h), data)
+
+		#Close gdal datasets
+		ds1 = None
+		ds2 = None
+
+		return GeoImage(img, (xmin, ymax), res)
+
+
+
+class NpImgWarper(ImgWarper):
+	"""
+	Pure NumPy fallback of ImgWarper, only Web Mercator, WGS84 and UTM are supported
+	Inverse mapping : the position in the source image of each destination pixel is computed, then
+	the source image is sampled with nearest neighbour or bilinear resampling (other algos fallback to bilinear).
+	Exact positions are computed on a coarse control grid and bilinearly interpolated in between,
+	the grid is refined until the interpolation error is below ERROR_THRESHOLD pixel
+	"""
+
+	# initial spacing in pixels of the control grid (0 will use the exact transformation for each pixel)
+	CONTROL_GRID_STEP = 32
+
+	# number of destination rows processed at once, bounds the memory used by the temporary arrays
+	BLOCK_ROWS = 512
+
+	def __init__(self, crs1, crs2, resamplAlg='BL'):
+		self.crs1, self.crs2 = crs1, crs2
+		self.reproj = ArrayReproj(crs1, crs2)
+		#inverse transformation, from destination to source crs
+		self.invReproj = ArrayReproj(crs2, crs1)
+
+		if resamplAlg == 'NN':
+			self.resamplAlg = 'NN'
+		else:
+			self.resamplAlg = 'BL'
+
+	@staticmethod
+	def validate(crs1, crs2):
+		return ArrayReproj.validate(crs1, crs2)
+
+	def reprojPt(self, x, y):
+		xs, ys = self.reproj.pts(np.array([x], dtype=float), np.array([y], dtype=float))
+		return xs[0], ys[0]
+
+	def reprojBbox(self, bbox):
+		xmin, ymin, xmax, ymax = bbox
+		xs, ys = self.reproj.pts(np.array([xmin, xmin, xmax, xmax], dtype=float), np.array([ymin, ymax, ymax, ymin], dtype=float))
+		return xs.min(), ys.min(), xs.max(), ys.max()
+
+
+	def getSrcPos(self, geoimg, xmin, ymax, res, cols, rows):
+		"""Return exact (x, y) positions in the source image of destination pixels centers (cols, rows arrays)"""
+		xs = xmin + (cols + 0.5) * res
+		ys = ymax - (rows + 0.5) * res
+		with np.errstate(all='ignore'):
+			xs, ys = self.invReproj.pts(xs, ys)
+		_xmin, _ymax = geoimg.ul
+		return (xs - _xmin) / geoimg.res - 0.5, (_ymax - ys) / geoimg.res - 0.5
+
+	@staticmethod
+	def _interpIdx(grid, n):
+		"""Return indices and weights to linearly interpolate values defined at grid positions to range(n)"""
+		pos = np.arange(n)
+		idx = np.clip(np.searchsorted(grid, pos, side='right') - 1, 0, max(len(grid) - 2, 0))
+		if len(grid) == 1:
+			return idx, idx, np.zeros(n, dtype=np.float32)
+		t = (pos - grid[idx]) / (grid[idx + 1] - grid[idx])
+		return idx, idx + 1, t.astype(np.float32)
+
+	def getControlGrid(self, geoimg, xmin, ymax, res, img_w, img_h):
+		"""
+		Return (gridCols, gridRows, srcX, srcY), exact source positions at the nodes of the coarsest
+		control grid whose bilinear interpolation error is below ERROR_THRESHOLD pixel
+		"""
+		step = self.CONTROL_GRID_STEP
+		while True:
+			if step <= 1:
+				gc, gr = np.arange(img_w), np.arange(img_h)
+			else:
+				gc = np.unique(np.append(np.arange(0, img_w, step), img_w - 1))
+				gr = np.unique(np.append(np.arange(0, img_h, step), img_h - 1))
+			cols, rows = np.meshgrid(gc.astype(float), gr.astype(float))
+			px, py = self.getSrcPos(geoimg, xmin, ymax, res, cols, rows)
+			if step <= 1 or (len(gc) < 2 and len(gr) < 2):
+				return gc, gr, px, py
+			#compare exact positions at the cells centers with the interpolated ones
+			cc = (gc[:-1] + gc[1:]) / 2 if len(gc) > 1 else gc.astype(float)
+			rc = (gr[:-1] + gr[1:]) / 2 if len(gr) > 1 else gr.astype(float)
+			cols, rows = np.meshgrid(cc, rc)
+			ex, ey = self.getSrcPos(geoimg, xmin, ymax, res, cols, rows)
+			def center(a):
+				if a.shape[1] > 1:
+					a = (a[:, :-1] + a[:, 1:]) / 2
+				if a.shape[0] > 1:
+					a = (a[:-1] + a[1:]) / 2
+				return a
+			with np.errstate(invalid='ignore'):
+				err = np.maximum(np.abs(center(px) - ex), np.abs(center(py) - ey))
+			if not np.any(err > self.ERROR_THRESHOLD):
+				return gc, gr, px, py
+			step //= 2
+
+
+	@staticmethod
+	def _lerp32(a, b, f):
+		"""
+		Linear interpolation between RGBA pixels packed in uint32 arrays, f are uint32 weights in [0, 256]
+		Two channels are computed at once in each 16 bits half of the integers (SWAR)
+		"""
+		g = 256 - f
+		rb = ( ((a & 0x00FF00FF) * g + (b & 0x00FF00FF) * f + 0x00800080) >> 8 ) & 0x00FF00FF
+		ag = ( ((a >> 8) & 0x00FF00FF) * g + ((b >> 8) & 0x00FF00FF) * f + 0x00800080 ) & 0xFF00FF00
+		return rb | ag
+
+	def sample(self, data, px, py):
+		"""Resample data (h,w,b) uint8 array at positions px, py (float arrays), outside pixels are zero"""
+		h, w, b = data.shape
+		with np.errstate(invalid='ignore'):
+			outside = ~( (px >= -0.5) & (px <= w - 0.5) & (py >= -0.5) & (py <= h - 0.5) )
+
+		if self.resamplAlg == 'NN' or w < 2 or h < 2:
+			x = np.clip(px + 0.5, 0, w - 1).astype(np.int32)
+			y = np.clip(py + 0.5, 0, h - 1).astype(np.int32)
+			i = y * w + x
+			i[outside] = 0
+			out = data.reshape(-1, b)[i]
+
+		else:
+			#8 bits fixed point coordinates, the last row and column are reached with a weight of 255/256
+			qx = (np.clip(px, 0, w - 1 - 1/256) * 256).astype(np.int32)
+			qy = (np.clip(py, 0, h - 1 - 1/256) * 256).astype(np.int32)
+			qx[outside] = 0
+			qy[outside] = 0
+			i = (qy >> 8) * w + (qx >> 8)
+
+			if b == 4:
+				#RGBA pixels are gathered and blended as 32 bits integers
+				flat = data.reshape(-1).view(np.uint32)
+				fx = (qx & 255).astype(np.uint32)
+				fy = (qy & 255).astype(np.uint32)
+				top = self._lerp32(flat[i], flat[i + 1], fx)
+				bottom = self._lerp32(flat[i + w], flat[i + w + 1], fx)
+				out = self._lerp32(top, bottom, fy).view(np.uint8).reshape(px.shape + (4,))
+			else:
+				flat = data.reshape(-1, b)
+				fx = (qx & 255)[..., None] / np.float32(256)
+				fy = (qy & 255)[..., None] / np.float32(256)
+				top = flat[i] * (1 - fx) + flat[i + 1] * fx
+				bottom = flat[i + w] * (1 - fx) + flat[i + w + 1] * fx
+				out = (top * (1 - fy) + bottom * fy + 0.5).astype(np.uint8)
+
+		out[outside] = 0
+		return out
+
+
+	def warp(self, geoimg, out_ul=None, out_size=None, out_res=None):
+		"""
+		Reproject a GeoImage object (PIL image + georef infos)
+		out_ul >> output raster top left coords (same as input if None)
+		out_size >> output raster size (same as input is None)
+		out_res >> output raster resolution (same as input if None)
+		"""
+		img = geoimg.img
+		if img.mode not in ('L', 'RGB', 'RGBA'):
+			img = img.convert('RGBA')
+		mode = img.mode
+		data = np.asarray(img)
+		if data.ndim == 2:
+			data = data[:, :, None]
+
+		xmin, ymax, res, img_w, img_h = self.getOutGeometry(geoimg, out_ul, out_size, out_res)
+		gc, gr, gx, gy = self.getControlGrid(geoimg, xmin, ymax, res, img_w, img_h)
+		gx, gy = gx.astype(np.float32), gy.astype(np.float32)
+
+		#interpolate the control grid along the columns once, then along the rows by blocks
+		c0, c1, tc = self._interpIdx(gc, img_w)
+		gx = gx[:, c0] * (1 - tc) + gx[:, c1] * tc
+		gy = gy[:, c0] * (1 - tc) + gy[:, c1] * tc
+		r0, r1, tr = self._interpIdx(gr, img_h)
+
+		out = np.empty((img_h, img_w, data.shape[2]), dtype=np.uint8)
+		for i in range(0, img_h, self.BLOCK_ROWS):
+			j = min(i + self.BLOCK_ROWS, img_h)
+			t = tr[i:j, None]
+			px = gx[r0[i:j]] * (1 - t) + gx[r1[i:j]] * t
+			py = gy[r0[i:j]] * (1 - t) + gy[r1[i:j]] * t
+			out[i:j] = self.sample(data, px, py)
+
+		if mode == 'L':
+			out = out[:, :, 0]
+		return GeoImage(Image.fromarray(out), (xmin, ymax), res)
+
+
+
 def reprojImg(crs1, crs2, geoimg, out_ul=None, out_size=None, out_res=None, resamplAlg='BL'):
 	'''
 	Use GDAL Python binding to reproject an image
@@ -1077,103 +2950,7 @@ def reprojImg(crs1, crs2, geoimg, out_ul=None, out_size=None, out_res=None, resa
 	out_ul >> output raster top left coords (same as input if None)
 	out_size >> output raster size (same as input is None)
 	out_res >> output raster resolution (same as input if None)
+	The warper is cached, see ImgWarper
+	Without GDAL, only Web Mercator, WGS84 and UTM are supported, see NpImgWarper
 	'''
-
-	if not GDAL:
-		raise NotImplementedError
-
-	#Create an in memory gdal raster and write data to it (PIL > Numpy > GDAL)
-	data = np.asarray(geoimg.img)
-	img_h, img_w, nbBands = data.shape
-	ds1 = gdal.GetDriverByName('MEM').Create('', img_w, img_h, nbBands, gdal.GDT_Byte)
-	for bandIdx in range(nbBands):
-		bandArray = data[:,:,bandIdx]
-		ds1.GetRasterBand(bandIdx+1).WriteArray(bandArray)
-	"""
-	# Alternative : Use a virtual memory file to create gdal dataset from buffer
-	buff = io.BytesIO()
-	geoimg.img.save(buff, format='PNG')
-	vsipath = '/vsimem/mosaic'
-	gdal.FileFromMemBuffer(vsipath, buff.getvalue())
-	ds1 = gdal.Open(vsipath)
-	img_h, img_w = ds1.RasterXSize, ds1.RasterYSize
-	nbBands = ds1.RasterCount
-	"""
-
-	#Assign georef infos
-	xmin, ymax = geoimg.ul
-	res = geoimg.res
-	geoTrans = (xmin, res, 0, ymax, 0, -res)
-	ds1.SetGeoTransform(geoTrans)
-	prj1 = SRS(crs1).getOgrSpatialRef()
-	wkt1 = prj1.ExportToWkt()
-	ds1.SetProjection(wkt1)
-
-	#Build destination dataset
-	# ds2 will be a template empty raster to reproject the data into
-	# we can directly set its size, res and top left coord as expected
-	# reproject funtion will match the template (clip and resampling)
-
-	if out_ul is not None:
-		xmin, ymax = out_ul
-	else:
-		xmin, ymax = reprojPt(crs1, crs2, xmin, ymax)
-
-	#submit resolution and size
-	if out_res is not None and out_size is not None:
-		res = out_res
-		img_w, img_h = out_size
-
-	#submit resolution and auto compute the best image size
-	if out_res is not None and out_size is None:
-		res = out_res
-		#reprojected image size depend on final bbox and expected resolution
-		xmin, ymin, xmax, ymax = reprojBbox(crs1, crs2, geoimg.bbox)
-		img_w = int( (xmax - xmin) / res )
-		img_h = int( (ymax - ymin) / res )
-
-	#submit image size and ...
-	if out_res is None and out_size is not None:
-		img_w, img_h = out_size
-		#...let's res as source value ? (image will be croped)
-
-	#Keep original image px size and compute resolution to approximately preserve geosize
-	if out_res is None and out_size is None:
-		#find the res that match source diagolal size
-		xmin, ymin, xmax, ymax = reprojBbox(crs1, crs2, geoimg.bbox)
-		dst_diag = math.sqrt( (xmax - xmin)**2 + (ymax - ymin)**2)
-		px_diag = math.sqrt(img_w**2 + img_h**2)
-		res = dst_diag / px_diag
-
-	ds2 = gdal.GetDriverByName('MEM').Create('', img_w, img_h, nbBands, gdal.GDT_Byte)
-	geoTrans = (xmin, res, 0, ymax, 0, -res)
-	ds2.SetGeoTransform(geoTrans)
-	prj2 = SRS(crs2).getOgrSpatialRef()
-	wkt2 = prj2.ExportToWkt()
-	ds2.SetProjection(wkt2)
-
-	#Perform the projection/resampling
-	# Resample algo
-	if resamplAlg == 'NN' : alg = gdal.GRA_NearestNeighbour
-	elif resamplAlg == 'BL' : alg = gdal.GRA_Bilinear
-	elif resamplAlg == 'CB' : alg = gdal.GRA_Cubic
-	elif resamplAlg == 'CBS' : alg = gdal.GRA_CubicSpline
-	elif resamplAlg == 'LCZ' : alg = gdal.GRA_Lanczos
-	# Memory limit (0 = no limit)
-	memLimit = 0
-	# Error in pixels (0 will use the exact transformer)
-	threshold = 0.25
-	# Warp options (http://www.gdal.org/structGDALWarpOptions.html)
-	opt = ['NUM_THREADS=ALL_CPUS, SAMPLE_GRID=YES']
-	gdal.ReprojectImage( ds1, ds2, wkt1, wkt2, alg, memLimit, threshold)#, options=opt) #option parameter start with gdal 2.1
-
-	#Convert to PIL image
-	data = ds2.ReadAsArray()
-	data = np.rollaxis(data, 0, 3) # because first axis is band index
-	img = Image.fromarray(data, 'RGBA')
-
-	#Close gdal datasets
-	ds1 = None
-	ds2 = None
-
-	return GeoImage(img, (xmin, ymax), res)
+	return ImgWarper.get(crs1, crs2, resamplAlg).warp(geoimg, out_ul, out_size, out_res)
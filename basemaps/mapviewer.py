@@ -33,7 +33,8 @@ import blf, bgl
 
 #addon import
 from .servicesDefs import GRIDS, SOURCES
-from .mapservice import MapService, PILLOW
+from .mapservice import MapService, GeoPackage, NpImgWarper, PILLOW
+from .prefetch import TilesPrefetcher
 
 #bgis imports
 from ..geoscene import GeoScene, SK, georefManagerLayout
@@ -71,8 +72,20 @@ class BaseMap(GeoScene):
 		#Get resampling algo preference and set the constant
 		MapService.RESAMP_ALG = prefs.resamplAlg
 
-		#Init MapService class
-		self.srv = MapService(srckey, folder)
+		#Set tiles downloading engine
+		MapService.FETCH_ENGINE = prefs.fetchEngine
+
+		#Set the max size of cache files
+		GeoPackage.MAX_SIZE = prefs.cacheMaxSize * 1024**2
+
+		#Set the storage layout of new cache files
+		GeoPackage.DEDUP = prefs.cacheDedup
+
+		#Set the max size of decoded tiles memory cache
+		MapService.MEM_CACHE.resize(prefs.memCacheSize * 1024**2)
+
+		#Get the shared MapService of this source and destination grid
+		self.srv = MapService.get(srckey, folder, grdkey)
 
 		#Set destination tile matrix
 		if grdkey is None:
@@ -80,8 +93,6 @@ class BaseMap(GeoScene):
 		if grdkey == self.srv.srcGridKey:
 			self.tm = self.srv.srcTms
 		else:
-			#Define destination grid in map service
-			self.srv.setDstGrid(grdkey)
 			self.tm = self.srv.dstTms
 
 		#Init some geoscene props if needed
@@ -100,6 +111,13 @@ class BaseMap(GeoScene):
 		#Get layer def obj
 		self.layer = self.srv.layers[laykey]
 
+		#Init background prefetcher, its map service shares the caches of the viewer one
+		#but has its own request generation (so that it can be stopped independently)
+		if prefs.prefetch:
+			self.prefetcher = TilesPrefetcher(self.srv.fork(), laykey, maxTiles=prefs.prefetchMaxTiles)
+		else:
+			self.prefetcher = None
+
 		#map keys
 		self.srckey = srckey
 		self.laykey = laykey
@@ -107,6 +125,9 @@ class BaseMap(GeoScene):
 
 		#Thread attributes
 		self.thread = None
+		#Last mosaic saved by a thread (generation, mosaic), placed by update() on the UI thread
+		self.result = None
+		self._resultLock = threading.Lock()
 		#Background image attributes
 		self.img = None #bpy image
 		self.bkg = None #bpy background
@@ -116,31 +137,65 @@ class BaseMap(GeoScene):
 
 
 	def get(self):
-		'''Launch run() function in a new thread'''
-		self.stop()
-		self.srv.running = True
-		self.thread = threading.Thread(target=self.run)
+		'''
+		Launch run() function in a new thread
+		The previous request becomes outdated and is dropped by its own thread, it's not waited for.
+		Its tiles still downloading are shared with the new request instead of being downloaded again
+		The mosaic is placed as background image by update(), called by the modal timer
+		'''
+		if self.prefetcher is not None:
+			self.prefetcher.stop()
+		generation = self.srv.newRequest()
+		self.thread = threading.Thread(target=self.run, args=(generation,))
+		self.thread.setDaemon(True)
 		self.thread.start()
 
 	def stop(self):
-		'''Stop actual thread'''
-		if self.srv.running:
-			self.srv.running = False
-			self.thread.join()
+		'''Stop actual thread, without waiting for it'''
+		if self.prefetcher is not None:
+			self.prefetcher.stop()
+		self.srv.cancel()
 
-	def run(self):
+	def run(self, generation):
 		"""thread method"""
-		self.mosaic = self.request()
-		if self.srv.running and self.mosaic is not None:
-			#save image
-			self.mosaic.save(self.imgPath)
-		if self.srv.running:
+		mosaic = self.request()
+		if not self.srv.isAlive(generation) or mosaic is None:
+			return
+		#encode the image off the UI thread, in a file of this generation renamed once the request is checked
+		tmpPath = self.imgPath + '.' + str(generation) + '.tmp'
+		mosaic.save(tmpPath, format='PNG')
+		#blender data are only updated by the UI thread, see update()
+		with self._resultLock:
+			if self.srv.isAlive(generation):
+				os.replace(tmpPath, self.imgPath)
+				self.result = (generation, mosaic)
+				return
+		os.remove(tmpPath)
+
+	def update(self):
+		'''
+		Place the mosaic saved by the last thread, if its request is still the current one
+		Must be called from the UI thread (modal timer), return True if the background image has changed
+		'''
+		#the lock prevents a newer thread to replace the image file before it's reloaded
+		with self._resultLock:
+			result, self.result = self.result, None
+			if result is None:
+				return False
+			generation, mosaic = result
+			if not self.srv.isAlive(generation):
+				return False
+			self.mosaic = mosaic
 			#Place background image
 			self.place()
+		if self.prefetcher is not None:
+			#Warm the cache with neighbouring tiles
+			self.prefetcher.start(self.bbox, self.zoom, self.toDstGrid)
+		return True
 
 	def progress(self):
-		'''Report thread download progress'''
-		return self.srv.cptTiles, self.srv.nbTiles
+		'''Report thread download progress (done, total, tiles/s, remaining seconds or None)'''
+		return self.srv.getProgress()
 
 	def view3dToProj(self, dx, dy):
 		'''Convert view3d coords to crs coords'''
@@ -195,7 +250,10 @@ class BaseMap(GeoScene):
 		else:
 			toDstGrid = True
 
-		mosaic = self.srv.getImage(self.laykey, bbox, self.zoom, toDstGrid, outCRS=self.crs)
+		#Store the request, prefetching will be based on it
+		self.bbox, self.toDstGrid = bbox, toDstGrid
+
+		mosaic = self.srv.getImage(self.laykey, bbox, self.zoom, toDstGrid, outCRS=self.crs, incremental=True)
 
 		return mosaic
 
@@ -296,9 +354,13 @@ def drawInfosText(self, context):
 	#Draw other texts
 	blf.size(font_id, 12, 72)
 	# thread progress
-	blf.position(font_id, cx-45, 90, 0)
 	if self.nbTotal > 0:
-		blf.draw(font_id, '(Downloading... ' + str(self.nb)+'/'+str(self.nbTotal) + ')')
+		txt = '(Downloading... ' + str(self.nb)+'/'+str(self.nbTotal)
+		if self.rate > 0:
+			txt += ' - {:.1f} tiles/s - ETA {:.0f}s'.format(self.rate, self.eta)
+		txt += ')'
+		blf.position(font_id, cx - blf.dimensions(font_id, txt)[0] / 2, 90, 0)
+		blf.draw(font_id, txt)
 	# zoom and scale values
 	blf.position(font_id, cx-50, 50, 0)
 	blf.draw(font_id, "Zoom " + str(zoom) + " - Scale 1:" + str(int(scale)))
@@ -446,13 +508,12 @@ class MAP_START(bpy.types.Operator):
 			layout.prop(self, 'src', text='Source')
 			layout.prop(self, 'lay', text='Layer')
 			col = layout.column()
-			if not GDAL:
-				col.enabled = False
+			srcCRS = GRIDS[SOURCES[self.src]['grid']]['CRS']
+			grdCRS = GRIDS[self.grd]['CRS']
+			if not GDAL and srcCRS != grdCRS and not NpImgWarper.validate(srcCRS, grdCRS):
+				#without gdal, only Web Mercator, WGS84 and UTM are supported
 				col.label('(No raster reprojection support)')
 			col.prop(self, 'grd', text='Tile matrix set')
-
-			#srcCRS = GRIDS[SOURCES[self.src]['grid']]['CRS']
-			grdCRS = GRIDS[self.grd]['CRS']
 			row = layout.row()
 			#row.alignment = 'RIGHT'
 			desc = PredefCRS.getName(grdCRS)
@@ -512,7 +573,11 @@ class MAP_START(bpy.types.Operator):
 			#if not geoscn.hasCRS:
 				#geoscn.crs = grdCRS
 			#Check if raster reproj is needed
-			if geoscn.hasCRS and geoscn.crs != grdCRS and not GDAL:
+			srcCRS = GRIDS[SOURCES[self.src]['grid']]['CRS']
+			needReproj = [(srcCRS, grdCRS)]
+			if geoscn.hasCRS:
+				needReproj.append( (grdCRS, geoscn.crs) )
+			if not GDAL and any(crs1 != crs2 and not NpImgWarper.validate(crs1, crs2) for crs1, crs2 in needReproj):
 				self.report({'ERROR'}, "Please install gdal to enable raster reprojection support")
 				return {'FINISHED'}
 
@@ -592,7 +657,7 @@ class MAP_VIEWER(bpy.types.Operator):
 		# mouse crs coordinates reported in draw callback
 		self.posx, self.posy = 0, 0
 		# thread progress infos reported in draw callback
-		self.nb, self.nbTotal = 0, 0
+		self.nb, self.nbTotal, self.rate, self.eta = 0, 0, 0, None
 		# Zoom box
 		self.zoomBoxMode = False
 		self.zoomBoxDrag = False
@@ -640,8 +705,10 @@ class MAP_VIEWER(bpy.types.Operator):
 		scn = bpy.context.scene
 
 		if event.type == 'TIMER':
+			#place the mosaic built by the thread, if any
+			self.map.update()
 			#report thread progression
-			self.nb, self.nbTotal = self.map.progress()
+			self.nb, self.nbTotal, self.rate, self.eta = self.map.progress()
 			return {'PASS_THROUGH'}
 
 
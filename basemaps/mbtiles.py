@@ -0,0 +1,200 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+# MBTiles export and import of the GeoPackage tiles cache
+# https://github.com/mapbox/mbtiles-spec/blob/master/1.3/spec.md
+# MBTiles only support the Web Mercator grid and its rows are numbered from the south (TMS scheme),
+# rows of caches built on a grid with a north west origin are flipped on the fly.
+# Tiles are streamed by batches inside one transaction, so memory usage doesn't depend on the number of tiles.
+#
+# Command line usage, with the python bundled with Blender :
+# blender -b --python-expr "import sys;from BlenderGIS.basemaps import mbtiles;mbtiles.main(sys.argv[sys.argv.index('--')+1:])" -- export OSM MAPNIK /path/to/file.mbtiles --cache /path/to/cache
+
+#built-in imports
+import os
+import time
+import imghdr
+import sqlite3
+import argparse
+
+#addon import
+from .servicesDefs import GRIDS, SOURCES
+from .mapservice import MapService
+
+
+BATCH_SIZE = 10000 #number of rows fetched and inserted at once
+
+
+def _rowFlipper(tm):
+	'''
+	Return a function converting a row number between the grid convention and the MBTiles one
+	The conversion is its own inverse, so the same function is used for export and import
+	'''
+	if tm.originLoc == 'SW':
+		return lambda row, zoom: row
+	heights = [tm.getMatrixSize(z)[1] for z in range(tm.nbLevels)]
+	return lambda row, zoom: heights[zoom] - 1 - row
+
+def _checkGrid(tm):
+	if tm.CRS != 'EPSG:3857' or tm.tileSize != 256:
+		raise ValueError('MBTiles only support the 256px Web Mercator grid')
+
+def _report(nbDone, t0):
+	t = max(time.time() - t0, 1e-6)
+	print('{} tiles - {:.0f} tiles/s'.format(nbDone, nbDone / t))
+
+
+def exportMBTiles(cache, tm, path, name=None, description='', overwrite=False, batchSize=BATCH_SIZE, report=True):
+	'''
+	Write the tiles of a GeoPackage cache to a new MBTiles file
+	tm is the tile matrix of the cache, expired tiles are not exported
+	Return the number of exported tiles
+	'''
+	_checkGrid(tm)
+	if os.path.exists(path):
+		if not overwrite:
+			raise FileExistsError(path)
+		os.remove(path)
+	flipRow = _rowFlipper(tm)
+
+	src = cache.getConnection()
+	zmin, zmax = src.execute("SELECT MIN(zoom_level), MAX(zoom_level) FROM gpkg_tiles").fetchone()
+	first = src.execute("SELECT tile_data FROM gpkg_tiles LIMIT 1").fetchone()
+	fmt = 'png'
+	if first is not None and imghdr.what(None, first[0]) == 'jpeg':
+		fmt = 'jpg'
+	lonMin, latMin = tm.projToGeo(tm.xmin, tm.ymin)
+	lonMax, latMax = tm.projToGeo(tm.xmax, tm.ymax)
+
+	dst = sqlite3.connect(path)
+	#the file is new, if the export fails it must be done again anyway
+	dst.execute("PRAGMA synchronous=OFF")
+	dst.execute("PRAGMA journal_mode=MEMORY")
+	dst.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+	dst.execute("""CREATE TABLE tiles (
+			zoom_level INTEGER,
+			tile_column INTEGER,
+			tile_row INTEGER,
+			tile_data BLOB)""")
+	dst.execute("CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)")
+	metadata = {
+		'name': name or cache.name,
+		'description': description,
+		'format': fmt,
+		'type': 'baselayer',
+		'version': '1.0',
+		'bounds': ','.join(map(str, (lonMin, latMin, lonMax, latMax)))
+	}
+	if zmin is not None:
+		metadata['minzoom'] = str(zmin)
+		metadata['maxzoom'] = str(zmax)
+	dst.executemany("INSERT INTO metadata (name, value) VALUES (?,?)", metadata.items())
+
+	#rows are read in the order of the unique index, so they are appended to the destination index
+	query = """SELECT zoom_level, tile_column, tile_row, tile_data FROM gpkg_tiles
+		WHERE last_modified > datetime('now', 'localtime', ?)
+		ORDER BY zoom_level, tile_column, tile_row"""
+	cursor = src.execute(query, (cache._expiryModifier,))
+	nbDone, t0 = 0, time.time()
+	try:
+		while True:
+			rows = cursor.fetchmany(batchSize)
+			if not rows:
+				break
+			dst.executemany("INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?,?,?,?)",
+				[(z, x, flipRow(y, z), data) for z, x, y, data in rows])
+			nbDone += len(rows)
+			if report:
+				_report(nbDone, t0)
+		dst.commit()
+	finally:
+		cursor.close()
+		dst.close()
+	return nbDone
+
+
+def importMBTiles(path, cache, tm, overwrite=True, batchSize=BATCH_SIZE, report=True):
+	'''
+	Load the tiles of a MBTiles file into a GeoPackage cache built on the tile matrix tm
+	Existing tiles are replaced if overwrite is True, kept otherwise
+	Return the number of imported tiles
+	'''
+	_checkGrid(tm)
+	if not os.path.exists(path):
+		raise FileNotFoundError(path)
+	flipRow = _rowFlipper(tm)
+
+	src = sqlite3.connect(path)
+	dst = cache.getConnection()
+	if overwrite:
+		query = "INSERT OR REPLACE INTO gpkg_tiles (tile_column, tile_row, zoom_level, tile_data, last_access) VALUES (?,?,?,?,?)"
+	else:
+		query = "INSERT OR IGNORE INTO gpkg_tiles (tile_column, tile_row, zoom_level, tile_data, last_access) VALUES (?,?,?,?,?)"
+	cursor = src.execute("""SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles
+		WHERE zoom_level < ? ORDER BY zoom_level, tile_column, tile_row""", (tm.nbLevels,))
+	nbDone, t0 = 0, time.time()
+	now = int(time.time())
+	try:
+		while True:
+			rows = cursor.fetchmany(batchSize)
+			if not rows:
+				break
+			dst.executemany(query, [(x, flipRow(y, z), z, data, now) for z, x, y, data in rows])
+			nbDone += len(rows)
+			if report:
+				_report(nbDone, t0)
+		dst.commit()
+	except:
+		dst.rollback()
+		raise
+	finally:
+		cursor.close()
+		src.close()
+	return nbDone
+
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(description='Export or import BlenderGIS basemaps cache as MBTiles')
+	parser.add_argument('action', choices=['export', 'import'])
+	parser.add_argument('source', choices=list(SOURCES.keys()), help='map service source key')
+	parser.add_argument('layer', help='layer key')
+	parser.add_argument('mbtiles', help='path of the MBTiles file')
+	parser.add_argument('--grid', choices=list(GRIDS.keys()), help='tile matrix key (default to the source grid)')
+	parser.add_argument('--cache', required=True, help='cache folder')
+	parser.add_argument('--overwrite', action='store_true', help='replace the existing MBTiles file (export) or the existing tiles (import)')
+	args = parser.parse_args(args)
+
+	srv = MapService(args.source, os.path.join(args.cache, ''), args.grid)
+	if args.layer not in srv.layers:
+		parser.error('unknown layer ' + args.layer + ', choose from ' + ', '.join(srv.layers.keys()))
+	toDstGrid = srv.dstGridKey is not None
+	cache = srv.getCache(args.layer, toDstGrid)
+	tm = srv.dstTms if toDstGrid else srv.srcTms
+	try:
+		if args.action == 'export':
+			exportMBTiles(cache, tm, args.mbtiles, overwrite=args.overwrite)
+		else:
+			importMBTiles(args.mbtiles, cache, tm, overwrite=args.overwrite)
+	finally:
+		srv.close()
+
+
+if __name__ == '__main__':
+	main()
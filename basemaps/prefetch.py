@@ -0,0 +1,121 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+#built-in imports
+import threading
+
+#deps imports
+import numpy as np
+
+
+class TilesPrefetcher():
+	'''
+	Warm the GeoPackage cache with the tiles the user is likely to request next :
+	a ring of tiles around the current view and the tiles of the same view at zoom +1 and -1
+	Prefetching runs in a background thread with few downloading workers and stops
+	as soon as the budget is spent or when the view changes.
+
+	srv must be a MapService instance dedicated to the prefetcher, because the running
+	flag of the map service is used to cancel the downloads. Use MapService.fork() to get one
+	sharing the caches of the viewer map service. Each prefetching is a new request
+	generation of this map service, so an outdated prefetching stops by itself and never has to be waited for.
+	'''
+
+	BATCH_SIZE = 32 #number of tiles requested to the map service at once
+
+	def __init__(self, srv, laykey, ringSize=1, maxTiles=500, maxBytes=50*1024**2, nbThread=2):
+		self.srv = srv
+		self.laykey = laykey
+		self.ringSize = ringSize #width of the ring in number of tiles
+		self.maxTiles = maxTiles #max number of tiles downloaded for one view
+		self.maxBytes = maxBytes #max number of bytes downloaded for one view
+		self.nbThread = nbThread
+
+		self.thread = None
+		self.nbTiles = 0
+		self.nbBytes = 0
+
+
+	def listTiles(self, bbox, zoom, toDstGrid):
+		'''Return the list of tiles to prefetch ordered by priority'''
+		if toDstGrid:
+			tm = self.srv.dstTms
+		else:
+			tm = self.srv.srcTms
+		lay = self.srv.layers[self.laykey]
+
+		#ring around the view
+		colMin, rowMin, colMax, rowMax = tm.getTileRange(bbox, zoom)
+		w, h = tm.getMatrixSize(zoom)
+		n = self.ringSize
+		cols = np.arange(max(0, colMin-n), min(w-1, colMax+n) + 1)
+		rows = np.arange(max(0, rowMin-n), min(h-1, rowMax+n) + 1)
+		cols, rows = np.repeat(cols, len(rows)), np.tile(rows, len(cols))
+		ring = (cols < colMin) | (cols > colMax) | (rows < rowMin) | (rows > rowMax)
+		tiles = list(zip(cols[ring].tolist(), rows[ring].tolist(), [zoom] * int(ring.sum())))
+
+		#same view at next and previous zoom levels
+		xmin, ymin, xmax, ymax = bbox
+		cx, cy = (xmin + xmax) / 2, (ymin + ymax) / 2
+		dx, dy = (xmax - xmin) / 2, (ymax - ymin) / 2
+		for z in (zoom + 1, zoom - 1):
+			if z < max(0, lay.zmin) or z > min(lay.zmax, tm.nbLevels - 1):
+				continue
+			fac = tm.getRes(z) / tm.getRes(zoom)
+			_bbox = (cx - dx * fac, cy - dy * fac, cx + dx * fac, cy + dy * fac)
+			cols, rows = tm.getTilesArray(_bbox, z)
+			tiles.extend(zip(cols.tolist(), rows.tolist(), [z] * len(cols)))
+
+		return tiles
+
+
+	def start(self, bbox, zoom, toDstGrid):
+		'''Cancel the previous prefetching and launch a new one for the given view'''
+		generation = self.srv.newRequest()
+		self.thread = threading.Thread(target=self.run, args=(bbox, zoom, toDstGrid, generation))
+		self.thread.setDaemon(True)
+		self.thread.start()
+
+	def stop(self):
+		'''Cancel the prefetching, without waiting for the thread'''
+		self.srv.cancel()
+
+	def run(self, bbox, zoom, toDstGrid, generation):
+		'''thread method'''
+		nbTiles, nbBytes = 0, 0
+
+		def spend(tile):
+			'''Called for each downloaded tile, cancel prefetching when the budget is exceeded'''
+			nonlocal nbTiles, nbBytes
+			data = tile[3]
+			if data is not None:
+				nbTiles += 1
+				nbBytes += len(data)
+			self.nbTiles, self.nbBytes = nbTiles, nbBytes
+			if nbTiles >= self.maxTiles or nbBytes >= self.maxBytes:
+				self.srv.cancel(generation)
+
+		tiles = self.listTiles(bbox, zoom, toDstGrid)
+		for i in range(0, len(tiles), self.BATCH_SIZE):
+			if not self.srv.isAlive(generation):
+				break
+			batch = tiles[i:i+self.BATCH_SIZE]
+			self.srv.getTiles(self.laykey, batch, [], toDstGrid, useCache=True, nbThread=self.nbThread, cpt=False, callback=spend)
+
+		self.srv.cancel(generation)
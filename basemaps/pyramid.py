@@ -0,0 +1,315 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+# Offline overviews
+# Build the coarser zoom levels of a GeoPackage cache from its finer levels, so an area seeded
+# at a high zoom level can be displayed at lower levels without requesting the map service.
+# Building is incremental : a tile is rebuilt only if it's missing or older than one of its children.
+# Built tiles take the modification date of their newest child, so the comparison doesn't depend on
+# when the pyramid was built and built tiles expire with the tiles they are made of.
+# A tile is built from its children alone if it's missing, if it was built by the pyramid builder or if
+# all its children exist. Otherwise (a downloaded tile whose level below is partly seeded), the children
+# are composited over the existing tile, so that its areas without children are kept.
+#
+# Command line usage, with the python bundled with Blender :
+# blender -b --python-expr "import sys;from BlenderGIS.basemaps import pyramid;pyramid.main(sys.argv[sys.argv.index('--')+1:])" -- OSM MAPNIK --zmin 10 --cache /path/to/cache
+
+#built-in imports
+import os
+import io
+import time
+import argparse
+import concurrent.futures
+
+#deps imports
+import numpy as np
+from PIL import Image
+
+#addon import
+from .servicesDefs import GRIDS, SOURCES
+from .mapservice import MapService
+
+
+RESAMPLING = ('BOX', 'LANCZOS')
+
+_weights = {} #lanczos weights matrices by (factor, tileSize), computed once per process
+
+def lanczosWeights(k, tileSize, a=3):
+	'''
+	Return the (tileSize, k*tileSize) matrix of the lanczos filter reducing k*tileSize pixels to tileSize
+	Rows are normalized, so the kernel is truncated and weighted again at the image borders
+	'''
+	w = _weights.get((k, tileSize))
+	if w is None:
+		#source pixels centers in destination pixels units
+		src = (np.arange(k * tileSize) + 0.5) / k
+		dst = np.arange(tileSize) + 0.5
+		d = src[None, :] - dst[:, None]
+		w = np.sinc(d) * np.sinc(d / a)
+		w[np.abs(d) >= a] = 0
+		w /= w.sum(axis=1, keepdims=True)
+		w = _weights[(k, tileSize)] = w.astype(np.float32)
+	return w
+
+def decodeTile(data, tileSize):
+	'''Return the RGBA array of a tile, or None if it can't be decoded or has not the expected size'''
+	try:
+		img = Image.open(io.BytesIO(data)).convert('RGBA')
+	except Exception:
+		return None
+	if img.size != (tileSize, tileSize):
+		return None
+	return np.asarray(img)
+
+def buildTile(children, k, tileSize, resampling='BOX', base=None):
+	'''
+	Build a tile from its k*k children [(i, j, data)] where i, j are the column and line of
+	the child in the mosaic (from the top left). Missing children are transparent, or taken from
+	the upsampled base tile if its data is given (the existing tile the children are composited over)
+	Return PNG bytes or None if no child can be decoded
+	This function is run by the workers of the process pool
+	'''
+	mosaic = np.zeros((k * tileSize, k * tileSize, 4), dtype=np.float32)
+	if base is not None:
+		a = decodeTile(base, tileSize)
+		if a is not None:
+			mosaic[...] = a.repeat(k, axis=0).repeat(k, axis=1)
+	valid = False
+	for i, j, data in children:
+		a = decodeTile(data, tileSize)
+		if a is None:
+			continue
+		mosaic[j*tileSize:(j+1)*tileSize, i*tileSize:(i+1)*tileSize] = a
+		valid = True
+	if not valid:
+		return None
+
+	#filter colors premultiplied by alpha, otherwise transparent pixels would darken the borders
+	alpha = mosaic[:, :, 3:] / 255
+	mosaic[:, :, :3] *= alpha
+
+	if resampling == 'LANCZOS':
+		w = lanczosWeights(k, tileSize)
+		tile = np.tensordot(w, mosaic, axes=(1, 0)) #reduce lines
+		tile = np.tensordot(tile, w, axes=(1, 1)).transpose(0, 2, 1) #reduce columns
+	else: #BOX
+		tile = mosaic.reshape(tileSize, k, tileSize, k, 4).mean(axis=(1, 3))
+
+	alpha = tile[:, :, 3:]
+	tile[:, :, :3] *= np.where(alpha > 0, 255 / np.maximum(alpha, 1e-6), 0)
+	tile = np.clip(np.rint(tile), 0, 255).astype(np.uint8)
+
+	b = io.BytesIO()
+	Image.fromarray(tile).save(b, format='PNG')
+	return b.getvalue()
+
+
+
+class PyramidBuilder():
+	'''
+	Build the overviews of a GeoPackage cache built on the tile matrix tm
+	Tiles are decoded, downsampled and encoded by a pool of processes (nbProcess, None means
+	the number of cpus, zero to work in the calling process), the database is only accessed
+	by the calling process. Levels whose resolution is not an integer multiple of the next
+	level resolution are skipped.
+	Built tiles are listed with their modification date in the bgis_pyramid_tiles table, a tile
+	replaced since (downloaded...) has another date and is no longer considered as built.
+	'''
+
+	def __init__(self, cache, tm, resampling='BOX', nbProcess=None, batchSize=64):
+		if resampling not in RESAMPLING:
+			raise ValueError('Unknown resampling method ' + resampling)
+		self.cache = cache
+		self.tm = tm
+		self.resampling = resampling
+		self.nbProcess = nbProcess
+		self.batchSize = batchSize
+
+		#stats
+		self.nbDone = 0
+		self.nbBuilt = 0
+		self.t0 = None
+
+
+	def getFactor(self, zoom):
+		'''Return the integer ratio between the resolutions of zoom and zoom+1, or None'''
+		k = self.tm.getRes(zoom) / self.tm.getRes(zoom + 1)
+		if abs(k - round(k)) > 1e-6 or round(k) < 2:
+			return None
+		return int(round(k))
+
+	def createBuiltTable(self):
+		db = self.cache.getConnection()
+		db.execute("""CREATE TABLE IF NOT EXISTS bgis_pyramid_tiles (
+				zoom_level INTEGER NOT NULL,
+				tile_column INTEGER NOT NULL,
+				tile_row INTEGER NOT NULL,
+				last_modified TIMESTAMP NOT NULL,
+				PRIMARY KEY (zoom_level, tile_column, tile_row)) WITHOUT ROWID""")
+		db.commit()
+
+	def iterDirtyTiles(self, zoom, k):
+		'''
+		Enumerate by batches the tiles (x,y,date,rebuild) of zoom level to build : tiles missing or older than
+		one of their children, date is the modification date of the newest child. rebuild is True if the tile
+		is built from its children alone : it's missing, it has been built by the pyramid builder or all its
+		children exist. Otherwise the children must be composited over the existing tile
+		Child tiles share the origin of the matrix so the parent of a child is its number divided by k
+		'''
+		db = self.cache.getConnection()
+		query = """SELECT c.tile_column / :k AS x, c.tile_row / :k AS y, MAX(c.last_modified),
+			MAX(p.last_modified) IS NULL OR MAX(p.last_modified) = MAX(b.last_modified) OR COUNT(*) = :k * :k
+			FROM gpkg_tiles AS c
+			LEFT JOIN gpkg_tiles AS p
+			ON p.zoom_level = :zp AND p.tile_column = c.tile_column / :k AND p.tile_row = c.tile_row / :k
+			LEFT JOIN bgis_pyramid_tiles AS b
+			ON b.zoom_level = :zp AND b.tile_column = c.tile_column / :k AND b.tile_row = c.tile_row / :k
+			WHERE c.zoom_level = :zc
+			GROUP BY x, y
+			HAVING MAX(p.last_modified) IS NULL OR MAX(c.last_modified) > MAX(p.last_modified)"""
+		cursor = db.execute(query, {'k': k, 'zp': zoom, 'zc': zoom + 1})
+		try:
+			while True:
+				rows = cursor.fetchmany(self.batchSize)
+				if not rows:
+					break
+				yield [ (x, y, date, bool(rebuild)) for x, y, date, rebuild in rows ]
+		finally:
+			cursor.close()
+
+	def getChildren(self, tiles, zoom, k):
+		'''Return the arguments (children, base) of buildTile() for each tile (x,y,date,rebuild) of zoom level'''
+		childs = [ (x*k + i, y*k + j, zoom + 1) for x, y, date, rebuild in tiles for i in range(k) for j in range(k) ]
+		bases = [ (x, y, zoom) for x, y, date, rebuild in tiles if not rebuild ]
+		data = { t[:3]: t[3] for t in self.cache.getTiles(childs + bases) }
+		args = []
+		for x, y, date, rebuild in tiles:
+			children = []
+			for i in range(k):
+				for j in range(k):
+					d = data.get((x*k + i, y*k + j, zoom + 1))
+					if d is None:
+						continue
+					#children rows are numbered from the bottom on a south west grid
+					line = j if self.tm.originLoc == 'NW' else k - 1 - j
+					children.append((i, line, d))
+			args.append( (children, None if rebuild else data.get((x, y, zoom))) )
+		return args
+
+	def putTiles(self, tiles):
+		'''
+		Write built tiles [(x,y,z,data,date,rebuild)] with the modification date of their newest child
+		Tiles built from their children alone are listed as built, those composited over an existing tile are not
+		'''
+		db = self.cache.getConnection()
+		query = """INSERT OR REPLACE INTO gpkg_tiles
+		(tile_column, tile_row, zoom_level, tile_data, last_modified, last_access) VALUES (?,?,?,?,?,?)"""
+		now = int(time.time())
+		db.executemany(query, [t[:5] + (now,) for t in tiles])
+		db.executemany("INSERT OR REPLACE INTO bgis_pyramid_tiles (tile_column, tile_row, zoom_level, last_modified) VALUES (?,?,?,?)",
+			[ (x, y, z, date) for x, y, z, data, date, rebuild in tiles if rebuild ])
+		db.executemany("DELETE FROM bgis_pyramid_tiles WHERE tile_column=? AND tile_row=? AND zoom_level=?",
+			[ (x, y, z) for x, y, z, data, date, rebuild in tiles if not rebuild ])
+		db.commit()
+
+
+	def report(self, z):
+		t = max(time.time() - self.t0, 1e-6)
+		print('Building z{} : {} tiles ({} built) - {:.1f} tiles/s'.format(z, self.nbDone, self.nbBuilt, self.nbDone / t))
+
+	def build(self, zmin, zmax=None, report=True):
+		'''
+		Build the levels from zmax - 1 to zmin, zmax defaults to the finest level in the cache
+		Return the number of built tiles
+		'''
+		if zmax is None:
+			self.cache.flush()
+			db = self.cache.getConnection()
+			zmax = db.execute("SELECT MAX(zoom_level) FROM gpkg_tiles").fetchone()[0]
+			if zmax is None:
+				return 0
+		zmin = max(zmin, 0)
+		zmax = min(zmax, self.tm.nbLevels - 1)
+		self.nbDone, self.nbBuilt, self.t0 = 0, 0, time.time()
+		self.createBuiltTable()
+
+		if self.nbProcess == 0:
+			executor = None
+		else:
+			executor = concurrent.futures.ProcessPoolExecutor(self.nbProcess)
+		try:
+			#built tiles are newer than the tiles of the previous level, which are rebuilt in turn
+			for z in range(zmax - 1, zmin - 1, -1):
+				k = self.getFactor(z)
+				if k is None:
+					print('Skip z{} : resolution is not a multiple of the next level resolution'.format(z))
+					continue
+				tileSize = self.tm.tileSize
+				#tiles queued in the cache background writer are committed first, so that a pending download
+				#is neither ignored by the scan nor written over a tile built meanwhile
+				self.cache.flush()
+				#the whole level is listed first because the query reads the table that is updated
+				dirty = [tiles for tiles in self.iterDirtyTiles(z, k)]
+				for tiles in dirty:
+					args = self.getChildren(tiles, z, k)
+					n = len(args)
+					children, bases = [a[0] for a in args], [a[1] for a in args]
+					if executor is None:
+						result = map(buildTile, children, [k]*n, [tileSize]*n, [self.resampling]*n, bases)
+					else:
+						result = executor.map(buildTile, children, [k]*n, [tileSize]*n, [self.resampling]*n, bases)
+					built = [ (x, y, z, data, date, rebuild) for (x, y, date, rebuild), data in zip(tiles, result) if data is not None ]
+					self.putTiles(built)
+					self.nbDone += n
+					self.nbBuilt += len(built)
+				if report:
+					self.report(z)
+		finally:
+			if executor is not None:
+				executor.shutdown()
+		return self.nbBuilt
+
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(description='Build the overviews of a BlenderGIS basemaps cache')
+	parser.add_argument('source', choices=list(SOURCES.keys()), help='map service source key')
+	parser.add_argument('layer', help='layer key')
+	parser.add_argument('--grid', choices=list(GRIDS.keys()), help='tile matrix key (default to the source grid)')
+	parser.add_argument('--zmin', type=int, required=True, help='coarsest level to build')
+	parser.add_argument('--zmax', type=int, help='finest level to read (default to the finest level in the cache)')
+	parser.add_argument('--cache', required=True, help='cache folder')
+	parser.add_argument('--resampling', choices=RESAMPLING, default='BOX')
+	parser.add_argument('--processes', type=int, help='number of worker processes (default to the number of cpus)')
+	args = parser.parse_args(args)
+
+	srv = MapService(args.source, os.path.join(args.cache, ''), args.grid)
+	if args.layer not in srv.layers:
+		parser.error('unknown layer ' + args.layer + ', choose from ' + ', '.join(srv.layers.keys()))
+	toDstGrid = srv.dstGridKey is not None
+	tm = srv.dstTms if toDstGrid else srv.srcTms
+	builder = PyramidBuilder(srv.getCache(args.layer, toDstGrid), tm, args.resampling, args.processes)
+	try:
+		builder.build(args.zmin, args.zmax)
+	finally:
+		srv.close()
+
+
+if __name__ == '__main__':
+	main()
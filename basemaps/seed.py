@@ -0,0 +1,276 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+# Offline tiles seeding
+# Download all the tiles of an area for a range of zoom levels into the GeoPackage cache.
+# Progress is journaled in the GeoPackage so an interrupted seeding resumes where it stopped.
+# Tiles that keep failing are journaled too, they are skipped and requested again on resume.
+#
+# Command line usage, with the python bundled with Blender :
+# blender -b --python-expr "import sys;from BlenderGIS.basemaps import seed;seed.main(sys.argv[sys.argv.index('--')+1:])" -- OSM MAPNIK --bbox 5.8 45.1 6.0 45.3 --zmin 10 --zmax 16 --cache /path/to/cache
+
+#built-in imports
+import os
+import time
+import argparse
+
+#deps imports
+import numpy as np
+
+#addon import
+from .servicesDefs import GRIDS, SOURCES
+from .mapservice import MapService
+
+from ..utils.proj import reprojBbox
+
+
+class TilesSeeder():
+	'''
+	Seed the cache of a map service layer
+	Tiles are requested by batches through MapService.getTiles, so each batch is downloaded
+	with bounded concurrency (nbThread) and committed to the cache by its background writer
+	The progress journal only moves over tiles which are cached or known to be missing on the server,
+	failed tiles are requested again after the cooldown of the circuit breaker if it's open.
+	Tiles still failing after MAX_STALLS attempts are given up : they are journaled as failed so that
+	seeding goes on, and they are requested again when the job is resumed
+	'''
+
+	MAX_STALLS = 3 #consecutive batches without progress before the failing tiles are given up
+
+	def __init__(self, srv, laykey, toDstGrid=False, nbThread=8, batchSize=256):
+		self.srv = srv
+		self.laykey = laykey
+		self.toDstGrid = toDstGrid
+		self.nbThread = nbThread
+		self.batchSize = batchSize
+
+		if toDstGrid:
+			self.tm = srv.dstTms
+		else:
+			self.tm = srv.srcTms
+
+		#stats
+		self.nbDone = 0
+		self.nbTotal = 0
+		self.nbDownloaded = 0
+		self.nbFailed = 0
+		self.nbBytes = 0
+		self.t0 = None
+
+
+	def getRanges(self, bbox, zmin, zmax):
+		'''Return [(zoom, colMin, rowMin, colMax, rowMax)] for each zoom level in the seeding range'''
+		lay = self.srv.layers[self.laykey]
+		zmin = max(zmin, lay.zmin, 0)
+		zmax = min(zmax, lay.zmax, self.tm.nbLevels - 1)
+		return [ (z,) + self.tm.getTileRange(bbox, z) for z in range(zmin, zmax + 1) ]
+
+	def iterTiles(self, ranges, skip=0):
+		'''Enumerate tiles (x,y,z) in a deterministic order, starting at the tile of index skip'''
+		for z, colMin, rowMin, colMax, rowMax in ranges:
+			nbRows = rowMax - rowMin + 1
+			n = (colMax - colMin + 1) * nbRows
+			if skip >= n:
+				skip -= n
+				continue
+			#tiles numbers are computed by chunks of batch size
+			for start in range(skip, n, self.batchSize):
+				i = np.arange(start, min(start + self.batchSize, n))
+				cols, rows = np.divmod(i, nbRows)
+				yield from zip((colMin + cols).tolist(), (rowMin + rows).tolist(), [z] * len(i))
+			skip = 0
+
+
+	@property
+	def throughput(self):
+		'''Return (tiles/s, MB/s) of the downloads'''
+		if self.t0 is None:
+			return 0, 0
+		t = max(time.time() - self.t0, 1e-6)
+		return self.nbDownloaded / t, self.nbBytes / 1024**2 / t
+
+	def report(self, z):
+		tps, mbps = self.throughput
+		print('Seeding z{} : {}/{} tiles ({} downloaded, {} failed) - {:.1f} tiles/s - {:.2f} MB/s'.format(z, self.nbDone, self.nbTotal, self.nbDownloaded, self.nbFailed, tps, mbps))
+
+	def getSucceeded(self, cache, tiles):
+		'''
+		Return the set of tiles (x,y,z) of [(x,y,z,data)] which are cached or known to be missing on the server
+		Tiles with data are looked up in the cache, because some of them are not cached (like reprojected tiles
+		built from incomplete source tiles, see MapService.warpTiles)
+		'''
+		succeeded = set( t[:3] for t in cache.getTiles([ t[:3] for t in tiles if t[3] is not None ]) )
+		if not self.toDstGrid:
+			succeeded.update(cache.getMissing([ t[:3] for t in tiles if t[3] is None ]))
+		return succeeded
+
+	def retryFailed(self, cache, job, generation, callback=None):
+		'''Request again the tiles given up by a previous run of the job, return the number of tiles still failing'''
+		failed = cache.getSeedFailed(job)
+		if failed:
+			print('Requesting again {} failed tiles'.format(len(failed)))
+		nbFailed = len(failed)
+		for i in range(0, len(failed), self.batchSize):
+			self.waitBreaker(generation)
+			if not self.srv.isAlive(generation):
+				break
+			batch = failed[i:i+self.batchSize]
+			#requested again while some succeed, the breaker lets only one request through when it's half open
+			while batch and self.srv.isAlive(generation):
+				fetched = self.srv.getTiles(self.laykey, batch, [], self.toDstGrid, useCache=True, nbThread=self.nbThread, cpt=False, callback=callback)
+				succeeded = self.getSucceeded(cache, fetched).intersection(batch)
+				if not succeeded:
+					break
+				cache.deleteSeedFailed(job, succeeded)
+				nbFailed -= len(succeeded)
+				batch = [t for t in batch if t not in succeeded]
+		return nbFailed
+
+	def waitBreaker(self, generation):
+		'''Wait until the circuit breaker of the source lets requests through again, or seeding is stopped'''
+		breaker = self.srv.getBreaker()
+		if breaker.state != 'OPEN':
+			return
+		print('Server unavailable, waiting {} seconds before trying again'.format(breaker.cooldown))
+		while self.srv.isAlive(generation) and breaker.state == 'OPEN':
+			time.sleep(0.5)
+
+
+	def seed(self, bbox, zmin, zmax, bboxCRS=None, resume=True, report=True):
+		'''
+		Download all tiles covering bbox between zoom levels zmin and zmax (inclusive)
+		bbox can be expressed in any crs (bboxCRS), it's reprojected to the grid crs if needed
+		Seeding is a request of the map service, it can be stopped by srv.cancel() or by a new request
+		Return the number of tiles processed
+		Tiles failing MAX_STALLS times in a row are journaled as failed and skipped, they are requested
+		again on resume. Seeding stops if a whole batch is given up while the server is unavailable
+		'''
+		if bboxCRS is not None and bboxCRS != self.tm.CRS:
+			bbox = reprojBbox(bboxCRS, self.tm.CRS, bbox)
+		bbox = tuple(bbox)
+
+		ranges = self.getRanges(bbox, zmin, zmax)
+		self.nbTotal = sum( (colMax - colMin + 1) * (rowMax - rowMin + 1) for z, colMin, rowMin, colMax, rowMax in ranges )
+
+		#identify the job to find its progress in the journal
+		cache = self.srv.getCache(self.laykey, self.toDstGrid)
+		job = ','.join(map(str, (self.laykey,) + bbox + (zmin, zmax)))
+		if resume:
+			self.nbDone = cache.getSeedProgress(job)
+		else:
+			self.nbDone = 0
+
+		def downloaded(tile):
+			data = tile[3]
+			if data is not None:
+				self.nbDownloaded += 1
+				self.nbBytes += len(data)
+
+		self.nbDownloaded, self.nbFailed, self.nbBytes = 0, 0, 0
+		self.t0 = time.time()
+		generation = self.srv.newRequest()
+
+		if resume:
+			self.nbFailed = self.retryFailed(cache, job, generation, downloaded)
+		else:
+			cache.deleteSeedFailed(job)
+
+		batch = []
+		stalls = 0
+		tiles = self.iterTiles(ranges, skip=self.nbDone)
+		while self.srv.isAlive(generation):
+			tile = next(tiles, None)
+			if tile is not None:
+				batch.append(tile)
+			if len(batch) == self.batchSize or (tile is None and batch):
+				fetched = self.srv.getTiles(self.laykey, batch, [], self.toDstGrid, useCache=True, nbThread=self.nbThread, cpt=False, callback=downloaded)
+				if not self.srv.isAlive(generation):
+					#batch is incomplete, it will be requested again on resume
+					break
+				succeeded = self.getSucceeded(cache, fetched)
+				failed = [t for t in batch if t not in succeeded]
+				#the journal only moves over the first tiles of the batch that all succeeded
+				n = next( (i for i, t in enumerate(batch) if t not in succeeded), len(batch) )
+				stop = False
+				if n > 0:
+					stalls = 0
+				else:
+					stalls += 1
+					if stalls >= self.MAX_STALLS:
+						#give up the tiles still failing, so that the journal moves over them
+						cache.putSeedFailed(job, failed)
+						self.nbFailed += len(failed)
+						stop = len(failed) == len(batch) and self.srv.getBreaker().state != 'CLOSED'
+						n, failed, stalls = len(batch), [], 0
+				if n > 0:
+					#the journal must not get ahead of the tiles queued in the background writer
+					cache.flush()
+					self.nbDone += n
+					cache.setSeedProgress(job, self.nbDone, self.nbTotal)
+				if report:
+					self.report(batch[-1][2])
+				batch = []
+				if stop:
+					print('Seeding stopped, the server is unavailable. Run the same command again to resume')
+					break
+				if failed:
+					#request again from the first failed tile, the next ones are read from the cache
+					self.waitBreaker(generation)
+					tiles = self.iterTiles(ranges, skip=self.nbDone)
+					continue
+			if tile is None:
+				break
+
+		if self.nbFailed:
+			print('{} tiles failed, they will be requested again if the same command is run again'.format(self.nbFailed))
+		self.srv.cancel(generation)
+		return self.nbDone
+
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(description='Seed BlenderGIS basemaps cache')
+	parser.add_argument('source', choices=list(SOURCES.keys()), help='map service source key')
+	parser.add_argument('layer', help='layer key')
+	parser.add_argument('--grid', choices=list(GRIDS.keys()), help='tile matrix key (default to the source grid)')
+	parser.add_argument('--bbox', nargs=4, type=float, required=True, metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'))
+	parser.add_argument('--crs', default='EPSG:4326', help='crs of the bbox (default EPSG:4326)')
+	parser.add_argument('--zmin', type=int, required=True)
+	parser.add_argument('--zmax', type=int, required=True)
+	parser.add_argument('--cache', required=True, help='cache folder')
+	parser.add_argument('--threads', type=int, default=8, help='max number of concurrent downloads')
+	parser.add_argument('--batch', type=int, default=256, help='number of tiles committed at once')
+	parser.add_argument('--restart', action='store_true', help='ignore the progress journal')
+	args = parser.parse_args(args)
+
+	srv = MapService(args.source, os.path.join(args.cache, ''), args.grid)
+	if args.layer not in srv.layers:
+		parser.error('unknown layer ' + args.layer + ', choose from ' + ', '.join(srv.layers.keys()))
+	seeder = TilesSeeder(srv, args.layer, toDstGrid=srv.dstGridKey is not None, nbThread=args.threads, batchSize=args.batch)
+	try:
+		seeder.seed(args.bbox, args.zmin, args.zmax, bboxCRS=args.crs, resume=not args.restart)
+	except KeyboardInterrupt:
+		srv.cancel()
+		print('Seeding interrupted, run the same command again to resume')
+	finally:
+		srv.close()
+
+
+if __name__ == '__main__':
+	main()
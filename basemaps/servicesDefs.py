@@ -213,6 +213,7 @@ SOURCES = {
 			"HEIGHT" : '{HEIGHT}',
 			"TRANSPARENT" : "False"
 			},
+		"metatile": {"size": [4, 4], "buffer": 32}, #cols, rows, pixels around the metatile (avoid clipped labels)
 		"referer": "http://www.osm-wms.de/"
 	},
 
@@ -242,6 +243,7 @@ SOURCES = {
 			"HEIGHT" : '{HEIGHT}',
 			"TRANSPARENT" : "False"
 			},
+		"metatile": {"size": [4, 4], "buffer": 0}, #no labels on orthophotos
 		"referer": "http://www.craig.fr/"
 	},
 
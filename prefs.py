@@ -78,6 +78,37 @@ class BGIS_PREFS(AddonPreferences):
 		items = [ ('NN', 'Nearest Neighboor', ''), ('BL', 'Bilinear', ''), ('CB', 'Cubic', ''), ('CBS', 'Cubic Spline', ''), ('LCZ', 'Lanczos', '') ]
 		)
 
+	fetchEngine = EnumProperty(
+		name = "Download engine",
+		description = "Choose the engine used to download tiles",
+		items = [ ('THREAD', 'Threads', 'Download tiles through a pool of threads'), ('ASYNC', 'Asyncio', 'Download tiles through an asyncio event loop') ]
+		)
+
+	prefetch = BoolProperty(name="Prefetch tiles", description='Download in background the tiles around the view and at adjacent zoom levels', default=True)
+
+	prefetchMaxTiles = IntProperty(
+		name = "Prefetch budget",
+		description = "Maximum number of tiles prefetched for each view",
+		default = 200,
+		min = 0
+		)
+
+	cacheMaxSize = IntProperty(
+		name = "Max cache size (MB)",
+		description = "Maximum size of each cache file, least recently used tiles are deleted beyond. Zero means no limit",
+		default = 0,
+		min = 0
+		)
+
+	cacheDedup = BoolProperty(name="Deduplicate tiles", description='Store identical tiles (oceans, empty areas...) only once in new cache files', default=False)
+
+	memCacheSize = IntProperty(
+		name = "Memory cache (MB)",
+		description = "Maximum memory used to keep decoded tiles, zero disables the memory cache",
+		default = 256,
+		min = 0
+		)
+
 
 	def draw(self, context):
 		layout = self.layout
@@ -103,12 +134,20 @@ class BGIS_PREFS(AddonPreferences):
 		box.label('Basemaps')
 		box.prop(self, "cacheFolder")
 		row = box.row()
+		row.prop(self, "cacheMaxSize")
+		row.prop(self, "cacheDedup")
+		row = box.row()
 		row.prop(self, "zoomToMouse")
 		row.prop(self, "lockOrigin")
 		row.label('Font color:')
 		row.prop(self, "fontColor", text='')
 		row = box.row()
 		row.prop(self, "resamplAlg")
+		row.prop(self, "memCacheSize")
+		row = box.row()
+		row.prop(self, "fetchEngine")
+		row.prop(self, "prefetch")
+		row.prop(self, "prefetchMaxTiles")
 
 
 
@@ -0,0 +1,248 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+import time
+import threading
+import zlib
+import http.client
+import urllib.parse
+import urllib.request
+
+
+def decodeBody(data, encoding):
+	'''Decode a response body according to its Content-Encoding header value'''
+	encoding = encoding.lower()
+	if encoding == 'gzip':
+		return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+	elif encoding == 'deflate':
+		return zlib.decompress(data)
+	return data
+
+
+class HTTPConnectionPool():
+	'''
+	Thread safe pool of persistent HTTP/1.1 connections grouped by host
+	Connections are kept alive between requests so that consecutive requests
+	to the same server do not pay a new TCP (and TLS) handshake each time
+	'''
+
+	REDIRECT_CODES = (301, 302, 303, 307, 308)
+	MAX_REDIRECTS = 5
+
+	def __init__(self, maxSize=10, idleTimeout=30, timeout=3):
+		self.maxSize = maxSize #max number of connections per host (idle + active)
+		self.idleTimeout = idleTimeout #seconds before an idle connection is discarded
+		self.timeout = timeout #socket timeout in seconds, for I/O only
+
+		self._idle = {} #host key : [(connection, last used time)]
+		self._slots = {} #host key : semaphore limiting the number of connections
+		self._lock = threading.Lock()
+
+		#Reuse statistics
+		self.nbRequests = 0
+		self.nbOpened = 0
+		self.nbReused = 0
+
+
+	@property
+	def reuseRatio(self):
+		if self.nbRequests == 0:
+			return 0
+		return self.nbReused / self.nbRequests
+
+	@property
+	def nbIdle(self):
+		with self._lock:
+			return sum(len(conns) for conns in self._idle.values())
+
+
+	def _getTarget(self, url):
+		'''
+		Return the host key of the connection to use and the path to request
+		http proxies defined in environment variables are respected
+		'''
+		u = urllib.parse.urlsplit(url)
+		scheme = u.scheme.lower()
+		port = u.port
+		if port is None:
+			port = 443 if scheme == 'https' else 80
+		path = u.path or '/'
+		if u.query:
+			path += '?' + u.query
+
+		proxy = urllib.request.getproxies().get(scheme)
+		if proxy is not None and not urllib.request.proxy_bypass(u.hostname):
+			p = urllib.parse.urlsplit(proxy)
+			proxy = (p.hostname, p.port or 8080)
+			if scheme == 'http':
+				#plain http proxies expect the absolute url
+				path = url
+		else:
+			proxy = None
+
+		return (scheme, u.hostname, port, proxy), path
+
+	def _connect(self, key):
+		scheme, host, port, proxy = key
+		if scheme == 'https':
+			connClass = http.client.HTTPSConnection
+		else:
+			connClass = http.client.HTTPConnection
+		if proxy is None:
+			return connClass(host, port, timeout=self.timeout)
+		conn = connClass(*proxy, timeout=self.timeout)
+		if scheme == 'https':
+			conn.set_tunnel(host, port)
+		return conn
+
+	def _acquire(self, key):
+		'''Return a (connection, isReused) tuple, open a new connection if no valid idle one exists'''
+		now = time.time()
+		with self._lock:
+			slots = self._slots.get(key)
+			if slots is None:
+				slots = self._slots[key] = threading.BoundedSemaphore(self.maxSize)
+		#wait for a free slot for this host, without timeout : slots are only held during requests, which are
+		#bounded by the socket timeout, and a busy pool must not be reported as a failure of the server
+		slots.acquire()
+		with self._lock:
+			conns = self._idle.get(key, [])
+			while conns:
+				conn, lastUsed = conns.pop()
+				if now - lastUsed < self.idleTimeout:
+					self.nbReused += 1
+					return conn, True
+				conn.close()
+			self.nbOpened += 1
+		return self._connect(key), False
+
+	def _release(self, key, conn, keep=True):
+		if keep:
+			with self._lock:
+				self._idle.setdefault(key, []).append( (conn, time.time()) )
+		else:
+			conn.close()
+		self._slots[key].release()
+
+
+	def request(self, url, headers={}, method='GET'):
+		'''
+		Perform a request and return a (status, data) tuple
+		Redirections are followed and gzip or deflate content encodings are decoded
+		Raise http.client.HTTPException or OSError if the request cannot be performed
+		'''
+		for i in range(self.MAX_REDIRECTS + 1):
+			status, respHeaders, data = self._request(url, headers, method)
+			location = respHeaders.get('Location')
+			if status in self.REDIRECT_CODES and location is not None:
+				url = urllib.parse.urljoin(url, location)
+				continue
+			break
+
+		return status, decodeBody(data, respHeaders.get('Content-Encoding', ''))
+
+	def _request(self, url, headers, method):
+		key, path = self._getTarget(url)
+		with self._lock:
+			self.nbRequests += 1
+
+		conn, reused = self._acquire(key)
+		try:
+			try:
+				conn.request(method, path, headers=headers)
+				resp = conn.getresponse()
+			except (http.client.HTTPException, OSError):
+				if not reused:
+					raise
+				#the server has probably closed this idle connection, retry once with a new one
+				conn.close()
+				with self._lock:
+					self.nbReused -= 1
+					self.nbOpened += 1
+				conn = self._connect(key)
+				conn.request(method, path, headers=headers)
+				resp = conn.getresponse()
+			data = resp.read()
+		except:
+			self._release(key, conn, keep=False)
+			raise
+
+		self._release(key, conn, keep=not resp.will_close)
+		return resp.status, resp.headers, data
+
+
+	def clear(self):
+		'''Close all idle connections'''
+		with self._lock:
+			for conns in self._idle.values():
+				for conn, lastUsed in conns:
+					conn.close()
+			self._idle.clear()
+
+
+
+class CircuitBreaker():
+	'''
+	Stop requesting a server that is down
+	After threshold consecutive failures the circuit opens : requests are refused without trying
+	during cooldown seconds. Then a single trial request is allowed (half open state),
+	its success closes the circuit, its failure opens it again for a new cooldown period.
+	'''
+
+	def __init__(self, threshold=5, cooldown=30):
+		self.threshold = threshold
+		self.cooldown = cooldown #seconds
+
+		self.nbFailures = 0 #consecutive failures
+		self.openedAt = None
+		self.trial = False #a trial request is pending
+		self._lock = threading.Lock()
+
+	@property
+	def state(self):
+		if self.openedAt is None:
+			return 'CLOSED'
+		if self.trial or time.time() - self.openedAt >= self.cooldown:
+			return 'HALF_OPEN'
+		return 'OPEN'
+
+	def allow(self):
+		'''Return True if a request can be sent'''
+		with self._lock:
+			if self.openedAt is None:
+				return True
+			if not self.trial and time.time() - self.openedAt >= self.cooldown:
+				self.trial = True
+				return True
+			return False
+
+	def success(self):
+		with self._lock:
+			self.nbFailures = 0
+			self.openedAt = None
+			self.trial = False
+
+	def failure(self):
+		with self._lock:
+			self.nbFailures += 1
+			if self.trial or self.nbFailures >= self.threshold:
+				if self.openedAt is None or self.trial:
+					print('Too many failures, stop requesting the server for ' + str(self.cooldown) + ' seconds')
+				self.openedAt = time.time()
+				self.trial = False
@@ -0,0 +1,186 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+import os
+import json
+import time
+import bisect
+import threading
+import contextlib
+
+
+class Histogram():
+	'''
+	Fixed buckets histogram of durations in seconds, percentiles are estimated from the buckets by
+	linear interpolation inside the bucket, whose edges are narrowed to the min and max values
+	'''
+
+	BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) #upper bounds of the buckets
+
+	def __init__(self):
+		self.counts = [0] * (len(self.BOUNDS) + 1)
+		self.count = 0
+		self.total = 0
+		self.min = 0
+		self.max = 0
+
+	def add(self, value):
+		self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+		self.min = min(self.min, value) if self.count else value
+		self.count += 1
+		self.total += value
+		self.max = max(self.max, value)
+
+	@property
+	def mean(self):
+		return self.total / self.count if self.count else 0
+
+	def percentile(self, q):
+		'''Return the estimated percentile q (0-100)'''
+		if self.count == 0:
+			return 0
+		rank = self.count * q / 100
+		n = 0
+		for i, c in enumerate(self.counts):
+			if c > 0 and n + c >= rank:
+				lower = max(self.BOUNDS[i-1] if i > 0 else 0, self.min)
+				upper = min(self.BOUNDS[i], self.max) if i < len(self.BOUNDS) else self.max
+				return lower + (upper - lower) * max(rank - n, 0) / c
+			n += c
+		return self.max
+
+	def asDict(self):
+		return {'count': self.count, 'total': self.total, 'mean': self.mean, 'min': self.min, 'max': self.max,
+			'p50': self.percentile(50), 'p95': self.percentile(95)}
+
+
+class TraceRecorder():
+	'''
+	Record spans in the Chrome trace event format, the json file can be opened
+	in chrome://tracing or https://ui.perfetto.dev
+	'''
+
+	def __init__(self):
+		self.events = []
+		self.t0 = time.perf_counter()
+		self._lock = threading.Lock()
+
+	def span(self, name, start, duration, cat='tiles', args=None):
+		'''Add a complete event, start is a time.perf_counter() value and duration is in seconds'''
+		event = {'name': name, 'cat': cat, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+			'ts': (start - self.t0) * 1e6, 'dur': duration * 1e6}
+		if args:
+			event['args'] = args
+		with self._lock:
+			self.events.append(event)
+
+	def dump(self, path):
+		with self._lock:
+			events = list(self.events)
+		with open(path, 'w') as f:
+			json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+class Metrics():
+	'''
+	Thread safe metrics of a tiles pipeline
+		counters : number of events or bytes (cache hits, downloads...)
+		timers : durations histograms (download latency, decoding...)
+		gauges : current and peak values (in-flight downloads...)
+	Spans measured with timer() are also recorded by the trace recorder, if tracing is on
+	'''
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.tracer = None
+		self.reset()
+
+	def reset(self):
+		with self._lock:
+			self.counters = {}
+			self.timers = {}
+			self.gauges = {}
+			self.peaks = {}
+
+	def incr(self, name, n=1):
+		with self._lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	def gauge(self, name, delta):
+		'''Move a gauge by delta and keep track of its peak value'''
+		with self._lock:
+			v = self.gauges[name] = self.gauges.get(name, 0) + delta
+			if v > self.peaks.get(name, 0):
+				self.peaks[name] = v
+
+	def observe(self, name, duration, start=None, args=None):
+		'''Add a duration in seconds to a timer, and a span to the trace if its start is known'''
+		with self._lock:
+			hist = self.timers.get(name)
+			if hist is None:
+				hist = self.timers[name] = Histogram()
+			hist.add(duration)
+		tracer = self.tracer
+		if tracer is not None and start is not None:
+			tracer.span(name, start, duration, args=args)
+
+	@contextlib.contextmanager
+	def timer(self, name, args=None):
+		'''Measure the duration of a block of code'''
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(name, time.perf_counter() - start, start, args)
+
+	@contextlib.contextmanager
+	def tracing(self, path):
+		'''Record the spans of a block of code (like a getImage call) and write them to a Chrome trace json file'''
+		self.tracer = TraceRecorder()
+		try:
+			yield self.tracer
+		finally:
+			tracer, self.tracer = self.tracer, None
+			tracer.dump(path)
+
+	def snapshot(self):
+		'''Return all metrics as a json serializable dictionary'''
+		with self._lock:
+			return {
+				'counters': dict(self.counters),
+				'timers': {k: h.asDict() for k, h in self.timers.items()},
+				'gauges': dict(self.gauges),
+				'peaks': dict(self.peaks)
+			}
+
+	def ratio(self, hits, misses):
+		'''Return the ratio of two counters, like a cache hit ratio'''
+		with self._lock:
+			h, m = self.counters.get(hits, 0), self.counters.get(misses, 0)
+		return h / (h + m) if h + m else 0
+
+	def report(self):
+		'''Return a human readable summary'''
+		snap = self.snapshot()
+		lines = [k + ' : ' + str(v) for k, v in sorted(snap['counters'].items())]
+		for k, t in sorted(snap['timers'].items()):
+			lines.append('{} : {} x {:.1f}ms (p50 {:.1f}ms, p95 {:.1f}ms, max {:.1f}ms)'.format(k, t['count'], t['mean']*1e3, t['p50']*1e3, t['p95']*1e3, t['max']*1e3))
+		for k, v in sorted(snap['peaks'].items()):
+			lines.append('{} : {} (peak {})'.format(k, snap['gauges'].get(k, 0), v))
+		return '\n'.join(lines)
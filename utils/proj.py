@@ -22,6 +22,8 @@ import urllib.request
 import json
 import math
 
+import numpy as np
+
 from .utm import UTM, UTM_EPSG_CODES
 from .errors import ReprojError
 from .geom import BBOX
@@ -84,7 +86,7 @@ class Reproj():
 			self.iproj = 'GDAL'
 		elif PYPROJ:
 			 self.iproj = 'PYPROJ'
-		elif ((crs1.isWM or crs1.isUTM) and crs2.isWGS84) or (crs1.isWGS84 and (crs2.isWM or crs2.isUTM)):
+		elif self.isBuiltin(crs1, crs2):
 			self.iproj = 'BUILTIN'
 		elif EPSGIO.ping():
 			#this is the slower solution, not suitable for reproject lot of points
@@ -110,7 +112,7 @@ class Reproj():
 				raise ReprojError('EPSG.io support only EPSG code')
 
 		elif self.iproj == 'BUILTIN':
-			if ((crs1.isWM or crs1.isUTM) and crs2.isWGS84) or (crs1.isWGS84 and (crs2.isWM or crs2.isUTM)):
+			if self.isBuiltin(crs1, crs2):
 				#just store codes
 				self.crs1, self.crs2 = crs1.code, crs2.code
 			else:
@@ -122,6 +124,17 @@ class Reproj():
 				self.utm = UTM.init_from_epsg(crs2)
 
 
+	@staticmethod
+	def isBuiltin(crs1, crs2):
+		'''Return True if the transformation between these two SRS objects is supported by the built-in formulas'''
+		if crs1.isWGS84:
+			return crs2.isWM or crs2.isUTM
+		elif crs1.isWM:
+			return crs2.isWGS84 or crs2.isUTM
+		elif crs1.isUTM:
+			return crs2.isWGS84 or crs2.isWM
+		return False
+
 	def pts(self, pts):
 		if len(pts) == 0:
 			return []
@@ -152,6 +165,11 @@ class Reproj():
 				return [self.utm.lonlat_to_utm(*pt) for pt in pts]
 			elif self.crs1 in UTM_EPSG_CODES and self.crs2 == 4326:
 				return [self.utm.utm_to_lonlat(*pt) for pt in pts]
+			#Web Mercator <> UTM through WGS84
+			if self.crs1 == 3857 and self.crs2 in UTM_EPSG_CODES:
+				return [self.utm.lonlat_to_utm(*webMercToLonLat(*pt)) for pt in pts]
+			elif self.crs1 in UTM_EPSG_CODES and self.crs2 == 3857:
+				return [lonLatToWebMerc(*self.utm.utm_to_lonlat(*pt)) for pt in pts]
 
 	def pt(self, x, y):
 		if x is None or y is None:
@@ -384,6 +402,70 @@ def lonLatToWebMerc(lon, lat):
 	y = lat * k
 	return x, y
 
+#vectorized versions for numpy arrays
+def webMercToLonLatArray(xs, ys):
+	k = GRS80.perimeter/360
+	lons = xs / k
+	lats = 180 / math.pi * (2 * np.arctan( np.exp( ys / k * math.pi / 180.0)) - math.pi / 2.0)
+	return lons, lats
+
+def lonLatToWebMercArray(lons, lats):
+	k = GRS80.perimeter/360
+	xs = lons * k
+	ys = np.log( np.tan((90 + lats) * math.pi / 360.0 )) / (math.pi / 180.0) * k
+	return xs, ys
+
+
+class ArrayReproj():
+	'''
+	Reproject numpy arrays of coordinates with the built-in formulas, no dependency required
+	Only Web Mercator, WGS84 and UTM are supported, others transformations are chained through WGS84
+	Coordinates out of the domain of validity give nan or inf values
+	'''
+
+	@classmethod
+	def validate(cls, crs1, crs2):
+		try:
+			cls(crs1, crs2)
+			return True
+		except ReprojError:
+			return False
+
+	def __init__(self, crs1, crs2):
+		try:
+			crs1, crs2 = SRS(crs1), SRS(crs2)
+		except Exception as e:
+			raise ReprojError(str(e))
+
+		for crs in (crs1, crs2):
+			if not (crs.isWM or crs.isWGS84 or crs.isUTM):
+				raise ReprojError('Not implemented transformation')
+
+		if crs1.isWM:
+			self.toLonLat = webMercToLonLatArray
+		elif crs1.isUTM:
+			self.toLonLat = UTM.init_from_epsg(crs1).utm_to_lonlat_array
+		else:
+			self.toLonLat = None
+
+		if crs2.isWM:
+			self.fromLonLat = lonLatToWebMercArray
+		elif crs2.isUTM:
+			self.fromLonLat = UTM.init_from_epsg(crs2).lonlat_to_utm_array
+		else:
+			self.fromLonLat = None
+
+		if crs1.SRID == crs2.SRID:
+			self.toLonLat = self.fromLonLat = None
+
+	def pts(self, xs, ys):
+		'''xs, ys >> numpy arrays, return reprojected (xs, ys) arrays'''
+		if self.toLonLat is not None:
+			xs, ys = self.toLonLat(xs, ys)
+		if self.fromLonLat is not None:
+			xs, ys = self.fromLonLat(xs, ys)
+		return xs, ys
+
 
 ######################################
 # EPSG.io
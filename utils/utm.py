@@ -10,6 +10,8 @@
 
 import math
 
+import numpy as np
+
 
 K0 = 0.9996
 
@@ -132,32 +134,40 @@ class UTM():
 		if not 0 <= northing <= 10000000:
 			raise OutOfRangeError('northing out of range (must be between 0 m and 10.000.000 m)')
 
+		return self._utm_to_lonlat(easting, northing, math)
+
+	def utm_to_lonlat_array(self, eastings, northings):
+		'''Vectorized utm_to_lonlat() for numpy arrays, coordinates out of range are not checked'''
+		return self._utm_to_lonlat(eastings, northings, np)
+
+	def _utm_to_lonlat(self, easting, northing, m):
+		'''m is the math module or numpy'''
 		x = easting - 500000
 		y = northing
 
 		if not self.northern:
-			y -= 10000000
+			y = y - 10000000
 
-		m = y / K0
-		mu = m / (R * M1)
+		mer = y / K0
+		mu = mer / (R * M1)
 
 		p_rad = (mu +
-				 P2 * math.sin(2 * mu) +
-				 P3 * math.sin(4 * mu) +
-				 P4 * math.sin(6 * mu) +
-				 P5 * math.sin(8 * mu))
+				 P2 * m.sin(2 * mu) +
+				 P3 * m.sin(4 * mu) +
+				 P4 * m.sin(6 * mu) +
+				 P5 * m.sin(8 * mu))
 
-		p_sin = math.sin(p_rad)
+		p_sin = m.sin(p_rad)
 		p_sin2 = p_sin * p_sin
 
-		p_cos = math.cos(p_rad)
+		p_cos = m.cos(p_rad)
 
 		p_tan = p_sin / p_cos
 		p_tan2 = p_tan * p_tan
 		p_tan4 = p_tan2 * p_tan2
 
 		ep_sin = 1 - E * p_sin2
-		ep_sin_sqrt = math.sqrt(1 - E * p_sin2)
+		ep_sin_sqrt = m.sqrt(1 - E * p_sin2)
 
 		n = R / ep_sin_sqrt
 		r = (1 - E) / ep_sin
@@ -181,8 +191,8 @@ class UTM():
 					 d3 / 6 * (1 + 2 * p_tan2 + c) +
 					 d5 / 120 * (5 - 2 * c + 28 * p_tan2 - 3 * c2 + 8 * E_P2 + 24 * p_tan4)) / p_cos
 
-		return (math.degrees(longitude) + zone_number_to_central_longitude(self.zone_number),
-				math.degrees(latitude))
+		return (m.degrees(longitude) + zone_number_to_central_longitude(self.zone_number),
+				m.degrees(latitude))
 
 
 	def lonlat_to_utm(self, longitude, latitude):
@@ -191,19 +201,27 @@ class UTM():
 		if not -180.0 <= longitude <= 180.0:
 			raise OutOfRangeError('longitude out of range (must be between 180 deg W and 180 deg E)')
 
-		lat_rad = math.radians(latitude)
-		lat_sin = math.sin(lat_rad)
-		lat_cos = math.cos(lat_rad)
+		return self._lonlat_to_utm(longitude, latitude, math)
+
+	def lonlat_to_utm_array(self, longitudes, latitudes):
+		'''Vectorized lonlat_to_utm() for numpy arrays, coordinates out of range are not checked'''
+		return self._lonlat_to_utm(longitudes, latitudes, np)
+
+	def _lonlat_to_utm(self, longitude, latitude, m):
+		'''m is the math module or numpy'''
+		lat_rad = m.radians(latitude)
+		lat_sin = m.sin(lat_rad)
+		lat_cos = m.cos(lat_rad)
 
 		lat_tan = lat_sin / lat_cos
 		lat_tan2 = lat_tan * lat_tan
 		lat_tan4 = lat_tan2 * lat_tan2
 
-		lon_rad = math.radians(longitude)
+		lon_rad = m.radians(longitude)
 		central_lon = zone_number_to_central_longitude(self.zone_number)
-		central_lon_rad = math.radians(central_lon)
+		central_lon_rad = m.radians(central_lon)
 
-		n = R / math.sqrt(1 - E * lat_sin**2)
+		n = R / m.sqrt(1 - E * lat_sin**2)
 		c = E_P2 * lat_cos**2
 
 		a = lat_cos * (lon_rad - central_lon_rad)
@@ -213,16 +231,16 @@ class UTM():
 		a5 = a4 * a
 		a6 = a5 * a
 
-		m = R * (M1 * lat_rad -
-				 M2 * math.sin(2 * lat_rad) +
-				 M3 * math.sin(4 * lat_rad) -
-				 M4 * math.sin(6 * lat_rad))
+		mer = R * (M1 * lat_rad -
+				 M2 * m.sin(2 * lat_rad) +
+				 M3 * m.sin(4 * lat_rad) -
+				 M4 * m.sin(6 * lat_rad))
 
 		easting = K0 * n * (a +
 							a3 / 6 * (1 - lat_tan2 + c) +
 							a5 / 120 * (5 - 18 * lat_tan2 + lat_tan4 + 72 * c - 58 * E_P2)) + 500000
 
-		northing = K0 * (m + n * lat_tan * (a2 / 2 +
+		northing = K0 * (mer + n * lat_tan * (a2 / 2 +
 											a4 / 24 * (5 - lat_tan2 + 9 * c + 4 * c**2) +
 											a6 / 720 * (61 - 58 * lat_tan2 + lat_tan4 + 600 * c - 330 * E_P2)))
 